@@ -0,0 +1,144 @@
+"""
+Pick which new images to label next.
+Every evaluated image gets an uncertainty score from its probability vector
+(margin between the top two classes, normalized entropy, or both). Only the
+most uncertain `pool_size` images are kept while results stream past, so memory
+is bounded by the pool, not the number of candidates.
+
+The pool is then embedded with the shared MobileNetV2 backbone (through the
+feature cache) and a budget is filled greedily: each pick maximizes a mix of
+its uncertainty and its distance to the training set (via the embedding index)
+and to the images already picked, so near-identical photos are not all chosen.
+"""
+import math
+import os
+
+import numpy as np
+
+from batch_inference import DEFAULT_BATCH_SIZE, DEFAULT_WORKERS
+from embedding_index import DEFAULT_INDEX_DIR, EmbeddingIndex
+from feature_cache import FeatureCache, build_backbone
+from result_stream import TopK
+
+STRATEGIES = ('margin', 'entropy', 'combined')
+DEFAULT_DIVERSITY = 0.5
+# Pool size per selected image when --pool isn't given, and its upper bound
+POOL_FACTOR = 10
+MAX_POOL = 20000
+# A candidate this similar to one already picked is never picked as well
+DUPLICATE_SIMILARITY = 0.95
+
+
+def uncertainty(result, strategy='combined', num_classes=None):
+    """
+    0 (certain) .. 1 (uncertain) for a result dict. Results written before margin
+    and entropy were recorded fall back to the margin of their top-3 list.
+    """
+    margin = result.get('margin')
+    if margin is None:
+        top = [p for _, p in result.get('top3') or []] + [0.0, 0.0]
+        margin = top[0] - top[1]
+    entropy = result.get('entropy')
+    if entropy is not None and num_classes and num_classes > 1:
+        entropy = entropy / math.log(num_classes)
+
+    if strategy == 'margin' or entropy is None:
+        return 1.0 - margin
+    if strategy == 'entropy':
+        return entropy
+    return 0.5 * (1.0 - margin) + 0.5 * entropy
+
+
+class CandidatePool:
+    """The pool_size most uncertain results seen so far."""
+
+    def __init__(self, pool_size, strategy='combined', num_classes=None):
+        self.strategy = strategy
+        self.num_classes = num_classes
+        self.seen = 0
+        self._top = TopK(pool_size)
+
+    def add(self, result):
+        if 'error' in result:
+            return
+        self.seen += 1
+        score = uncertainty(result, self.strategy, self.num_classes)
+        self._top.push((score, -self.seen), {
+            'image': result['image'],
+            'predicted_class': result['predicted_class'],
+            'confidence': result['confidence'],
+            'uncertainty': score,
+        })
+
+    def __len__(self):
+        return len(self._top)
+
+    def items(self):
+        """Pooled candidates, most uncertain first."""
+        return self._top.items()
+
+
+def training_similarity(features, index_dir):
+    """Cosine similarity of each row to its nearest training image, or None without an index."""
+    if not os.path.exists(os.path.join(index_dir, 'meta.json')):
+        return None
+    index = EmbeddingIndex(index_dir)
+    if not len(index):
+        return None
+    scores, _ = index.search(features, k=1, allowed=index.column('split') == 'train')
+    return np.maximum(scores[:, 0], 0.0)
+
+
+def select(candidates, features, budget, diversity=DEFAULT_DIVERSITY, train_similarity=None):
+    """
+    Greedy budgeted selection. candidates are pool items with 'uncertainty';
+    features are their embeddings (one row each). Each step picks the candidate
+    maximizing (1 - diversity) * uncertainty + diversity * novelty, where novelty
+    is 1 - the highest similarity to the training set or to an earlier pick.
+    Returns the picked items with 'novelty' and 'score' added, in pick order.
+    """
+    if not candidates:
+        return []
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    features = features / np.maximum(norms, 1e-12)
+    u = np.array([c['uncertainty'] for c in candidates], dtype=np.float32)
+    closest = np.zeros(len(candidates), dtype=np.float32)
+    if train_similarity is not None:
+        closest = np.asarray(train_similarity, dtype=np.float32).copy()
+    available = np.ones(len(candidates), dtype=bool)
+
+    picked = []
+    for _ in range(min(budget, len(candidates))):
+        novelty = 1.0 - closest
+        score = np.where(available, (1.0 - diversity) * u + diversity * novelty, -np.inf)
+        best = int(np.argmax(score))
+        if not np.isfinite(score[best]):
+            break
+        picked.append(dict(candidates[best], novelty=float(novelty[best]), score=float(score[best])))
+        available[best] = False
+        sims = features @ features[best]
+        available &= sims < DUPLICATE_SIMILARITY
+        np.maximum(closest, sims, out=closest)
+    return picked
+
+
+def rank_candidates(pool, budget, diversity=DEFAULT_DIVERSITY, index_dir=DEFAULT_INDEX_DIR,
+                    batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS):
+    """Embed the pooled candidates and return the budgeted selection."""
+    candidates = pool.items()
+    if not candidates:
+        return []
+    print(f"\nRanking {len(candidates)} most uncertain of {pool.seen} images for a budget of {budget}...")
+    cache = FeatureCache()
+    features, paths, errors = cache.features_for([c['image'] for c in candidates], build_backbone(),
+                                                 batch_size, workers)
+    for path, error in errors:
+        print(f"  Skipping {path}: {error}")
+    by_path = {c['image']: c for c in candidates}
+    candidates = [by_path[p] for p in paths]
+
+    train_similarity = training_similarity(features, index_dir)
+    if train_similarity is None:
+        print(f"  No embedding index in {index_dir}; diversity is measured among the candidates only "
+              f"(run embedding_index.py build)")
+    return select(candidates, features, budget, diversity, train_similarity)
@@ -0,0 +1,77 @@
+"""
+Batched inference helpers.
+Images are decoded on a thread pool straight into preallocated batch buffers so
+the model is called once per batch instead of once per image.
+"""
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from preprocessing import load_into, IMG_SIZE, CURRENT_VERSION
+from instrumentation import metrics
+
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_WORKERS = 4
+
+
+def _safe_load_into(image_path, out, version):
+    """Decode into out, returning an error message instead of raising."""
+    try:
+        load_into(image_path, out, version)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def iter_batches(image_paths, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS,
+                 img_size=IMG_SIZE, version=CURRENT_VERSION):
+    """
+    Yield (paths, batch, errors) per batch, in input order.
+    errors has one entry per path: None if it decoded, else the error message.
+    batch is a float32 array holding only the decoded images, in order.
+    The next batch is decoded in the background while the current one is consumed.
+    Two buffers are reused in turn, so copy batch if you need it after the next
+    iteration.
+    """
+    image_paths = list(image_paths)
+    if not image_paths:
+        return
+
+    buffers = [np.empty((batch_size, img_size, img_size, 3), dtype=np.float32) for _ in range(2)]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit(start, buffer):
+            chunk = image_paths[start:start + batch_size]
+            return chunk, buffer, [pool.submit(_safe_load_into, p, buffer[i], version) for i, p in enumerate(chunk)]
+
+        pending = submit(0, buffers[0])
+        for n, start in enumerate(range(batch_size, len(image_paths) + batch_size, batch_size)):
+            chunk, buffer, futures = pending
+            # Wait for the current batch before its other buffer gets reused
+            errors_by_row = [f.result() for f in futures]
+            pending = submit(start, buffers[(n + 1) % 2]) if start < len(image_paths) else None
+
+            ok = [i for i, err in enumerate(errors_by_row) if err is None]
+            if len(ok) == len(chunk):
+                batch = buffer[:len(chunk)]
+            else:
+                batch = buffer[ok]
+            yield chunk, batch, errors_by_row
+
+
+def predict_in_batches(model, image_paths, batch_size=DEFAULT_BATCH_SIZE,
+                       workers=DEFAULT_WORKERS, img_size=IMG_SIZE, version=CURRENT_VERSION):
+    """
+    Yield (path, probabilities, error) for every input path, in input order.
+    The model is called once per batch; images that fail to decode get an error
+    and no probabilities.
+    """
+    for paths, batch, errors in iter_batches(image_paths, batch_size, workers, img_size, version):
+        preds = iter(())
+        if len(batch):
+            with metrics.timer('main_predict'):
+                preds = iter(np.asarray(model.predict_on_batch(batch)))
+        for path, error in zip(paths, errors):
+            if error is None:
+                yield path, next(preds), None
+            else:
+                yield path, None, error
@@ -0,0 +1,403 @@
+"""
+Inference and training benchmarks.
+Generates synthetic stone-like JPEGs (or uses a directory you point it at) and
+measures latency percentiles for each stage of the pipeline: decode + resize,
+scaling, backbone, stone type head and subtype head, the two-stage single-image
+path that predict_stone takes, batched directory scans and training steps.
+Results are written as JSON; pass --compare with an earlier file to see what
+got slower.
+
+Models are built with the same architecture the classifiers use, so no trained
+model files are needed. Each --threads value runs in its own process, because
+TensorFlow's thread pools can only be configured before the first op.
+
+Usage:
+  python benchmark.py --output bench.json
+  python benchmark.py --batch-sizes 1,16,64 --threads 1,4,0 --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import preprocessing
+from preprocessing import IMG_SIZE, CURRENT_VERSION
+
+STAGES = ('inference', 'directory', 'training')
+
+
+def synthetic_stone(rng, width, height):
+    """A marble-like RGB image: smooth cloudy noise crossed by warped veins."""
+    noise = np.zeros((height, width), dtype=np.float32)
+    for scale, weight in ((64, 0.5), (16, 0.3), (4, 0.2)):
+        coarse = rng.random((height // scale + 2, width // scale + 2)).astype(np.float32)
+        noise += weight * np.asarray(Image.fromarray(coarse).resize((width, height), Image.BICUBIC))
+
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    angle = rng.uniform(0, np.pi)
+    period = rng.uniform(0.02, 0.08) * max(width, height)
+    veins = np.abs(np.sin((x * np.cos(angle) + y * np.sin(angle)) / period + 8.0 * noise)) ** 0.3
+
+    base = rng.uniform(110, 235, 3).astype(np.float32)
+    vein = rng.uniform(20, 120, 3).astype(np.float32)
+    img = veins[..., None] * base + (1.0 - veins[..., None]) * vein
+    img += (noise[..., None] - 0.5) * 40.0 + rng.normal(0, 6, (height, width, 1)).astype(np.float32)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+
+def generate_images(directory, count, width, height, seed=0):
+    """Write count synthetic JPEGs into directory and return their paths."""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'stone_{i:05d}.jpg')
+        synthetic_stone(rng, width, height).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def summarize(samples, items=1):
+    """Latency percentiles (ms) for a list of per-call durations in seconds."""
+    samples = np.asarray(samples, dtype=np.float64) * 1000.0
+    mean = float(samples.mean())
+    return {
+        'calls': len(samples),
+        'mean_ms': mean,
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p90_ms': float(np.percentile(samples, 90)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'max_ms': float(samples.max()),
+        'images_per_sec': items * 1000.0 / mean if mean > 0 else None,
+    }
+
+
+def timed(fn, repeat, warmup=2):
+    """Run fn warmup times untimed, then repeat times; return the durations."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def cycle(paths, n):
+    """n paths, repeating the list as needed."""
+    return [paths[i % len(paths)] for i in range(n)]
+
+
+def configure_threads(threads):
+    """Set TensorFlow's intra- and inter-op thread pools (0 keeps TF's default)."""
+    import tensorflow as tf
+
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(max(1, threads // 2))
+
+
+def bench_inference(paths, config, backbone, head, subtype_head):
+    """Per-stage latencies, and the two-stage path predict_stone takes for one image."""
+    version = config['version']
+    results = {}
+
+    decode, scale = [], []
+    out = np.empty((IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+    for path in paths:
+        start = time.perf_counter()
+        pixels = np.asarray(preprocessing.open_resized(path, IMG_SIZE, version), dtype=np.uint8)
+        decoded = time.perf_counter()
+        np.multiply(pixels, np.float32(1.0 / 255.0), out=out)
+        decode.append(decoded - start)
+        scale.append(time.perf_counter() - decoded)
+    results['decode_resize'] = summarize(decode)
+    results['scale'] = summarize(scale)
+
+    results['backbone'] = {}
+    results['stone_type_head'] = {}
+    results['subtype_head'] = {}
+    for batch_size in config['batch_sizes']:
+        batch = preprocessing.load_batch(cycle(paths, batch_size), version=version)
+        samples = timed(lambda: backbone.predict_on_batch(batch), config['repeat'])
+        results['backbone'][str(batch_size)] = summarize(samples, batch_size)
+
+        features = np.asarray(backbone.predict_on_batch(batch))
+        samples = timed(lambda: head.predict_on_batch(features), config['repeat'])
+        results['stone_type_head'][str(batch_size)] = summarize(samples, batch_size)
+        samples = timed(lambda: subtype_head.predict_on_batch(features), config['repeat'])
+        results['subtype_head'][str(batch_size)] = summarize(samples, batch_size)
+
+    # Same work as testScript.predict_stone: decode, backbone, stone type head, subtype head
+    queue = iter(cycle(paths, config['repeat'] + 2))
+
+    def predict_one():
+        img = preprocessing.load_image(next(queue), version=version)[np.newaxis]
+        features = np.asarray(backbone.predict_on_batch(img))
+        probs = np.asarray(head.predict_on_batch(features))
+        np.asarray(subtype_head.predict_on_batch(features))
+        return int(np.argmax(probs[0]))
+
+    results['two_stage_single'] = summarize(timed(predict_one, config['repeat']))
+    return results
+
+
+def bench_directory(paths, config, model):
+    """Whole-directory throughput of the batched path evaluate_new_images.py uses."""
+    from batch_inference import predict_in_batches
+
+    results = {}
+    for batch_size in config['batch_sizes']:
+        # One untimed batch so graph tracing isn't counted
+        for _ in predict_in_batches(model, paths[:batch_size], batch_size, config['workers'],
+                                    version=config['version']):
+            pass
+        start = time.perf_counter()
+        count = sum(1 for _ in predict_in_batches(model, paths, batch_size, config['workers'],
+                                                   version=config['version']))
+        elapsed = time.perf_counter() - start
+        results[str(batch_size)] = {
+            'images': count,
+            'seconds': elapsed,
+            'images_per_sec': count / elapsed if elapsed > 0 else None,
+        }
+    return results
+
+
+def bench_training(config, backbone, num_classes):
+    """Training-step throughput with the frozen backbone, plus batch augmentation cost."""
+    import tensorflow as tf
+    from tensorflow import keras
+    from feature_cache import build_head, attach_head
+    from data_pipeline import augment_batch, DEFAULT_AUGMENTATION
+
+    model = attach_head(backbone, build_head(num_classes))
+    model.compile(
+        optimizer=keras.optimizers.Adam(learning_rate=0.001),
+        loss='categorical_crossentropy',
+        metrics=['accuracy']
+    )
+
+    rng = np.random.default_rng(0)
+    results = {'train_step': {}, 'augment': {}}
+    for batch_size in config['batch_sizes']:
+        images = rng.random((batch_size, IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+        labels = np.eye(num_classes, dtype=np.float32)[rng.integers(0, num_classes, batch_size)]
+        samples = timed(lambda: model.train_on_batch(images, labels), config['repeat'])
+        results['train_step'][str(batch_size)] = summarize(samples, batch_size)
+
+        pixels = tf.constant(images * 255.0)
+        samples = timed(lambda: augment_batch(pixels, DEFAULT_AUGMENTATION).numpy(), config['repeat'])
+        results['augment'][str(batch_size)] = summarize(samples, batch_size)
+    return results
+
+
+def run(config):
+    """Run the selected stages in this process with config['threads'] TF threads."""
+    configure_threads(config['threads'])
+    from feature_cache import build_backbone, build_head, attach_head
+
+    paths = sorted(os.path.join(config['image_dir'], f) for f in os.listdir(config['image_dir'])
+                   if os.path.splitext(f)[1].lower() in ('.jpg', '.jpeg', '.png'))
+
+    start = time.perf_counter()
+    backbone = build_backbone(weights=config['weights'])
+    head = build_head(config['classes'])
+    subtype_head = build_head(config['subtypes'])
+    result = {'threads': config['threads'], 'model_build_seconds': time.perf_counter() - start}
+
+    if 'inference' in config['stages']:
+        print(f"[threads={config['threads']}] inference stages...")
+        result['inference'] = bench_inference(paths, config, backbone, head, subtype_head)
+    if 'directory' in config['stages']:
+        print(f"[threads={config['threads']}] directory scan over {len(paths)} images...")
+        result['directory'] = bench_directory(paths, config, attach_head(backbone, head))
+    if 'training' in config['stages']:
+        print(f"[threads={config['threads']}] training steps...")
+        result['training'] = bench_training(config, backbone, config['classes'])
+    return result
+
+
+def run_in_subprocess(config):
+    """Run one thread setting in a fresh interpreter and return its result."""
+    fd, output = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__),
+                        '--child', json.dumps(config), '--output', output], check=True)
+        with open(output, 'r') as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+
+def environment():
+    import tensorflow as tf
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'tensorflow': tf.__version__,
+        'numpy': np.__version__,
+    }
+
+
+def metrics(report):
+    """Flatten a report into {name: (images_per_sec, p50_ms)} for comparison."""
+    flat = {}
+
+    def walk(prefix, node):
+        if not isinstance(node, dict):
+            return
+        if 'images_per_sec' in node:
+            flat[prefix] = (node.get('images_per_sec'), node.get('p50_ms'))
+            return
+        for key, value in node.items():
+            walk(f"{prefix}/{key}", value)
+
+    for result in report['runs']:
+        walk(f"threads={result['threads']}", result)
+    return flat
+
+
+def compare(report, baseline, tolerance):
+    """Print throughput changes against a baseline report; return the regressions."""
+    old, new = metrics(baseline), metrics(report)
+    regressions = []
+    print(f"\n{'metric':60s} {'before':>10s} {'after':>10s} {'change':>8s}")
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name][0], new[name][0]
+        if not before or not after:
+            continue
+        change = after / before - 1.0
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:60s} {before:10.1f} {after:10.1f} {change:+7.1%}{flag}")
+    print("(images/sec)")
+    return regressions
+
+
+def print_summary(report):
+    for result in report['runs']:
+        print(f"\nthreads={result['threads'] or 'default'}")
+        inference = result.get('inference')
+        if inference:
+            for stage in ('decode_resize', 'scale', 'two_stage_single'):
+                s = inference[stage]
+                print(f"  {stage:20s} p50 {s['p50_ms']:8.2f} ms  p99 {s['p99_ms']:8.2f} ms")
+            for stage in ('backbone', 'stone_type_head', 'subtype_head'):
+                for batch_size, s in inference[stage].items():
+                    print(f"  {stage + ' x' + batch_size:20s} p50 {s['p50_ms']:8.2f} ms  "
+                          f"{s['images_per_sec']:8.1f} img/s")
+        for batch_size, s in result.get('directory', {}).items():
+            print(f"  {'directory x' + batch_size:20s} {s['images_per_sec']:8.1f} img/s")
+        training = result.get('training')
+        if training:
+            for batch_size, s in training['train_step'].items():
+                print(f"  {'train_step x' + batch_size:20s} p50 {s['p50_ms']:8.2f} ms  "
+                      f"{s['images_per_sec']:8.1f} img/s")
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark inference and training throughput.")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON results file")
+    parser.add_argument('--compare', metavar='BASELINE_JSON', default=None,
+                        help="Compare images/sec with an earlier results file")
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help="Slowdown that counts as a regression with --compare (default: 0.10)")
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help=f"Comma-separated subset of {', '.join(STAGES)}")
+    parser.add_argument('--batch-sizes', type=int_list, default=[1, 8, 32, 64])
+    parser.add_argument('--threads', type=int_list, default=[0],
+                        help="TF thread counts to compare, e.g. 1,4,8 (0 = TF default)")
+    parser.add_argument('--repeat', type=int, default=20, help="Timed calls per measurement")
+    parser.add_argument('--workers', type=int, default=4, help="Decode threads for the directory scan")
+    parser.add_argument('--images', type=int, default=64, help="Synthetic images to generate")
+    parser.add_argument('--image-size', default='1600x1200',
+                        help="Synthetic image size WIDTHxHEIGHT (default: 1600x1200)")
+    parser.add_argument('--image-dir', default=None,
+                        help="Benchmark these images instead of generating synthetic ones")
+    parser.add_argument('--classes', type=int, default=4, help="Stone types in the benchmark head")
+    parser.add_argument('--subtypes', type=int, default=8, help="Subtypes in the benchmark subtype head")
+    parser.add_argument('--weights', choices=['imagenet', 'none'], default='none',
+                        help="Backbone weights; 'none' avoids the download and costs the same")
+    parser.add_argument('--version', type=int, default=CURRENT_VERSION,
+                        help=f"Preprocessing version (default: {CURRENT_VERSION})")
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open(args.output, 'w') as f:
+            json.dump(run(json.loads(args.child)), f)
+        sys.exit(0)
+
+    stages = [s for s in args.stages.split(',') if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    width, height = (int(v) for v in args.image_size.lower().split('x'))
+
+    image_dir = args.image_dir
+    generated = None
+    if image_dir is None:
+        generated = image_dir = tempfile.mkdtemp(prefix='stone_bench_')
+        print(f"Generating {args.images} synthetic {width}x{height} images...")
+        generate_images(image_dir, args.images, width, height)
+
+    config = {
+        'stages': stages,
+        'batch_sizes': args.batch_sizes,
+        'repeat': args.repeat,
+        'workers': args.workers,
+        'image_dir': image_dir,
+        'image_size': [width, height] if generated else None,
+        'classes': args.classes,
+        'subtypes': args.subtypes,
+        'weights': None if args.weights == 'none' else args.weights,
+        'version': args.version,
+    }
+
+    try:
+        runs = []
+        for threads in args.threads:
+            runs.append(run_in_subprocess(dict(config, threads=threads)))
+    finally:
+        if generated:
+            shutil.rmtree(generated, ignore_errors=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'config': config,
+        'runs': runs,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_summary(report)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regressions beyond {args.tolerance:.0%}")
+            sys.exit(1)
@@ -0,0 +1,176 @@
+"""
+tf.data input pipeline for training.
+Replaces ImageDataGenerator: images are decoded with parallel map (or read from
+pre-decoded shards), optionally cached, and augmented a whole batch at a time
+with tensor ops, so every CPU core can feed the model. Decoding always goes
+through preprocessing.py, so training sees exactly the pixels inference does.
+"""
+import math
+
+import numpy as np
+import tensorflow as tf
+
+from dataset_shards import list_labeled_images, load_index, open_shards
+from preprocessing import IMG_SIZE, CURRENT_VERSION, load_uint8
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+# Same parameters (and names) as the ImageDataGenerator the training scripts used
+DEFAULT_AUGMENTATION = {
+    'rotation_range': 20,
+    'width_shift_range': 0.2,
+    'height_shift_range': 0.2,
+    'shear_range': 0.2,
+    'zoom_range': 0.2,
+    'brightness_range': (0.8, 1.2),
+    'horizontal_flip': True,
+}
+
+
+def _decode_file(path, label, img_size, version):
+    """Decode with preprocessing.load_uint8, the same code inference and the shards use."""
+    img = tf.numpy_function(lambda p: load_uint8(p.decode(), img_size, version), [path], tf.uint8,
+                            stateful=False)
+    img.set_shape((img_size, img_size, 3))
+    return img, label
+
+
+def _shard_dataset(source_dir, index, seed, shuffle=True):
+    """
+    Dataset of (uint8 image, label) read from memory-mapped shards.
+    The (shard, row) indices are shuffled in full every epoch (shards are stored
+    in class order) and the rows are copied out of the memmaps by a parallel map.
+    """
+    images, locations, classes = open_shards(source_dir, index)
+    img_size = index['img_size']
+
+    def read(shard, row):
+        return np.asarray(images[shard][row])
+
+    def load(location, label):
+        img = tf.numpy_function(read, [location[0], location[1]], tf.uint8, stateful=False)
+        img.set_shape((img_size, img_size, 3))
+        return img, label
+
+    ds = tf.data.Dataset.from_tensor_slices((locations, classes.astype(np.int32)))
+    if shuffle:
+        ds = ds.shuffle(max(len(classes), 1), seed=seed, reshuffle_each_iteration=True)
+    return ds.map(load, num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+
+
+def _uniform(batch, low, high, seed=None):
+    return tf.random.uniform((batch,), low, high, seed=seed)
+
+
+def augment_batch(images, augmentation):
+    """
+    Apply ImageDataGenerator-style random transforms to a float32 batch in [0, 255].
+    With DEFAULT_AUGMENTATION this is the augmentation the ImageDataGenerator
+    pipeline used, applied per batch in tf.data instead of per image in Python.
+    Rotation, shifts, shear and zoom are combined into one affine transform per
+    image (bilinear sampling, nearest fill), followed by flip and brightness.
+    """
+    batch = tf.shape(images)[0]
+    height = tf.cast(tf.shape(images)[1], tf.float32)
+    width = tf.cast(tf.shape(images)[2], tf.float32)
+    deg = math.pi / 180.0
+
+    rotation = augmentation.get('rotation_range', 0)
+    theta = _uniform(batch, -rotation, rotation) * deg
+    dx = _uniform(batch, -1.0, 1.0) * augmentation.get('width_shift_range', 0) * width
+    dy = _uniform(batch, -1.0, 1.0) * augmentation.get('height_shift_range', 0) * height
+    shear_range = augmentation.get('shear_range', 0)
+    shear = _uniform(batch, -shear_range, shear_range) * deg
+    zoom = augmentation.get('zoom_range', 0)
+    zx = _uniform(batch, 1.0 - zoom, 1.0 + zoom)
+    zy = _uniform(batch, 1.0 - zoom, 1.0 + zoom)
+
+    # Output -> input mapping: rotate @ shift @ shear @ zoom about the image centre
+    cos, sin = tf.cos(theta), tf.sin(theta)
+    sh_sin, sh_cos = tf.sin(shear), tf.cos(shear)
+    a0 = cos * zx
+    a1 = (-cos * sh_sin - sin * sh_cos) * zy
+    b0 = sin * zx
+    b1 = (-sin * sh_sin + cos * sh_cos) * zy
+    cx = width / 2.0 - 0.5
+    cy = height / 2.0 - 0.5
+    a2 = cx - a0 * cx - a1 * cy + cos * dx - sin * dy
+    b2 = cy - b0 * cx - b1 * cy + sin * dx + cos * dy
+    zeros = tf.zeros_like(a0)
+    transforms = tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=tf.shape(images)[1:3],
+        fill_value=0.0,
+        interpolation='BILINEAR',
+        fill_mode='NEAREST'
+    )
+
+    if augmentation.get('horizontal_flip'):
+        flip = _uniform(batch, 0.0, 1.0) < 0.5
+        images = tf.where(flip[:, None, None, None], tf.reverse(images, axis=[2]), images)
+
+    brightness = augmentation.get('brightness_range')
+    if brightness:
+        factor = _uniform(batch, brightness[0], brightness[1])
+        images = tf.clip_by_value(images * factor[:, None, None, None], 0.0, 255.0)
+
+    return images
+
+
+def build_dataset(source_dir, batch_size=32, augmentation=None, shuffle=True, cache=None,
+                  shuffle_buffer=2048, seed=None, img_size=IMG_SIZE, version=CURRENT_VERSION):
+    """
+    Build a batched (images, one_hot_labels) dataset for a flow_from_directory-style
+    tree, with images scaled to [0, 1].
+
+    Pre-decoded shards from dataset_shards.py are used when they are current.
+    cache: None, 'memory' or a file path; caches decoded images before augmentation.
+    augmentation: dict of ImageDataGenerator-style parameters, e.g. DEFAULT_AUGMENTATION.
+    version: preprocessing version (see preprocessing.py); evaluate a saved model
+    with the version from its metadata.
+
+    Returns (dataset, class_indices, samples).
+    """
+    index = load_index(source_dir, version=version)
+    if index is not None:
+        print(f"Using pre-decoded shards for {source_dir} ({index['count']} images)")
+        class_indices = index['class_indices']
+        samples = index['count']
+        ds = _shard_dataset(source_dir, index, seed, shuffle)
+    else:
+        paths, labels, class_indices = list_labeled_images(source_dir)
+        samples = len(paths)
+        print(f"Found {samples} images belonging to {len(class_indices)} classes.")
+        ds = tf.data.Dataset.from_tensor_slices((paths, np.array(labels, dtype=np.int32)))
+        if shuffle:
+            # Shuffle file names up front so the shuffle buffer isn't one class at a time
+            ds = ds.shuffle(max(samples, 1), seed=seed, reshuffle_each_iteration=True)
+        ds = ds.map(lambda p, l: _decode_file(p, l, img_size, version), num_parallel_calls=AUTOTUNE,
+                    deterministic=not shuffle)
+        # Skip files that fail to decode, as flow_from_directory users expected
+        ds = ds.ignore_errors()
+
+    if cache == 'memory':
+        ds = ds.cache()
+    elif cache:
+        ds = ds.cache(cache)
+
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+
+    num_classes = len(class_indices)
+    ds = ds.batch(batch_size)
+
+    def prepare(images, labels):
+        images = tf.cast(images, tf.float32)
+        if augmentation:
+            images = augment_batch(images, augmentation)
+        # Multiply by the float32 reciprocal like preprocessing.load_into, not divide
+        return images * np.float32(1.0 / 255.0), tf.one_hot(labels, num_classes)
+
+    ds = ds.map(prepare, num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+    ds = ds.prefetch(AUTOTUNE)
+    return ds, class_indices, samples
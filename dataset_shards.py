@@ -0,0 +1,211 @@
+"""
+Pre-decoded dataset shards for training.
+Decodes every image once, resizes it to 224x224 and writes uint8 arrays plus
+labels into sharded .npy files with a JSON index. Training scripts read the
+shards through memory maps instead of decoding JPEGs every epoch.
+
+Usage: python dataset_shards.py [data_dir] [--out shards] [--subtypes]
+
+Shards for Stone_Data/train end up in shards/Stone_Data/train, shards for the
+marble subtype tree in shards/Stone_Data/train/marble, and so on.
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from preprocessing import load_uint8, IMG_SIZE, CURRENT_VERSION
+
+DEFAULT_SHARD_ROOT = 'shards'
+DEFAULT_SHARD_SIZE = 2048
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+
+def shard_dir_for(source_dir, shard_root=DEFAULT_SHARD_ROOT):
+    """
+    Where the shards for a source directory live, always inside shard_root.
+    Directories below the working directory keep their layout (Stone_Data/train
+    -> shards/Stone_Data/train); any other directory gets shards/_external/
+    <name>-<hash of its absolute path>.
+    """
+    source = os.path.abspath(source_dir)
+    try:
+        relative = os.path.relpath(source)
+    except ValueError:
+        # Another drive on Windows
+        relative = source
+    if relative != os.curdir and not os.path.isabs(relative) and relative.split(os.sep)[0] != os.pardir:
+        return os.path.join(shard_root, relative)
+    digest = hashlib.sha256(source.encode()).hexdigest()[:12]
+    return os.path.join(shard_root, '_external', f"{os.path.basename(source) or 'root'}-{digest}")
+
+
+def list_labeled_images(source_dir):
+    """
+    (paths, labels, class_indices) in flow_from_directory order: class folders
+    sorted by name, images found recursively inside each.
+    """
+    class_names = sorted(d for d in os.listdir(source_dir)
+                         if os.path.isdir(os.path.join(source_dir, d)))
+    class_indices = {name: i for i, name in enumerate(class_names)}
+    paths, labels = [], []
+    for name in class_names:
+        for p in sorted(Path(source_dir, name).rglob('*')):
+            if p.suffix.lower() in IMAGE_EXTENSIONS:
+                paths.append(str(p))
+                labels.append(class_indices[name])
+    return paths, labels, class_indices
+
+
+def source_fingerprint(source_dir, paths, labels):
+    """
+    sha256 over the sorted (relative path, label, size, mtime) of every image, so
+    replaced, relabelled or renamed files make the shards stale, not just a
+    changed image count.
+    """
+    entries = []
+    for path, label in zip(paths, labels):
+        st = os.stat(path)
+        entries.append((os.path.relpath(path, source_dir), int(label), st.st_size, st.st_mtime_ns))
+    return hashlib.sha256(json.dumps(sorted(entries)).encode()).hexdigest()
+
+
+def decode_image(path, img_size=IMG_SIZE, version=CURRENT_VERSION):
+    """Decode and resize one image to uint8, or None if it can't be read."""
+    try:
+        return load_uint8(path, img_size, version)
+    except Exception as e:
+        print(f"Skipping {path}: {e}")
+        return None
+
+
+def ingest(source_dir, shard_root=DEFAULT_SHARD_ROOT, shard_size=DEFAULT_SHARD_SIZE,
+           img_size=IMG_SIZE, workers=8, version=CURRENT_VERSION):
+    """Write shards and an index for one flow_from_directory-style tree."""
+    out_dir = shard_dir_for(source_dir, shard_root)
+    os.makedirs(out_dir, exist_ok=True)
+
+    paths, labels, class_indices = list_labeled_images(source_dir)
+    print(f"Ingesting {len(paths)} images from {source_dir} into {out_dir}")
+
+    shards = []
+    kept = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(paths), shard_size):
+            chunk_paths = paths[start:start + shard_size]
+            chunk_labels = labels[start:start + shard_size]
+            decoded = list(pool.map(lambda p: decode_image(p, img_size, version), chunk_paths))
+            ok = [i for i, arr in enumerate(decoded) if arr is not None]
+            if not ok:
+                continue
+
+            name = f'shard_{len(shards):05d}'
+            images = np.lib.format.open_memmap(
+                os.path.join(out_dir, name + '.npy'), mode='w+', dtype=np.uint8,
+                shape=(len(ok), img_size, img_size, 3)
+            )
+            for row, i in enumerate(ok):
+                images[row] = decoded[i]
+            images.flush()
+            del images
+            np.save(os.path.join(out_dir, name + '_labels.npy'),
+                    np.array([chunk_labels[i] for i in ok], dtype=np.int32))
+            shards.append({'name': name, 'count': len(ok)})
+            kept += len(ok)
+            print(f"  {name}: {len(ok)} images")
+
+    index = {
+        'source_dir': source_dir,
+        'source_count': len(paths),
+        'source_fingerprint': source_fingerprint(source_dir, paths, labels),
+        'img_size': img_size,
+        'preprocessing_version': version,
+        'class_indices': class_indices,
+        'shards': shards,
+        'count': kept,
+    }
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    print(f"Wrote {kept} images in {len(shards)} shards")
+    return index
+
+
+def load_index(source_dir, shard_root=DEFAULT_SHARD_ROOT, version=CURRENT_VERSION):
+    """
+    Return the shard index for source_dir, or None if there are no shards, they were
+    written with another preprocessing version, or the images on disk changed since
+    ingest (see source_fingerprint).
+    """
+    index_path = os.path.join(shard_dir_for(source_dir, shard_root), 'index.json')
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    if index.get('preprocessing_version', 1) != version:
+        print(f"Shards for {source_dir} use preprocessing version "
+              f"{index.get('preprocessing_version', 1)}, not {version}. Re-run dataset_shards.py.")
+        return None
+    paths, labels, _ = list_labeled_images(source_dir)
+    if source_fingerprint(source_dir, paths, labels) != index.get('source_fingerprint'):
+        print(f"Shards for {source_dir} are stale ({index['source_count']} images at ingest, "
+              f"{len(paths)} now, files added, removed or modified since). "
+              f"Re-run dataset_shards.py to refresh them.")
+        return None
+    return index
+
+
+def open_shards(source_dir, index, shard_root=DEFAULT_SHARD_ROOT):
+    """
+    Memory-map the shards described by index.
+    Returns (images, locations, classes): one uint8 memmap per shard, the
+    (shard, row) of every sample, and every sample's label.
+    """
+    out_dir = shard_dir_for(source_dir, shard_root)
+    images = [np.load(os.path.join(out_dir, s['name'] + '.npy'), mmap_mode='r')
+              for s in index['shards']]
+    if not index['shards']:
+        return images, np.zeros((0, 2), np.int64), np.zeros(0, np.int32)
+    classes = np.concatenate([np.load(os.path.join(out_dir, s['name'] + '_labels.npy'))
+                              for s in index['shards']])
+    locations = np.concatenate([
+        np.stack([np.full(s['count'], i), np.arange(s['count'])], axis=1)
+        for i, s in enumerate(index['shards'])
+    ])
+    return images, locations, classes
+
+
+def subtype_dirs(split_dir):
+    """Stone type folders under split_dir that have subtype subfolders."""
+    result = []
+    for stone_type in sorted(os.listdir(split_dir)):
+        stone_dir = os.path.join(split_dir, stone_type)
+        if os.path.isdir(stone_dir) and any(
+                os.path.isdir(os.path.join(stone_dir, d)) for d in os.listdir(stone_dir)):
+            result.append(stone_dir)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-decode the dataset into training shards.")
+    parser.add_argument('data_dir', nargs='?', default='Stone_Data')
+    parser.add_argument('--out', default=DEFAULT_SHARD_ROOT, help="Shard root directory")
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f"Images per shard (default: {DEFAULT_SHARD_SIZE})")
+    parser.add_argument('--workers', type=int, default=8, help="Decode threads (default: 8)")
+    parser.add_argument('--subtypes', action='store_true',
+                        help="Also write shards for every stone type's subtype tree")
+    args = parser.parse_args()
+
+    for split in ('train', 'val'):
+        split_dir = os.path.join(args.data_dir, split)
+        if not os.path.isdir(split_dir):
+            print(f"Skipping {split_dir} (not found)")
+            continue
+        ingest(split_dir, args.out, args.shard_size, workers=args.workers)
+        if args.subtypes:
+            for stone_dir in subtype_dirs(split_dir):
+                ingest(stone_dir, args.out, args.shard_size, workers=args.workers)
@@ -0,0 +1,413 @@
+"""
+Vector index over backbone embeddings for near-duplicate and leakage checks.
+Every image in Stone_Data/{train,val} gets its L2-normalized MobileNetV2
+embedding (the 1280-d features every classifier is built on) stored in a
+memory-mapped matrix, so cosine similarity is a dot product.
+
+Search is exact (blocked matrix products over the whole matrix) or approximate
+with an inverted file (IVF): vectors are grouped by their nearest k-means
+centroid, and a query only scans the lists of the few centroids closest to it.
+Both are plain NumPy.
+
+The index is updated incrementally: files whose size and mtime are unchanged
+keep their row, new or modified files are embedded through the feature cache,
+and rows for deleted files are dropped.
+
+Usage:
+  python embedding_index.py build [data_dir]
+  python embedding_index.py duplicates [--threshold 0.95]
+  python embedding_index.py leakage [--threshold 0.95]
+  python embedding_index.py check <new_images_dir> [--threshold 0.95]
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from feature_cache import FEATURE_DIM, FeatureCache, list_images, grow_memmap
+
+DEFAULT_INDEX_DIR = 'embedding_index'
+SPLITS = ('train', 'val')
+# Cosine similarity above which two images count as near-duplicates
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_NPROBE = 8
+# Rows scored per matrix product; bounds temporary memory to BLOCK x queries floats
+BLOCK = 16384
+# Retrain the IVF centroids once the index has grown this much since training
+RETRAIN_GROWTH = 2.0
+
+
+def normalize(vectors):
+    """Rows scaled to unit length (zero rows stay zero)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _merge_topk(best_scores, best_rows, scores, rows, k):
+    """Merge a block of candidate scores (m, n) for rows (n,) into running top-k."""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        cand_rows = rows[part]
+    else:
+        cand_rows = np.broadcast_to(rows, scores.shape)
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    all_rows = np.concatenate([best_rows, cand_rows], axis=1)
+    order = np.argsort(-all_scores, axis=1)[:, :k]
+    return np.take_along_axis(all_scores, order, axis=1), np.take_along_axis(all_rows, order, axis=1)
+
+
+class _UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        self.parent.setdefault(x, x)
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+    def groups(self):
+        groups = {}
+        for x in self.parent:
+            groups.setdefault(self.find(x), []).append(x)
+        return list(groups.values())
+
+
+class EmbeddingIndex:
+    """Normalized embeddings plus per-row path, split and label, with optional IVF."""
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR, initial_capacity=1024):
+        self.index_dir = index_dir
+        self.meta_path = os.path.join(index_dir, 'meta.json')
+        self.data_path = os.path.join(index_dir, 'vectors.npy')
+        self.ivf_path = os.path.join(index_dir, 'ivf.npz')
+        os.makedirs(index_dir, exist_ok=True)
+
+        if os.path.exists(self.meta_path) and os.path.exists(self.data_path):
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            self.settings_id = meta['settings_id']
+            self.rows = meta['rows']
+            self._vectors = np.load(self.data_path, mmap_mode='r+')
+        else:
+            self.settings_id = None
+            self.rows = []
+            self._vectors = np.lib.format.open_memmap(
+                self.data_path, mode='w+', dtype=np.float32, shape=(initial_capacity, FEATURE_DIM)
+            )
+
+        self.centroids = None
+        self.assignments = None
+        self.trained_count = 0
+        if os.path.exists(self.ivf_path):
+            ivf = np.load(self.ivf_path)
+            self.centroids = ivf['centroids']
+            self.assignments = ivf['assignments']
+            self.trained_count = int(ivf['trained_count'])
+        self._lists = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def vectors(self):
+        """(rows, FEATURE_DIM) memmap of normalized embeddings."""
+        return self._vectors[:len(self.rows)]
+
+    def column(self, name):
+        return np.array([row[name] for row in self.rows])
+
+    # -- building ---------------------------------------------------------
+
+    def flush(self):
+        self._vectors.flush()
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'settings_id': self.settings_id, 'count': len(self.rows), 'rows': self.rows}, f)
+        os.replace(tmp_path, self.meta_path)
+        if self.centroids is not None:
+            np.savez(self.ivf_path, centroids=self.centroids, assignments=self.assignments,
+                     trained_count=self.trained_count)
+
+    def _keep(self, keep):
+        """Drop every row whose index is not in keep (sorted), compacting in place."""
+        keep = np.asarray(keep, dtype=np.int64)
+        for new, old in enumerate(keep):
+            if new != old:
+                self._vectors[new] = self._vectors[old]
+        self.rows = [self.rows[i] for i in keep]
+        if self.assignments is not None:
+            self.assignments = self.assignments[keep]
+        self._lists = None
+
+    def _append(self, rows, vectors):
+        start = len(self.rows)
+        self._vectors = grow_memmap(self._vectors, self.data_path, start, start + len(rows))
+        self._vectors[start:start + len(rows)] = normalize(vectors)
+        self.rows.extend(rows)
+        if self.centroids is not None:
+            self.assignments = np.concatenate([self.assignments, self._assign(self._vectors[start:start + len(rows)])])
+        self._lists = None
+
+    def update(self, data_dir, cache, backbone, splits=SPLITS):
+        """
+        Bring the index in line with data_dir/<split>. Returns (added, removed).
+        Unchanged files (same size and mtime) are not re-read.
+        """
+        if self.settings_id not in (None, cache.settings_id):
+            print("Preprocessing settings changed, rebuilding the embedding index")
+            self._keep([])
+            self.centroids = self.assignments = None
+        self.settings_id = cache.settings_id
+
+        current = {}
+        for split in splits:
+            split_dir = os.path.join(data_dir, split)
+            if not os.path.isdir(split_dir):
+                continue
+            for path in list_images(split_dir):
+                stat = os.stat(path)
+                current[path] = {
+                    'path': path,
+                    'split': split,
+                    'label': os.path.relpath(os.path.dirname(path), split_dir).replace(os.sep, '/'),
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime_ns,
+                }
+
+        keep, seen = [], set()
+        for i, row in enumerate(self.rows):
+            now = current.get(row['path'])
+            if now is not None and now == row:
+                keep.append(i)
+                seen.add(row['path'])
+        removed = len(self.rows) - len(keep)
+        if removed:
+            self._keep(keep)
+
+        new_paths = [p for p in current if p not in seen]
+        added = 0
+        if new_paths:
+            features, paths, errors = cache.features_for(new_paths, backbone)
+            for path, error in errors:
+                print(f"Skipping {path}: {error}")
+            self._append([current[p] for p in paths], features)
+            added = len(paths)
+
+        if self.centroids is None or len(self.rows) > self.trained_count * RETRAIN_GROWTH:
+            self.train_ivf()
+        self.flush()
+        return added, removed
+
+    # -- IVF --------------------------------------------------------------
+
+    def _assign(self, vectors):
+        """Nearest centroid for each vector."""
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), BLOCK):
+            block = np.asarray(vectors[start:start + BLOCK])
+            out[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        return out
+
+    def train_ivf(self, nlist=None, iterations=10, sample_size=100000, seed=0):
+        """Spherical k-means on a sample of the index; every row is then assigned to a list."""
+        count = len(self.rows)
+        if count == 0:
+            self.centroids = self.assignments = None
+            return
+        nlist = nlist or max(1, min(4096, int(np.sqrt(count))))
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(count, size=min(count, sample_size), replace=False))
+        sample = np.asarray(self.vectors[sample_rows])
+        centroids = sample[rng.choice(len(sample), size=min(nlist, len(sample)), replace=False)].copy()
+
+        print(f"Training IVF with {len(centroids)} lists on {len(sample)} vectors...")
+        for _ in range(iterations):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, nearest, sample)
+            empty = np.bincount(nearest, minlength=len(centroids)) == 0
+            # Re-seed empty lists with random sample points
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = normalize(sums)
+
+        self.centroids = centroids
+        self.assignments = self._assign(self.vectors)
+        self.trained_count = count
+        self._lists = None
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind='stable')
+            bounds = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+        return self._lists
+
+    # -- search -----------------------------------------------------------
+
+    def _scan(self, queries, candidates, k, query_rows=None):
+        """Exact top-k of queries against candidate rows, BLOCK rows at a time."""
+        m = len(queries)
+        best_scores = np.full((m, 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((m, 0), dtype=np.int64)
+        for start in range(0, len(candidates), BLOCK):
+            rows = candidates[start:start + BLOCK]
+            scores = queries @ np.asarray(self._vectors[rows]).T
+            if query_rows is not None:
+                scores[query_rows[:, None] == rows[None, :]] = -np.inf
+            best_scores, best_rows = _merge_topk(best_scores, best_rows, scores, rows, k)
+        if best_scores.shape[1] < k:
+            pad = k - best_scores.shape[1]
+            best_scores = np.pad(best_scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+            best_rows = np.pad(best_rows, ((0, 0), (0, pad)), constant_values=-1)
+        best_rows[~np.isfinite(best_scores)] = -1
+        return best_scores, best_rows
+
+    def search(self, queries, k=10, allowed=None, exact=False, nprobe=DEFAULT_NPROBE, query_rows=None):
+        """
+        Top-k cosine neighbours for each query vector.
+        allowed: optional boolean mask over rows to search. query_rows: index rows
+        the queries came from, so an image never matches itself.
+        Returns (scores, rows), both (len(queries), k); rows are -1 past the last hit.
+        With IVF, queries are grouped by their nearest list and each group scans
+        the nprobe lists closest to that list's centroid.
+        """
+        queries = normalize(queries)
+        if query_rows is not None:
+            query_rows = np.asarray(query_rows, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(queries) == 0 or len(self.rows) == 0:
+            return scores, rows
+
+        if exact or self.centroids is None:
+            candidates = np.arange(len(self.rows)) if allowed is None else np.flatnonzero(allowed)
+            for start in range(0, len(queries), 1024):
+                q = slice(start, start + 1024)
+                scores[q], rows[q] = self._scan(queries[q], candidates, k,
+                                                None if query_rows is None else query_rows[q])
+            return scores, rows
+
+        lists = self._inverted_lists()
+        nprobe = min(nprobe, len(self.centroids))
+        nearest = np.argmax(queries @ self.centroids.T, axis=1)
+        for list_id in np.unique(nearest):
+            members = np.flatnonzero(nearest == list_id)
+            probes = np.argpartition(-(self.centroids @ self.centroids[list_id]), nprobe - 1)[:nprobe]
+            candidates = np.sort(np.concatenate([lists[p] for p in probes]))
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            scores[members], rows[members] = self._scan(
+                queries[members], candidates, k, None if query_rows is None else query_rows[members])
+        return scores, rows
+
+    def self_join(self, query_rows, allowed=None, threshold=DEFAULT_THRESHOLD, k=10, exact=False,
+                  nprobe=DEFAULT_NPROBE, batch=16384):
+        """Yield (query_row, row, score) for every neighbour of query_rows at or above threshold."""
+        for start in range(0, len(query_rows), batch):
+            q_rows = np.asarray(query_rows[start:start + batch])
+            scores, rows = self.search(np.asarray(self._vectors[q_rows]), k, allowed, exact, nprobe, q_rows)
+            for i, j in zip(*np.nonzero(scores >= threshold)):
+                yield int(q_rows[i]), int(rows[i, j]), float(scores[i, j])
+
+    def near_duplicates(self, threshold=DEFAULT_THRESHOLD, k=10, exact=False, nprobe=DEFAULT_NPROBE):
+        """Clusters (lists of rows, largest first) of images within threshold of each other."""
+        uf = _UnionFind()
+        for a, b, _ in self.self_join(np.arange(len(self.rows)), None, threshold, k, exact, nprobe):
+            uf.union(a, b)
+        return sorted((sorted(g) for g in uf.groups() if len(g) > 1), key=len, reverse=True)
+
+    def leakage(self, threshold=DEFAULT_THRESHOLD, query_split='val', target_split='train', k=5,
+                exact=False, nprobe=DEFAULT_NPROBE):
+        """(query_row, target_row, score) for query_split images with a near-duplicate in target_split."""
+        splits = self.column('split')
+        query_rows = np.flatnonzero(splits == query_split)
+        return list(self.self_join(query_rows, splits == target_split, threshold, k, exact, nprobe))
+
+
+def print_duplicates(index, clusters, limit=20):
+    print(f"\n{len(clusters)} near-duplicate clusters "
+          f"({sum(len(c) for c in clusters)} images)")
+    for cluster in clusters[:limit]:
+        labels = {index.rows[r]['label'] for r in cluster}
+        flag = "  <- different labels" if len(labels) > 1 else ""
+        print(f"\n  {len(cluster)} images{flag}")
+        for r in cluster:
+            row = index.rows[r]
+            print(f"    [{row['split']}/{row['label']}] {row['path']}")
+    if len(clusters) > limit:
+        print(f"\n  ... and {len(clusters) - limit} more clusters")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embedding index for near-duplicate and leakage checks.")
+    parser.add_argument('--index-dir', default=DEFAULT_INDEX_DIR)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Cosine similarity that counts as a near-duplicate (default: {DEFAULT_THRESHOLD})")
+    parser.add_argument('--exact', action='store_true', help="Scan every row instead of using the IVF lists")
+    parser.add_argument('--nprobe', type=int, default=DEFAULT_NPROBE,
+                        help=f"IVF lists scanned per query (default: {DEFAULT_NPROBE})")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="Create or incrementally update the index")
+    build.add_argument('data_dir', nargs='?', default='Stone_Data')
+    build.add_argument('--retrain', action='store_true', help="Retrain the IVF centroids")
+    commands.add_parser('duplicates', help="Clusters of near-duplicate images across the dataset")
+    commands.add_parser('leakage', help="Validation images with a near-duplicate in train")
+    check = commands.add_parser('check', help="Which new images the dataset already has")
+    check.add_argument('directory')
+    check.add_argument('--k', type=int, default=3, help="Neighbours shown per image (default: 3)")
+    args = parser.parse_args()
+
+    index = EmbeddingIndex(args.index_dir)
+
+    if args.command in ('build', 'check'):
+        from feature_cache import build_backbone
+        cache = FeatureCache()
+        backbone = build_backbone()
+
+    if args.command == 'build':
+        added, removed = index.update(args.data_dir, cache, backbone)
+        if args.retrain:
+            index.train_ivf()
+            index.flush()
+        print(f"Index has {len(index)} images ({added} added, {removed} removed)")
+
+    elif len(index) == 0:
+        parser.error(f"{args.index_dir} is empty, run 'build' first")
+
+    elif args.command == 'duplicates':
+        print_duplicates(index, index.near_duplicates(args.threshold, exact=args.exact, nprobe=args.nprobe))
+
+    elif args.command == 'leakage':
+        pairs = index.leakage(args.threshold, exact=args.exact, nprobe=args.nprobe)
+        print(f"\n{len({q for q, _, _ in pairs})} validation images have a near-duplicate in train")
+        for q, t, score in sorted(pairs, key=lambda p: -p[2]):
+            qrow, trow = index.rows[q], index.rows[t]
+            flag = "  <- different labels" if qrow['label'] != trow['label'] else ""
+            print(f"  {score:.3f}  {qrow['path']}\n         {trow['path']}{flag}")
+
+    elif args.command == 'check':
+        paths = list_images(args.directory)
+        features, paths, errors = cache.features_for(paths, backbone)
+        for path, error in errors:
+            print(f"Skipping {path}: {error}")
+        scores, rows = index.search(features, args.k, exact=args.exact, nprobe=args.nprobe)
+        have = 0
+        for path, s, r in zip(paths, scores, rows):
+            duplicate = s[0] >= args.threshold
+            have += duplicate
+            print(f"\n{'ALREADY HAVE' if duplicate else 'new':12s} {path}")
+            for score, row in zip(s, r):
+                if row >= 0:
+                    match = index.rows[row]
+                    print(f"    {score:.3f}  [{match['split']}/{match['label']}] {match['path']}")
+        print(f"\n{have} of {len(paths)} images are near-duplicates of images already in the dataset")
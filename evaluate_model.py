@@ -1,15 +1,57 @@
-import tensorflow as tf
-from tensorflow import keras
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 import numpy as np
+import argparse
 import json
 import os
-from sklearn.metrics import classification_report, confusion_matrix
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+from streaming_metrics import StreamingEvaluator
+from preprocessing import model_version
+
+parser = argparse.ArgumentParser(description="Evaluate the stone classifier on the validation set.")
+parser.add_argument('--model', default='stone_classifier_model.h5')
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--top-k', type=int, default=3, help="Also report top-k accuracy (default: 3)")
+parser.add_argument('--report-every', type=int, default=50,
+                    help="Print running metrics every N batches (default: 50, 0 to disable)")
+parser.add_argument('--spill', default=None,
+                    help="Write every probability row to this .npy file (memory-mapped); "
+                         "the filled row count is in <file>_meta.json")
+parser.add_argument('--plot', default='confusion_matrix.png',
+                    help="Confusion matrix figure (default: confusion_matrix.png)")
+parser.add_argument('--no-plot', action='store_true',
+                    help="Text metrics only; skips loading matplotlib and seaborn")
+args = parser.parse_args()
+
+# Setup data pipeline (not shuffled, labels come with each batch)
+data_dir = "Stone_Data"
+val_dir = os.path.join(data_dir, 'val')
+
+for path in (args.model, 'class_indices.json', val_dir):
+    if not os.path.exists(path):
+        parser.error(f"{path} not found")
+
+def plot_confusion_matrix(cm, class_names, path):
+    """Save the confusion matrix as a heatmap. Plotting libraries load only here."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    plt.figure(figsize=(10, 8))
+    sns.heatmap(cm, annot=True, fmt='d', cmap='Blues',
+                xticklabels=class_names, yticklabels=class_names)
+    plt.title('Confusion Matrix')
+    plt.ylabel('True Label')
+    plt.xlabel('Predicted Label')
+    plt.tight_layout()
+    plt.savefig(path, dpi=150)
+    plt.close()
+
+# TensorFlow is only imported once the arguments check out
+from tensorflow import keras
+from data_pipeline import build_dataset
 
 # Load model and class indices
-model = keras.models.load_model('stone_classifier_model.h5')
+model = keras.models.load_model(args.model)
 with open('class_indices.json', 'r') as f:
     class_indices = json.load(f)
 
@@ -17,62 +59,60 @@ with open('class_indices.json', 'r') as f:
 idx_to_class = {v: k for k, v in class_indices.items()}
 class_names = [idx_to_class[i] for i in range(len(class_indices))]
 
-# Setup data generators
-data_dir = "Stone_Data"
-val_dir = os.path.join(data_dir, 'val')
-
-val_datagen = ImageDataGenerator(rescale=1./255)
-
-val_generator = val_datagen.flow_from_directory(
+# Same preprocessing the model was trained with (from its metadata)
+val_ds, val_class_indices, val_samples = build_dataset(
     val_dir,
-    target_size=(224, 224),
-    batch_size=32,
-    class_mode='categorical',
-    shuffle=False  # Important: don't shuffle for evaluation
+    batch_size=args.batch_size,
+    shuffle=False,
+    version=model_version(args.model)
 )
+if val_class_indices != class_indices:
+    print(f"WARNING: validation classes {val_class_indices} don't match the model's {class_indices}")
 
-# Get true labels and predictions
+evaluator = StreamingEvaluator(class_names, top_k=args.top_k,
+                               spill_path=args.spill, spill_rows=val_samples)
+
+# Stream predictions batch by batch; only the running counts are kept in memory
 print("Evaluating model on validation set...")
-y_true = val_generator.classes
-y_pred_proba = model.predict(val_generator, verbose=1)
-y_pred = np.argmax(y_pred_proba, axis=1)
+for batch_num, (images, labels) in enumerate(val_ds, start=1):
+    y_proba = model.predict_on_batch(images)
+    evaluator.update(np.argmax(labels, axis=1), y_proba)
+    if args.report_every and batch_num % args.report_every == 0:
+        print(f"  [{batch_num} batches] {evaluator.progress_line()}")
+evaluator.flush()
 
 # Overall accuracy
-accuracy = np.mean(y_true == y_pred)
+accuracy = evaluator.accuracy()
 print(f"\n{'='*60}")
 print(f"Overall Validation Accuracy: {accuracy:.4f} ({accuracy*100:.2f}%)")
+for k in range(2, evaluator.top_k + 1):
+    print(f"Top-{k} Accuracy: {evaluator.topk_accuracy(k):.4f}")
 print(f"{'='*60}\n")
 
 # Classification report
 print("Classification Report:")
-print(classification_report(y_true, y_pred, target_names=class_names))
+print(evaluator.classification_report())
 
 # Confusion matrix
-cm = confusion_matrix(y_true, y_pred)
+cm = evaluator.confusion
 print("\nConfusion Matrix:")
 print(cm)
 
 # Visualize confusion matrix
-plt.figure(figsize=(10, 8))
-sns.heatmap(cm, annot=True, fmt='d', cmap='Blues', 
-            xticklabels=class_names, yticklabels=class_names)
-plt.title('Confusion Matrix')
-plt.ylabel('True Label')
-plt.xlabel('Predicted Label')
-plt.tight_layout()
-plt.savefig('confusion_matrix.png', dpi=150)
-print("\nConfusion matrix saved to 'confusion_matrix.png'")
+if not args.no_plot:
+    plot_confusion_matrix(cm, class_names, args.plot)
+    print(f"\nConfusion matrix saved to '{args.plot}'")
 
 # Per-class accuracy
 print("\n" + "="*60)
 print("Per-Class Accuracy:")
 print("="*60)
+support = evaluator.support()
+per_class = evaluator.per_class_accuracy()
 for i, class_name in enumerate(class_names):
-    class_mask = y_true == i
-    if np.sum(class_mask) > 0:
-        class_acc = np.mean(y_pred[class_mask] == i)
-        count = np.sum(class_mask)
-        print(f"{class_name:15s}: {class_acc:.4f} ({class_acc*100:.2f}%) - {count} samples")
+    if support[i] > 0:
+        class_acc = per_class[i]
+        print(f"{class_name:15s}: {class_acc:.4f} ({class_acc*100:.2f}%) - {support[i]} samples")
     else:
         print(f"{class_name:15s}: No samples")
 
@@ -80,24 +120,19 @@ for i, class_name in enumerate(class_names):
 print("\n" + "="*60)
 print("Validation Set Distribution:")
 print("="*60)
-unique, counts = np.unique(y_true, return_counts=True)
-for idx, count in zip(unique, counts):
-    print(f"{class_names[idx]:15s}: {count:4d} samples ({count/len(y_true)*100:.1f}%)")
+for idx, count in enumerate(support):
+    if count > 0:
+        print(f"{class_names[idx]:15s}: {count:4d} samples ({count/evaluator.count*100:.1f}%)")
 
 # Check for misclassifications
 print("\n" + "="*60)
 print("Most Common Misclassifications:")
 print("="*60)
-misclassifications = {}
-for true_idx, pred_idx in zip(y_true, y_pred):
-    if true_idx != pred_idx:
-        key = (class_names[true_idx], class_names[pred_idx])
-        misclassifications[key] = misclassifications.get(key, 0) + 1
-
-# Sort by frequency
-sorted_mis = sorted(misclassifications.items(), key=lambda x: x[1], reverse=True)
-for (true_class, pred_class), count in sorted_mis[:10]:
+for (true_class, pred_class), count in evaluator.misclassifications(10):
     print(f"{true_class:15s} -> {pred_class:15s}: {count:3d} times")
 
-print("\nEvaluation complete!")
+if args.spill:
+    print(f"\nProbabilities written to {args.spill} ({min(evaluator.count, val_samples)} of "
+          f"{val_samples} rows filled, see {evaluator.spill_meta_path})")
 
+print("\nEvaluation complete!")
@@ -1,164 +1,696 @@
 """
 Helper script to evaluate new images before adding them to the dataset.
 This helps you identify which images from your website would be most valuable.
+
+The directory is walked lazily and results are summarized as they arrive
+(--output also streams every result to a .jsonl or .csv file), so memory stays
+flat however many images there are.
+
+Large dumps can be split with --shard i/N (one slice per process or host) and
+--processes P (worker processes on this host). Each worker writes a part file;
+--merge combines them into the usual summary.
+
+Long runs can be resumed: with --resume, images already in the --output file
+(or in the part files) are skipped and new results are appended. --time-budget
+and SIGTERM stop the run cleanly after the current chunk; it exits with status
+75 so a scheduler knows to run it again with --resume.
+
+--rank BUDGET picks BUDGET images worth labeling: the most uncertain results
+(margin/entropy) are pooled as they stream past, then chosen for being far from
+the training set and from each other (see active_learning.py).
 """
-import tensorflow as tf
-from tensorflow import keras
-from tensorflow.keras.preprocessing.image import load_img, img_to_array
 import numpy as np
+import glob
+import hashlib
 import json
+import multiprocessing
 import os
+import signal
 import sys
-from pathlib import Path
+import threading
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from preprocessing import load_image, model_version
+from batch_inference import predict_in_batches, DEFAULT_BATCH_SIZE, DEFAULT_WORKERS
+from tflite_backend import load_classifier, full_model_path, BACKENDS
+from feature_cache import file_hash
+from prediction_cache import PredictionCache
+from result_stream import ResultWriter, TopK, read_jsonl, read_results, repair_tail
+import instrumentation
+from instrumentation import metrics
+import active_learning
+from embedding_index import DEFAULT_INDEX_DIR
+
+MODEL_FILE = 'stone_classifier_model.h5'
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'}
+DEFAULT_PARTS_DIR = 'eval_parts'
+# Paths are read from the directory walk this many batches at a time
+CHUNK_BATCHES = 16
+PROGRESS_EVERY = 1000
+MAX_ERRORS_SHOWN = 20
+# Exit status when a run stops early (time budget or SIGTERM); rerun with --resume
+EXIT_INCOMPLETE = 75
+SELECTION_FIELDS = ['image', 'predicted_class', 'confidence', 'uncertainty', 'novelty', 'score']
+
+# Loaded on first use by get_model(), so --help, argument errors and cache hits
+# never import TensorFlow. set_backend() picks the backend beforehand.
+model = None
+backend_settings = {'backend': 'keras', 'num_threads': None}
+
+# Preprocessing version the model was trained with
+PREPROCESSING_VERSION = model_version(MODEL_FILE)
+
+# Set by enable_cache(); stores probability vectors keyed by image hash
+prediction_cache = None
 
-# Load model and class indices
-model = keras.models.load_model('stone_classifier_model.h5')
+# Set on SIGTERM/SIGINT (see install_stop_handlers); runs stop between chunks.
+# Worker processes get a shared multiprocessing.Event instead.
+stop_event = threading.Event()
+
+# Load class indices
 with open('class_indices.json', 'r') as f:
     class_indices = json.load(f)
 
 idx_to_class = {v: k for k, v in class_indices.items()}
 class_names = [idx_to_class[i] for i in range(len(class_indices))]
 
+def load_model(backend='keras', num_threads=None):
+    """Load the classifier with the Keras or TFLite backend."""
+    global model
+    if backend == 'keras' and num_threads:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    with metrics.timer('model_load'):
+        model = load_classifier(MODEL_FILE, backend, num_threads)
+    return model
+
+def set_backend(backend='keras', num_threads=None):
+    """Backend get_model() loads with."""
+    backend_settings.update(backend=backend, num_threads=num_threads)
+
+def get_model():
+    """The classifier, loaded on first call."""
+    if model is None:
+        load_model(**backend_settings)
+    return model
+
+def enable_cache(db_path=None, backend='keras'):
+    """Cache predictions by image content; invalidated when the model file changes."""
+    global prediction_cache
+    model_path = full_model_path(MODEL_FILE) if backend == 'tflite' else MODEL_FILE
+    prediction_cache = PredictionCache([model_path, 'class_indices.json'], db_path=db_path)
+    return prediction_cache
+
 def predict_image(image_path, target_class=None):
     """Predict a single image and return results."""
+    classifier = get_model()
     try:
         # Load and preprocess image
-        img = load_img(image_path, target_size=(224, 224))
-        img_array = img_to_array(img) / 255.0
-        img_array = np.expand_dims(img_array, axis=0)
+        img_array = np.expand_dims(load_image(image_path, version=PREPROCESSING_VERSION), axis=0)
         
         # Predict
-        predictions = model.predict(img_array, verbose=0)[0]
-        predicted_idx = np.argmax(predictions)
-        predicted_class = class_names[predicted_idx]
-        confidence = predictions[predicted_idx]
-        
-        # Get top 3 predictions
-        top3_indices = np.argsort(predictions)[-3:][::-1]
-        top3 = [(class_names[i], predictions[i]) for i in top3_indices]
-        
-        result = {
-            'image': image_path,
-            'predicted_class': predicted_class,
-            'confidence': float(confidence),
-            'top3': top3,
-            'is_correct': predicted_class == target_class if target_class else None
-        }
-        
-        return result
+        with metrics.timer('main_predict'):
+            predictions = classifier.predict(img_array, verbose=0)[0]
+        return build_result(image_path, predictions, target_class)
     except Exception as e:
+        metrics.inc('errors_total')
         return {'error': str(e), 'image': image_path}
 
-def evaluate_directory(directory, target_class=None):
-    """Evaluate all images in a directory."""
-    image_extensions = {'.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'}
-    image_paths = [str(p) for p in Path(directory).rglob('*') if p.suffix in image_extensions]
+def build_result(image_path, predictions, target_class=None):
+    """Turn a probability vector into a result dict."""
+    with metrics.timer('postprocess'):
+        result = _build_result(image_path, predictions, target_class)
+    metrics.record_prediction(result['confidence'])
+    return result
+
+def _build_result(image_path, predictions, target_class=None):
+    predicted_idx = np.argmax(predictions)
+    predicted_class = class_names[predicted_idx]
+    confidence = predictions[predicted_idx]
     
-    if not image_paths:
-        print(f"No images found in {directory}")
-        return []
+    # Get top 3 predictions
+    top3_indices = np.argsort(predictions)[-3:][::-1]
+    top3 = [(class_names[i], float(predictions[i])) for i in top3_indices]
+
+    # Uncertainty measures for --rank
+    runner_up = predictions[top3_indices[1]] if len(top3_indices) > 1 else 0.0
+    probs = np.clip(np.asarray(predictions, dtype=np.float64), 1e-12, 1.0)
     
-    print(f"\nEvaluating {len(image_paths)} images...")
+    return {
+        'image': image_path,
+        'predicted_class': predicted_class,
+        'confidence': float(confidence),
+        'top3': top3,
+        'is_correct': predicted_class == target_class if target_class else None,
+        'margin': float(confidence - runner_up),
+        'entropy': float(-np.sum(probs * np.log(probs)))
+    }
+
+def predict_images(image_paths, target_class=None, batch_size=DEFAULT_BATCH_SIZE,
+                   workers=DEFAULT_WORKERS):
+    """Predict many images in batches. Results are in the same order as image_paths."""
+    image_paths = list(image_paths)
+    results = [None] * len(image_paths)
+    to_predict = list(range(len(image_paths)))
+    hashes = {}
+
+    if prediction_cache is not None:
+        to_predict = []
+        for i, image_path in enumerate(image_paths):
+            try:
+                # Streamed; the same key testScript.py uses
+                hashes[i] = file_hash(image_path)
+            except OSError as e:
+                metrics.inc('errors_total')
+                results[i] = {'error': str(e), 'image': image_path}
+                continue
+            cached = prediction_cache.get(hashes[i])
+            if cached is not None:
+                results[i] = build_result(image_path, np.asarray(cached), target_class)
+            else:
+                to_predict.append(i)
+
+    if not to_predict:
+        return results
+
+    predictions_iter = predict_in_batches(get_model(), [image_paths[i] for i in to_predict], batch_size, workers,
+                                          version=PREPROCESSING_VERSION)
+    for i, (image_path, predictions, error) in zip(to_predict, predictions_iter):
+        if error is not None:
+            metrics.inc('errors_total')
+            results[i] = {'error': error, 'image': image_path}
+            continue
+        if prediction_cache is not None:
+            prediction_cache.put(hashes[i], [float(p) for p in predictions])
+        results[i] = build_result(image_path, predictions, target_class)
+    return results
+
+def shard_of(image_path, directory, num_shards):
+    """Shard an image belongs to. Depends only on its path relative to directory,
+    so every host computes the same split."""
+    rel = os.path.relpath(image_path, directory).replace(os.sep, '/')
+    return int(hashlib.sha1(rel.encode()).hexdigest()[:8], 16) % num_shards
+
+def iter_images(directory, shard=None):
+    """
+    Yield image paths under directory lazily, in a stable order (directories and
+    files sorted per level). With shard=(i, N) only the i-th of N shards.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1] not in IMAGE_EXTENSIONS:
+                continue
+            image_path = os.path.join(root, name)
+            if shard is None or shard_of(image_path, directory, shard[1]) == shard[0]:
+                yield image_path
+
+def iter_results(image_paths, target_class=None, batch_size=DEFAULT_BATCH_SIZE,
+                 workers=DEFAULT_WORKERS, deadline=None):
+    """
+    Yield results for an iterable of paths, CHUNK_BATCHES batches at a time.
+    Stops before the next chunk once stop_reason(deadline) is set.
+    """
+    image_paths = iter(image_paths)
+    while stop_reason(deadline) is None:
+        chunk = list(islice(image_paths, batch_size * CHUNK_BATCHES))
+        if not chunk:
+            return
+        yield from predict_images(chunk, target_class, batch_size, workers)
+
+def evaluate_directory(directory, target_class=None, batch_size=DEFAULT_BATCH_SIZE,
+                       workers=DEFAULT_WORKERS, output=None, shard=None, resume=False,
+                       deadline=None, pool=None):
+    """
+    Evaluate all images in a directory, streaming.
+    Results are summarized as they arrive and, with output (.jsonl or .csv),
+    written to that file. With resume, images already in output are skipped and
+    counted from the file, and new results are appended. A CandidatePool (pool)
+    also sees every result.
+    Returns the ResultSummary; summary.stopped says why a run ended early.
+    """
+    print(f"\nEvaluating images in {directory}...")
     if target_class:
         print(f"Target class: {target_class}")
-    
-    results = []
-    for img_path in image_paths:
-        result = predict_image(img_path, target_class)
-        results.append(result)
-    
-    return results
 
-def print_results(results, target_class=None):
-    """Print evaluation results in a helpful format."""
-    if not results:
-        return
-    
-    print("\n" + "="*70)
-    print("EVALUATION RESULTS")
-    print("="*70)
-    
-    # Group by prediction
-    by_prediction = {}
-    correct = []
-    incorrect = []
-    low_confidence = []
-    
-    for r in results:
-        if 'error' in r:
-            print(f"\nERROR with {r['image']}: {r['error']}")
+    summary = ResultSummary(target_class, pool)
+    done = set()
+    if resume and output:
+        done = load_checkpoint(output, summary)
+        if done:
+            print(f"Resuming: {len(done)} images already in {output}")
+    image_paths = (p for p in iter_images(directory, shard) if os.path.normpath(p) not in done)
+
+    writer = ResultWriter(output, append=bool(done)) if output else None
+    try:
+        for result in iter_results(image_paths, target_class, batch_size, workers, deadline):
+            summary.add(result)
+            if writer is not None:
+                writer.write(result)
+            if summary.total % PROGRESS_EVERY == 0:
+                print(f"  {summary.total} images evaluated")
+    finally:
+        if writer is not None:
+            writer.close()
+
+    # Paths left over mean the run was cut short
+    if next(image_paths, None) is not None:
+        summary.stopped = stop_reason(deadline)
+    if not summary.total:
+        print(f"No images found in {directory}")
+    return summary
+
+def parse_duration(value):
+    """'3600', '90s', '45m' or '2h' -> seconds."""
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    try:
+        if value[-1:].lower() in units:
+            return float(value[:-1]) * units[value[-1].lower()]
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected seconds or a number with s/m/h, got '{value}'")
+
+def install_stop_handlers(event):
+    """
+    First SIGTERM/SIGINT sets event so the run stops after the current chunk and
+    keeps its results; a second one exits immediately.
+    """
+    def handler(signum, frame):
+        if event.is_set():
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+            return
+        print(f"\n{signal.Signals(signum).name} received, stopping after the current chunk "
+              f"(send again to exit now)")
+        event.set()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, handler)
+
+def stop_reason(deadline=None):
+    """Why the run should stop now, or None."""
+    if stop_event.is_set():
+        return 'signal'
+    if deadline is not None and time.time() >= deadline:
+        return 'time budget'
+    return None
+
+def load_checkpoint(output, summary=None):
+    """
+    Images already in a results file from an earlier run, which is also the
+    checkpoint journal. Existing results are added to summary.
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    dropped = repair_tail(output)
+    if dropped:
+        print(f"Dropped an incomplete last row ({dropped} bytes) from {output}")
+    for record in read_results(output):
+        if 'part' in record:
             continue
-        
-        pred = r['predicted_class']
-        if pred not in by_prediction:
-            by_prediction[pred] = []
-        by_prediction[pred].append(r)
-        
-        if target_class:
+        done.add(os.path.normpath(record['image']))
+        if summary is not None:
+            summary.add(record)
+    return done
+
+def parse_shard(value):
+    """'i/N' -> (i, N)."""
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got '{value}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..N-1, got '{value}'")
+    return index, count
+
+def part_path(parts_dir, shard, worker):
+    index, count = shard
+    return os.path.join(parts_dir, f'part-{index:04d}-of-{count:04d}-{worker:03d}.jsonl')
+
+def shard_parts(parts_dir, shard):
+    """Existing part files for a shard, from any number of workers."""
+    return sorted(glob.glob(part_path(parts_dir, shard, 0).replace('-000.jsonl', '-*.jsonl')))
+
+def _init_worker(event, collect_metrics):
+    """Worker processes share the parent's stop event and handle signals themselves."""
+    global stop_event
+    stop_event = event
+    install_stop_handlers(event)
+    if collect_metrics:
+        instrumentation.enable()
+
+def _evaluate_part_in_worker(task):
+    """_evaluate_part in a pool process, plus the metrics it recorded (None if disabled)."""
+    metrics.reset()
+    result = _evaluate_part(task)
+    return result + (metrics.snapshot() if metrics.enabled else None,)
+
+def _evaluate_part(task):
+    """
+    Worker: evaluate this worker's slice of the shard and stream it to a part file.
+    The first line of a part file describes the run; every other line is a result.
+    """
+    directory, shard, worker, processes, out_path, part, options = task
+    set_backend(options['backend'], options['threads'])
+    if options['cache']:
+        enable_cache(options['cache'], options['backend'])
+
+    # Images finished by an earlier run of this shard, read by evaluate_sharded
+    # before any worker started appending to the part files
+    done = options['done']
+
+    # Worker w of P takes sub-shard (i + N*w) of N*P, which lies entirely inside shard i of N
+    index, count = shard
+    image_paths = (p for p in iter_images(directory, (index + count * worker, count * processes))
+                   if os.path.normpath(p) not in done)
+    append = os.path.exists(out_path) and options['resume']
+    written = 0
+    with ResultWriter(out_path, append=append) as writer:
+        if not append:
+            writer.write({'part': part})
+        for result in iter_results(image_paths, part['target_class'], options['batch_size'],
+                                   options['workers'], options['deadline']):
+            writer.write(result)
+            written += 1
+    stopped = stop_reason(options['deadline']) if next(image_paths, None) is not None else None
+    return out_path, written, stopped
+
+def evaluate_sharded(directory, target_class=None, shard=(0, 1), processes=1,
+                     parts_dir=DEFAULT_PARTS_DIR, batch_size=DEFAULT_BATCH_SIZE,
+                     workers=DEFAULT_WORKERS, backend='keras', threads=None, cache=None,
+                     resume=False, deadline=None):
+    """
+    Evaluate one shard of directory with `processes` worker processes.
+    Each worker loads its own model (threads bounds its inference threads) and
+    writes part-<shard>-of-<N>-<worker>.jsonl to parts_dir. With resume, images
+    already in this shard's part files are skipped.
+    Returns (part files, why the run stopped early or None).
+    """
+    print(f"\nShard {shard[0]}/{shard[1]} of {directory}, {processes} processes")
+
+    os.makedirs(parts_dir, exist_ok=True)
+    if not resume:
+        # Parts left over from an earlier run of this shard would be merged twice
+        for stale in shard_parts(parts_dir, shard):
+            os.remove(stale)
+
+    # Images finished by an earlier run of this shard, whatever its worker count.
+    # Read (and torn last rows repaired) here, never while workers are appending.
+    finished = set()
+    if resume:
+        for path in shard_parts(parts_dir, shard):
+            finished |= load_checkpoint(path)
+
+    part = {'directory': os.path.abspath(directory), 'target_class': target_class, 'shard': list(shard)}
+    options = {'backend': backend, 'threads': threads, 'cache': cache,
+               'batch_size': batch_size, 'workers': workers, 'resume': resume,
+               'deadline': deadline, 'done': finished}
+    tasks = [(directory, shard, w, processes, part_path(parts_dir, shard, w), part, options)
+             for w in range(processes)]
+
+    if len(tasks) == 1:
+        done = [_evaluate_part(tasks[0])]
+    else:
+        # spawn, not fork: TensorFlow's thread pools don't survive a fork
+        context = multiprocessing.get_context('spawn')
+        event = context.Event()
+        # SIGTERM to this process is passed on to the workers through the shared event
+        install_stop_handlers(event)
+        with ProcessPoolExecutor(max_workers=len(tasks), mp_context=context,
+                                 initializer=_init_worker, initargs=(event, metrics.enabled)) as pool:
+            done = []
+            for *outcome, worker_metrics in pool.map(_evaluate_part_in_worker, tasks):
+                # Stage timings and counters from the workers go into this process's --metrics
+                if worker_metrics is not None:
+                    metrics.merge(worker_metrics)
+                done.append(tuple(outcome))
+    for out_path, count, _ in done:
+        print(f"  {count} new results -> {out_path}")
+    stopped = next((reason for _, _, reason in done if reason), None)
+    return shard_parts(parts_dir, shard), stopped
+
+def find_parts(parts_dir):
+    return sorted(glob.glob(os.path.join(parts_dir, 'part-*.jsonl')))
+
+def merge_parts(part_files, output=None, pool=None):
+    """
+    Stream part files into one summary (and, with output, one combined results file).
+    Results are also fed to pool, if given.
+    Returns (ResultSummary, missing shards as 'i/N').
+    """
+    summary = None
+    shards_seen = {}
+    writer = ResultWriter(output) if output else None
+    try:
+        for path in part_files:
+            for record in read_jsonl(path):
+                if 'part' in record:
+                    part = record['part']
+                    if summary is None:
+                        summary = ResultSummary(part['target_class'], pool)
+                    index, count = part['shard']
+                    shards_seen.setdefault(count, set()).add(index)
+                    continue
+                summary.add(record)
+                if writer is not None:
+                    writer.write(record)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if len(shards_seen) > 1:
+        print(f"WARNING: part files from runs with different shard counts: {sorted(shards_seen)}")
+    missing = []
+    for count, seen in shards_seen.items():
+        missing.extend(f"{i}/{count}" for i in range(count) if i not in seen)
+    return summary or ResultSummary(pool=pool), missing
+
+class ResultSummary:
+    """
+    Running aggregates behind print_results: counts per predicted class and
+    bounded heaps for the example lists, so memory doesn't grow with the
+    number of images. Results are passed on to pool (an active_learning.CandidatePool)
+    when one is given.
+    """
+
+    def __init__(self, target_class=None, pool=None):
+        self.target_class = target_class
+        self.pool = pool
+        self.total = 0
+        self.correct = 0
+        self.incorrect = 0
+        self.low_confidence = 0
+        self.errors = []
+        self.error_count = 0
+        # predicted class -> [count, confidence sum]
+        self.by_prediction = {}
+        self.top_correct = TopK(5)
+        self.top_incorrect = TopK(5)
+        self.lowest_confidence = TopK(5)
+        self.best = TopK(10)
+        # Why the run ended before every image was evaluated (None if it finished)
+        self.stopped = None
+
+    def add(self, r):
+        self.total += 1
+        if self.pool is not None:
+            self.pool.add(r)
+        if 'error' in r:
+            self.error_count += 1
+            if len(self.errors) < MAX_ERRORS_SHOWN:
+                self.errors.append(r)
+            return
+
+        # Ties keep the earlier image first, as a stable sort would
+        seq = -self.total
+        item = {'image': r['image'], 'predicted_class': r['predicted_class'],
+                'confidence': r['confidence']}
+        stats = self.by_prediction.setdefault(r['predicted_class'], [0, 0.0])
+        stats[0] += 1
+        stats[1] += r['confidence']
+
+        if self.target_class:
             if r['is_correct']:
-                correct.append(r)
+                self.correct += 1
+                self.top_correct.push((r['confidence'], seq), item)
+                if r['confidence'] > 0.8:
+                    self.best.push((r['confidence'], seq), item)
             else:
-                incorrect.append(r)
-        
+                self.incorrect += 1
+                self.top_incorrect.push((r['confidence'], seq), item)
+        else:
+            self.best.push((r['confidence'], seq), item)
+
         if r['confidence'] < 0.7:
-            low_confidence.append(r)
-    
-    # Summary
-    print(f"\nTotal images evaluated: {len(results)}")
-    if target_class:
-        print(f"Correctly predicted as {target_class}: {len(correct)} ({len(correct)/len(results)*100:.1f}%)")
-        print(f"Incorrectly predicted: {len(incorrect)} ({len(incorrect)/len(results)*100:.1f}%)")
-    
-    print(f"\nLow confidence predictions (<0.7): {len(low_confidence)}")
-    
-    # Breakdown by predicted class
-    print("\nPredicted as:")
-    for pred_class, pred_results in sorted(by_prediction.items(), key=lambda x: len(x[1]), reverse=True):
-        avg_conf = np.mean([r['confidence'] for r in pred_results])
-        print(f"  {pred_class:15s}: {len(pred_results):3d} images (avg confidence: {avg_conf:.3f})")
-    
-    # Recommendations
-    print("\n" + "="*70)
-    print("RECOMMENDATIONS")
-    print("="*70)
-    
-    if target_class:
-        if len(correct) > 0:
-            print(f"\n✓ Good images for {target_class} dataset:")
-            for r in sorted(correct, key=lambda x: x['confidence'], reverse=True)[:5]:
-                print(f"  {os.path.basename(r['image']):50s} (conf: {r['confidence']:.3f})")
-        
-        if len(incorrect) > 0:
-            print(f"\n⚠ Images that might confuse the model (predicted as something else):")
-            for r in sorted(incorrect, key=lambda x: x['confidence'], reverse=True)[:5]:
+            self.low_confidence += 1
+            self.lowest_confidence.push((-r['confidence'], seq), item)
+
+    def print(self):
+        """Print evaluation results in a helpful format."""
+        if not self.total:
+            return
+        target_class = self.target_class
+
+        print("\n" + "="*70)
+        print("EVALUATION RESULTS")
+        print("="*70)
+
+        for r in self.errors:
+            print(f"\nERROR with {r['image']}: {r['error']}")
+        if self.error_count > len(self.errors):
+            print(f"\n... and {self.error_count - len(self.errors)} more errors")
+
+        # Summary
+        print(f"\nTotal images evaluated: {self.total}")
+        if target_class:
+            print(f"Correctly predicted as {target_class}: {self.correct} ({self.correct/self.total*100:.1f}%)")
+            print(f"Incorrectly predicted: {self.incorrect} ({self.incorrect/self.total*100:.1f}%)")
+
+        print(f"\nLow confidence predictions (<0.7): {self.low_confidence}")
+
+        # Breakdown by predicted class
+        print("\nPredicted as:")
+        for pred_class, (count, conf_sum) in sorted(self.by_prediction.items(), key=lambda x: x[1][0], reverse=True):
+            print(f"  {pred_class:15s}: {count:3d} images (avg confidence: {conf_sum / count:.3f})")
+
+        # Recommendations
+        print("\n" + "="*70)
+        print("RECOMMENDATIONS")
+        print("="*70)
+
+        if target_class:
+            if self.correct > 0:
+                print(f"\n✓ Good images for {target_class} dataset:")
+                for r in self.top_correct.items():
+                    print(f"  {os.path.basename(r['image']):50s} (conf: {r['confidence']:.3f})")
+
+            if self.incorrect > 0:
+                print(f"\n⚠ Images that might confuse the model (predicted as something else):")
+                for r in self.top_incorrect.items():
+                    print(f"  {os.path.basename(r['image']):50s} -> {r['predicted_class']} (conf: {r['confidence']:.3f})")
+
+        if self.low_confidence:
+            print(f"\n⚠ Low confidence images (might need better quality or clearer features):")
+            for r in self.lowest_confidence.items():
                 print(f"  {os.path.basename(r['image']):50s} -> {r['predicted_class']} (conf: {r['confidence']:.3f})")
-    
-    if low_confidence:
-        print(f"\n⚠ Low confidence images (might need better quality or clearer features):")
-        for r in sorted(low_confidence, key=lambda x: x['confidence'])[:5]:
+
+        # Best candidates
+        print(f"\n✓ Best candidates to add (high confidence, correct prediction):")
+        for r in self.best.items():
             print(f"  {os.path.basename(r['image']):50s} -> {r['predicted_class']} (conf: {r['confidence']:.3f})")
-    
-    # Best candidates
-    print(f"\n✓ Best candidates to add (high confidence, correct prediction):")
-    if target_class:
-        best = [r for r in correct if r['confidence'] > 0.8]
-    else:
-        best = sorted(results, key=lambda x: x['confidence'], reverse=True)
-    
-    for r in best[:10]:
-        print(f"  {os.path.basename(r['image']):50s} -> {r['predicted_class']} (conf: {r['confidence']:.3f})")
+
+def rank(pool, args):
+    """Budgeted labeling selection from a filled CandidatePool."""
+    return active_learning.rank_candidates(pool, args.rank, args.diversity, args.index_dir,
+                                           args.batch_size, args.workers)
+
+def print_selection(selection, output=None):
+    """Print the labeling selection and optionally write it to a .jsonl or .csv file."""
+    print("\n" + "="*70)
+    print(f"SELECTED FOR LABELING ({len(selection)})")
+    print("="*70)
+    for r in selection:
+        print(f"  {os.path.basename(r['image']):50s} -> {r['predicted_class']:12s} "
+              f"(conf: {r['confidence']:.3f}, uncertainty: {r['uncertainty']:.3f}, novelty: {r['novelty']:.3f})")
+    if output:
+        with ResultWriter(output, fields=SELECTION_FIELDS) as writer:
+            for r in selection:
+                writer.write(r)
+        print(f"\nSelection written to {output}")
+
+def print_results(results, target_class=None):
+    """Print evaluation results in a helpful format."""
+    summary = ResultSummary(target_class)
+    for r in results:
+        summary.add(r)
+    summary.print()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python evaluate_new_images.py <image_directory> [target_class]")
-        print("\nExample:")
-        print("  python evaluate_new_images.py ./new_marble_images marble")
-        print("  python evaluate_new_images.py ./new_quartzite_images quartzite")
-        sys.exit(1)
-    
-    directory = sys.argv[1]
-    target_class = sys.argv[2] if len(sys.argv) > 2 else None
-    
+    parser = argparse.ArgumentParser(
+        description="Evaluate new images before adding them to the dataset.",
+        epilog="Example:\n"
+               "  python evaluate_new_images.py ./new_marble_images marble\n"
+               "  python evaluate_new_images.py ./new_quartzite_images quartzite",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('directory', nargs='?', default=None, help="Directory of images to evaluate")
+    parser.add_argument('target_class', nargs='?', default=None, help="Expected stone type")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"Images per model call (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"Image decode threads (default: {DEFAULT_WORKERS})")
+    parser.add_argument('--backend', choices=BACKENDS, default='keras',
+                        help="keras (.h5) or tflite (artifacts from export_tflite.py)")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="Inference threads per process: TFLite interpreter threads, "
+                             "or TensorFlow intra-op threads for keras (default: library's choice)")
+    parser.add_argument('--cache', metavar='SQLITE_FILE', default=None,
+                        help="Reuse predictions for images already seen (keyed by content hash); "
+                             "--processes workers share the file")
+    parser.add_argument('--metrics', metavar='FILE', default=None,
+                        help="Time each stage and write the metrics to FILE "
+                             "(Prometheus text, or JSON if FILE ends in .json); "
+                             "includes the --processes workers")
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='i/N',
+                        help="Evaluate only shard i of N and write part files (run --merge afterwards)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Worker processes for this shard, each with its own model (default: 1)")
+    parser.add_argument('--parts-dir', default=DEFAULT_PARTS_DIR,
+                        help=f"Where part files are written and merged from (default: {DEFAULT_PARTS_DIR})")
+    parser.add_argument('--merge', action='store_true',
+                        help="Print the summary for all part files in --parts-dir")
+    parser.add_argument('--output', metavar='FILE', default=None,
+                        help="Write every result to FILE as it is produced (.jsonl or .csv)")
+    parser.add_argument('--resume', action='store_true',
+                        help="Skip images already in --output (or in this shard's part files) and append")
+    parser.add_argument('--time-budget', type=parse_duration, default=None, metavar='DURATION',
+                        help="Stop cleanly after this long, e.g. 3600, 45m or 2h")
+    parser.add_argument('--rank', type=int, default=None, metavar='BUDGET',
+                        help="Select BUDGET images to label, by uncertainty and embedding diversity")
+    parser.add_argument('--strategy', choices=active_learning.STRATEGIES, default='combined',
+                        help="Uncertainty measure for --rank (default: combined)")
+    parser.add_argument('--pool', type=int, default=None,
+                        help=f"Most uncertain images kept for --rank (default: {active_learning.POOL_FACTOR}x "
+                             f"the budget, at most {active_learning.MAX_POOL})")
+    parser.add_argument('--diversity', type=float, default=active_learning.DEFAULT_DIVERSITY,
+                        help="Weight of novelty vs. uncertainty in --rank, 0..1 "
+                             f"(default: {active_learning.DEFAULT_DIVERSITY})")
+    parser.add_argument('--index-dir', default=DEFAULT_INDEX_DIR,
+                        help=f"Embedding index of the training set for --rank (default: {DEFAULT_INDEX_DIR})")
+    parser.add_argument('--selection', metavar='FILE', default=None,
+                        help="Write the --rank selection to FILE (.jsonl or .csv)")
+    args = parser.parse_args()
+
+    pool = None
+    if args.rank is not None:
+        if args.rank < 1:
+            parser.error("--rank needs a budget of at least 1")
+        pool_size = args.pool or min(args.rank * active_learning.POOL_FACTOR, active_learning.MAX_POOL)
+        pool = active_learning.CandidatePool(max(pool_size, args.rank), args.strategy, len(class_names))
+
+    if args.merge:
+        summary, missing = merge_parts(find_parts(args.parts_dir), args.output, pool)
+        if missing:
+            print(f"WARNING: no part files for shards {', '.join(missing)}")
+        summary.print()
+        if pool is not None:
+            print_selection(rank(pool, args), args.selection)
+        sys.exit(0)
+
+    directory = args.directory
+    target_class = args.target_class
+
+    if directory is None:
+        parser.error("directory is required unless --merge is given")
+    sharded = args.shard is not None or args.processes > 1
+    if args.resume and not (args.output or sharded):
+        parser.error("--resume needs --output (or --shard/--processes part files) to resume from")
+
     if not os.path.exists(directory):
         print(f"Error: Directory '{directory}' does not exist")
         sys.exit(1)
@@ -168,6 +700,40 @@ if __name__ == "__main__":
         print(f"Valid classes: {', '.join(class_names)}")
         sys.exit(1)
     
-    results = evaluate_directory(directory, target_class)
-    print_results(results, target_class)
+    if args.metrics:
+        instrumentation.enable(args.metrics)
+    set_backend(args.backend, args.threads)
+    if args.cache:
+        enable_cache(args.cache, args.backend)
+    deadline = time.time() + args.time_budget if args.time_budget else None
+    install_stop_handlers(stop_event)
+
+    if sharded:
+        shard = args.shard or (0, 1)
+        part_files, stopped = evaluate_sharded(directory, target_class, shard, args.processes,
+                                               args.parts_dir, args.batch_size, args.workers,
+                                               args.backend, args.threads, args.cache,
+                                               args.resume, deadline)
+        if stopped:
+            print(f"\nStopped early ({stopped}). Rerun the same command with --resume to continue.")
+            sys.exit(EXIT_INCOMPLETE)
+        if shard[1] > 1:
+            print(f"\nWhen all {shard[1]} shards are done: "
+                  f"python evaluate_new_images.py --merge --parts-dir {args.parts_dir}"
+                  + (f" --rank {args.rank}" if pool is not None else ""))
+            sys.exit(0)
+        summary, _ = merge_parts(part_files, args.output, pool)
+    else:
+        summary = evaluate_directory(directory, target_class, args.batch_size, args.workers,
+                                     args.output, resume=args.resume, deadline=deadline, pool=pool)
+    summary.print()
+    if args.output:
+        print(f"\nAll results written to {args.output}")
+    if pool is not None and not summary.stopped:
+        print_selection(rank(pool, args), args.selection)
+    if metrics.enabled:
+        metrics.print_summary()
+    if summary.stopped:
+        print(f"\nStopped early ({summary.stopped}). Rerun the same command with --resume to continue.")
+        sys.exit(EXIT_INCOMPLETE)
 
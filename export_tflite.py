@@ -0,0 +1,164 @@
+"""
+Export the classifiers to quantized TFLite.
+For every .h5 model this writes:
+  <model>.tflite        whole classifier (used by evaluate_new_images.py)
+  <model>_head.tflite   head only, fed by the shared backbone (used by testScript.py)
+and mobilenet_backbone.tflite for the shared MobileNetV2 feature extractor.
+Calibration images are drawn from Stone_Data/val. Each exported classifier is
+then compared against its Keras model on the validation set, as it is served:
+backbone then head where a head was exported, otherwise the whole classifier.
+
+Usage: python export_tflite.py [--quantize int8|float16|none] [--calibration-samples 200]
+"""
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+from feature_cache import split_model, backbone_matches
+from streaming_metrics import StreamingEvaluator
+from preprocessing import model_version
+from tflite_backend import TFLiteModel, BACKBONE_FILE, full_model_path, head_model_path
+
+MAIN_MODEL = 'stone_classifier_model_weighted.h5'
+# Unweighted classifier used by evaluate_new_images.py, exported when present
+EXTRA_MODELS = ['stone_classifier_model.h5']
+
+
+def calibration_images(source_dir, samples, version, seed=0):
+    """A random sample of preprocessed validation images as one float32 array."""
+    from data_pipeline import build_dataset
+
+    ds, _, _ = build_dataset(source_dir, batch_size=32, shuffle=True, seed=seed, version=version)
+    batches = []
+    total = 0
+    for images, _ in ds:
+        batches.append(images.numpy())
+        total += len(batches[-1])
+        if total >= samples:
+            break
+    return np.concatenate(batches)[:samples]
+
+
+def convert(model, out_path, quantize, calibration=None):
+    """Convert a Keras model to TFLite and write it to out_path."""
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+        def representative_dataset():
+            for row in calibration:
+                yield [row[None].astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+        # Integer kernels everywhere; inputs and outputs stay float32
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    tflite_model = converter.convert()
+    with open(out_path, 'wb') as f:
+        f.write(tflite_model)
+    print(f"  {out_path}: {len(tflite_model) / 1024 / 1024:.1f} MB")
+
+
+def compare(keras_model, tflite_paths, source_dir, class_names, version, limit=None, num_threads=None):
+    """
+    Accuracy of a Keras classifier and its deployed TFLite form on the same images.
+    tflite_paths run in sequence, e.g. [backbone, head] as testScript.py serves
+    them, so the delta includes the quantization error of every stage.
+    """
+    from data_pipeline import build_dataset
+
+    stages = [TFLiteModel(path, num_threads) for path in tflite_paths]
+    ds, _, _ = build_dataset(source_dir, batch_size=32, shuffle=False, version=version)
+    keras_eval = StreamingEvaluator(class_names, top_k=1)
+    tflite_eval = StreamingEvaluator(class_names, top_k=1)
+    agree = 0
+    for images, labels in ds:
+        y_true = np.argmax(labels, axis=1)
+        keras_proba = keras_model.predict_on_batch(images)
+        tflite_proba = images.numpy()
+        for stage in stages:
+            tflite_proba = stage.predict_on_batch(tflite_proba)
+        keras_eval.update(y_true, keras_proba)
+        tflite_eval.update(y_true, tflite_proba)
+        agree += np.sum(np.argmax(keras_proba, axis=1) == np.argmax(tflite_proba, axis=1))
+        if limit and keras_eval.count >= limit:
+            break
+
+    keras_acc, tflite_acc = keras_eval.accuracy(), tflite_eval.accuracy()
+    print(f"  Keras accuracy:  {keras_acc:.4f}")
+    print(f"  TFLite accuracy: {tflite_acc:.4f} (delta {tflite_acc - keras_acc:+.4f})")
+    print(f"  Prediction agreement: {agree / max(keras_eval.count, 1):.2%} on {keras_eval.count} images")
+    return {'tflite_files': list(tflite_paths), 'keras_accuracy': keras_acc, 'tflite_accuracy': tflite_acc,
+            'agreement': agree / max(keras_eval.count, 1), 'samples': keras_eval.count}
+
+
+def class_names_from(indices_path):
+    with open(indices_path, 'r') as f:
+        indices = json.load(f)
+    idx_to_class = {v: k for k, v in indices.items()}
+    return [idx_to_class[i] for i in range(len(indices))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export classifiers to quantized TFLite.")
+    parser.add_argument('--quantize', choices=['int8', 'float16', 'none'], default='int8')
+    parser.add_argument('--calibration-samples', type=int, default=200)
+    parser.add_argument('--compare-samples', type=int, default=None,
+                        help="Limit the Keras vs TFLite comparison to N images per model")
+    parser.add_argument('--threads', type=int, default=None, help="Interpreter threads for the comparison")
+    args = parser.parse_args()
+
+    if not os.path.exists(MAIN_MODEL):
+        parser.error(f"{MAIN_MODEL} not found; train it first")
+
+    # Imported after argument checks so --help and typos return immediately
+    from tensorflow import keras
+
+    val_dir = os.path.join('Stone_Data', 'val')
+    print(f"Drawing {args.calibration_samples} calibration images from {val_dir}...")
+    calibration = calibration_images(val_dir, args.calibration_samples, model_version(MAIN_MODEL))
+
+    main_model = keras.models.load_model(MAIN_MODEL)
+    backbone, main_head = split_model(main_model)
+    features = np.asarray(backbone.predict(calibration, verbose=0))
+
+    print("\nExporting shared backbone...")
+    convert(backbone, BACKBONE_FILE, args.quantize, calibration)
+
+    models = [(MAIN_MODEL, 'class_indices.json', val_dir)]
+    models += [(m, 'class_indices.json', val_dir) for m in EXTRA_MODELS if os.path.exists(m)]
+    for model_file in sorted(glob.glob('*_subtype_model.h5')):
+        stone_type = model_file[:-len('_subtype_model.h5')]
+        models.append((model_file, f'{stone_type}_subtype_indices.json', os.path.join(val_dir, stone_type)))
+
+    report = {}
+    for model_file, indices_file, model_val_dir in models:
+        print(f"\nExporting {model_file}...")
+        model = main_model if model_file == MAIN_MODEL else keras.models.load_model(model_file)
+        convert(model, full_model_path(model_file), args.quantize, calibration)
+        # What gets served: testScript.py runs the shared backbone and this head,
+        # evaluate_new_images.py (and models without a head export) the whole classifier
+        deployed = [full_model_path(model_file)]
+        if model is main_model or backbone_matches(backbone, model):
+            convert(split_model(model)[1], head_model_path(model_file), args.quantize, features)
+            deployed = [BACKBONE_FILE, head_model_path(model_file)]
+        else:
+            print("  Backbone differs from the main model, skipping head-only export")
+
+        if os.path.exists(indices_file) and os.path.isdir(model_val_dir):
+            print(f"  Comparing against {' -> '.join(deployed)}")
+            report[model_file] = compare(model, deployed, model_val_dir, class_names_from(indices_file),
+                                         model_version(model_file), args.compare_samples, args.threads)
+
+    report_file = f'tflite_{args.quantize}_report.json'
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nAccuracy comparison saved to {report_file}")
@@ -0,0 +1,304 @@
+"""
+Persistent cache of MobileNetV2 embeddings.
+The frozen backbone (MobileNetV2 + GlobalAveragePooling2D) is the same in every
+classifier we train, so its 1280-d output is computed once per image and stored
+in a memory-mapped array. Entries are keyed by the file's content hash plus the
+preprocessing settings, so renamed or copied files are still cache hits.
+
+Usage: python feature_cache.py [data_dir] [cache_dir]
+"""
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from batch_inference import iter_batches, DEFAULT_BATCH_SIZE, DEFAULT_WORKERS
+from preprocessing import IMG_SIZE, CURRENT_VERSION
+
+FEATURE_DIM = 1280
+DEFAULT_CACHE_DIR = 'feature_cache'
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+# Settings that change the embedding. Anything here is part of the cache key.
+PREPROCESSING = {
+    'img_size': IMG_SIZE,
+    'version': CURRENT_VERSION,
+    'backbone': 'MobileNetV2-imagenet-gap',
+}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def settings_id(settings):
+    """Short, stable id for a preprocessing settings dict."""
+    blob = json.dumps(settings, sort_keys=True).encode()
+    return hashlib.sha256(blob).hexdigest()[:12]
+
+
+def build_backbone(img_size=IMG_SIZE, weights='imagenet'):
+    """Frozen MobileNetV2 with global average pooling, as used by every classifier."""
+    from tensorflow import keras
+    from tensorflow.keras import layers
+
+    base_model = keras.applications.MobileNetV2(
+        input_shape=(img_size, img_size, 3),
+        include_top=False,
+        weights=weights
+    )
+    base_model.trainable = False
+    return keras.Sequential([base_model, layers.GlobalAveragePooling2D()])
+
+
+def build_head(num_classes):
+    """Classifier head that sits on top of the pooled backbone features."""
+    from tensorflow import keras
+    from tensorflow.keras import layers
+
+    return keras.Sequential([
+        keras.Input(shape=(FEATURE_DIM,)),
+        layers.Dropout(0.3),
+        layers.Dense(256, activation='relu'),
+        layers.Dropout(0.3),
+        layers.Dense(128, activation='relu'),
+        layers.Dropout(0.2),
+        # float32 output even under a mixed precision policy
+        layers.Dense(num_classes, activation='softmax', dtype='float32')
+    ])
+
+
+def split_model(model):
+    """
+    Split a saved classifier into (backbone, head).
+    Both share layers (and weights) with the original model.
+    """
+    from tensorflow import keras
+
+    backbone = keras.Sequential(model.layers[:2])
+    head = keras.Sequential([keras.Input(shape=(FEATURE_DIM,))] + model.layers[2:])
+    return backbone, head
+
+
+def backbone_matches(backbone, model):
+    """True if model's backbone has the same weights as backbone (i.e. it was not fine-tuned)."""
+    other = model.layers[0].get_weights()
+    mine = backbone.layers[0].get_weights()
+    return len(other) == len(mine) and all(np.array_equal(a, b) for a, b in zip(mine, other))
+
+
+def train_head(features, labels, num_classes, class_weights=None, epochs=15,
+               batch_size=32, validation_data=None, learning_rate=0.001, jit_compile=False,
+               callbacks=None):
+    """Train a fresh head on cached features. labels are integer class indices."""
+    from tensorflow import keras
+
+    head = build_head(num_classes)
+    head.compile(
+        optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
+        loss='sparse_categorical_crossentropy',
+        metrics=['accuracy'],
+        jit_compile=jit_compile
+    )
+    head.fit(
+        features, labels,
+        epochs=epochs,
+        batch_size=batch_size,
+        validation_data=validation_data,
+        class_weight=class_weights,
+        callbacks=callbacks,
+        verbose=1
+    )
+    return head
+
+
+def attach_head(backbone, head):
+    """Combine a backbone and a head into a model that takes images."""
+    from tensorflow import keras
+
+    return keras.Sequential(backbone.layers + head.layers)
+
+
+def grow_memmap(array, data_path, count, needed):
+    """
+    Return a memmap of data_path with room for at least `needed` rows, keeping
+    the first `count`. Capacity doubles, so appends are amortized O(1).
+    """
+    capacity = array.shape[0]
+    if needed <= capacity:
+        return array
+    new_capacity = max(capacity * 2, needed)
+    tmp_path = data_path + '.tmp'
+    grown = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=array.dtype, shape=(new_capacity,) + array.shape[1:]
+    )
+    grown[:count] = array[:count]
+    grown.flush()
+    del grown
+    array.flush()
+    del array
+    os.replace(tmp_path, data_path)
+    return np.load(data_path, mmap_mode='r+')
+
+
+class FeatureCache:
+    """Content-addressed store of backbone embeddings backed by a .npy memmap."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, settings=None, initial_capacity=1024):
+        self.cache_dir = cache_dir
+        self.settings = dict(settings or PREPROCESSING)
+        self.settings_id = settings_id(self.settings)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.data_path = os.path.join(cache_dir, 'features.npy')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        if os.path.exists(self.index_path) and os.path.exists(self.data_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            self.rows = index['rows']
+            self.count = index['count']
+            self.features = np.load(self.data_path, mmap_mode='r+')
+        else:
+            self.rows = {}
+            self.count = 0
+            self.features = np.lib.format.open_memmap(
+                self.data_path, mode='w+', dtype=np.float32,
+                shape=(initial_capacity, FEATURE_DIM)
+            )
+        self._path_hashes = {}
+
+    def key_for(self, path):
+        """Cache key for an image file under the current settings."""
+        stat = os.stat(path)
+        memo = self._path_hashes.get(path)
+        if memo is None or memo[0] != (stat.st_size, stat.st_mtime):
+            memo = ((stat.st_size, stat.st_mtime), file_hash(path))
+            self._path_hashes[path] = memo
+        return f"{memo[1]}:{self.settings_id}"
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __len__(self):
+        return self.count
+
+    def get(self, key):
+        """Cached vector for a key, or None."""
+        row = self.rows.get(key)
+        return None if row is None else np.array(self.features[row])
+
+    def _grow(self, needed):
+        self.features = grow_memmap(self.features, self.data_path, self.count, needed)
+
+    def add(self, keys, vectors):
+        """Store vectors for keys. Existing keys are left untouched."""
+        new = [(k, v) for k, v in zip(keys, vectors) if k not in self.rows]
+        if not new:
+            return
+        self._grow(self.count + len(new))
+        for key, vector in new:
+            self.features[self.count] = vector
+            self.rows[key] = self.count
+            self.count += 1
+
+    def flush(self):
+        """Write the memmap and index to disk."""
+        self.features.flush()
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'settings': self.settings, 'count': self.count, 'rows': self.rows}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def features_for(self, image_paths, backbone, batch_size=DEFAULT_BATCH_SIZE,
+                     workers=DEFAULT_WORKERS):
+        """
+        Return (features, paths, errors) for image_paths.
+        Missing embeddings are computed with the backbone and added to the cache.
+        features has one row per entry in paths (images that failed to decode are
+        listed in errors as (path, message) instead).
+        """
+        image_paths = list(image_paths)
+        keys = {}
+        misses = []
+        errors = []
+        for path in image_paths:
+            try:
+                keys[path] = self.key_for(path)
+            except OSError as e:
+                errors.append((path, str(e)))
+                continue
+            if keys[path] not in self.rows:
+                misses.append(path)
+
+        if misses:
+            print(f"Computing {len(misses)} embeddings ({len(keys) - len(misses)} cached)...")
+            for chunk, batch, chunk_errors in iter_batches(misses, batch_size, workers,
+                                                           self.settings['img_size'],
+                                                           self.settings['version']):
+                ok = [p for p, err in zip(chunk, chunk_errors) if err is None]
+                errors.extend((p, err) for p, err in zip(chunk, chunk_errors) if err is not None)
+                if ok:
+                    vectors = np.asarray(backbone.predict_on_batch(batch))
+                    self.add([keys[p] for p in ok], vectors)
+            self.flush()
+
+        paths = [p for p in image_paths if p in keys and keys[p] in self.rows]
+        rows = [self.rows[keys[p]] for p in paths]
+        features = np.asarray(self.features[rows]) if rows else np.zeros((0, FEATURE_DIM), np.float32)
+        return features, paths, errors
+
+
+def list_images(directory):
+    """All image files under directory, sorted."""
+    return sorted(str(p) for p in Path(directory).rglob('*')
+                  if p.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def load_labeled_features(cache, backbone, directory, batch_size=DEFAULT_BATCH_SIZE,
+                          workers=DEFAULT_WORKERS):
+    """
+    Features and integer labels for a flow_from_directory-style tree.
+    Class indices follow the same sorted-subdirectory order Keras uses.
+    """
+    class_names = sorted(d for d in os.listdir(directory)
+                         if os.path.isdir(os.path.join(directory, d)))
+    class_indices = {name: i for i, name in enumerate(class_names)}
+
+    paths, labels = [], []
+    for name in class_names:
+        for path in list_images(os.path.join(directory, name)):
+            paths.append(path)
+            labels.append(class_indices[name])
+
+    features, kept, errors = cache.features_for(paths, backbone, batch_size, workers)
+    label_of = dict(zip(paths, labels))
+    for path, error in errors:
+        print(f"Skipping {path}: {error}")
+    return features, np.array([label_of[p] for p in kept], dtype=np.int32), class_indices
+
+
+if __name__ == "__main__":
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else "Stone_Data"
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_CACHE_DIR
+
+    image_paths = list_images(data_dir)
+    print(f"Found {len(image_paths)} images in {data_dir}")
+
+    cache = FeatureCache(cache_dir)
+    backbone = build_backbone()
+    features, paths, errors = cache.features_for(image_paths, backbone)
+
+    print(f"\nCached embeddings: {len(cache)}")
+    print(f"Embeddings available for this directory: {len(paths)}")
+    if errors:
+        print(f"Failed to embed {len(errors)} images:")
+        for path, error in errors:
+            print(f"  {path}: {error}")
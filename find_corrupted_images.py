@@ -1,48 +1,157 @@
 """
-Find corrupted images in the dataset
+Find corrupted images in the dataset.
+Images are checked on a process pool and the results are kept in a manifest
+(path, size, mtime, hash, status). Later runs only re-check files whose size or
+mtime changed, so the training scripts can call this on every run cheaply.
+
+Usage: python find_corrupted_images.py [data_dir] [--manifest image_manifest.json] [--workers N]
 """
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
-from pathlib import Path
 
-def check_image(filepath):
-    """Check if an image file is valid."""
+DEFAULT_MANIFEST = 'image_manifest.json'
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+def check_file(filepath):
+    """Hash and fully decode one file. Returns its manifest entry."""
+    try:
+        stat = os.stat(filepath)
+    except OSError as e:
+        # Broken symlink, or the file vanished or became unreadable since the walk
+        return filepath, {'size': -1, 'mtime': -1, 'status': 'corrupted', 'error': str(e)}
+    entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
     try:
-        img = Image.open(filepath)
-        img.verify()  # Verify it's a valid image
-        return True, None
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        entry['sha256'] = hashlib.sha256(data).hexdigest()
+        Image.open(io.BytesIO(data)).verify()
+        # verify() doesn't decode pixel data, load() catches truncated files
+        with Image.open(io.BytesIO(data)) as img:
+            img.load()
+        entry['status'] = 'ok'
     except Exception as e:
-        return False, str(e)
+        entry['status'] = 'corrupted'
+        entry['error'] = str(e)
+    return filepath, entry
 
-def find_corrupted_images(data_dir):
-    """Find all corrupted images in the dataset."""
-    corrupted = []
-    image_extensions = {'.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'}
-    
-    for root, dirs, files in os.walk(data_dir):
-        for file in files:
-            if any(file.lower().endswith(ext) for ext in image_extensions):
+def iter_image_files(data_dir):
+    """
+    Yield (path, size, mtime_ns) for every image under data_dir. Files that
+    can't be stat'ed (e.g. broken symlinks) get size and mtime -1, which
+    check_file reports as corrupted.
+    """
+    visited = set()
+    for root, dirs, files in os.walk(os.path.normpath(data_dir), followlinks=True):
+        # Symlinks are followed, so skip directories already walked (link cycles)
+        try:
+            stat = os.stat(root)
+        except OSError:
+            dirs[:] = []
+            continue
+        if (stat.st_dev, stat.st_ino) in visited:
+            dirs[:] = []
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+        dirs.sort()
+        for file in sorted(files):
+            if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS:
                 filepath = os.path.join(root, file)
-                is_valid, error = check_image(filepath)
-                if not is_valid:
-                    corrupted.append((filepath, error))
-                    print(f"Corrupted: {filepath} - {error}")
-    
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    yield filepath, -1, -1
+                    continue
+                yield filepath, stat.st_size, stat.st_mtime_ns
+
+def load_manifest(manifest_path=DEFAULT_MANIFEST):
+    """Manifest entries keyed by path, or {} if there is no manifest yet."""
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)['files']
+
+def save_manifest(entries, manifest_path=DEFAULT_MANIFEST):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'files': entries}, f)
+    os.replace(tmp_path, manifest_path)
+
+def _pool_context():
+    # The training scripts call scan() from module level; fork avoids re-running them
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+def scan(data_dir, manifest_path=DEFAULT_MANIFEST, workers=None):
+    """
+    Bring the manifest up to date for data_dir and return its entries for that tree.
+    Only new files and files whose size or mtime changed are re-checked.
+    """
+    entries = load_manifest(manifest_path)
+    prefix = os.path.join(os.path.normpath(data_dir), '')
+
+    seen = set()
+    to_check = []
+    for filepath, size, mtime in iter_image_files(data_dir):
+        seen.add(filepath)
+        old = entries.get(filepath)
+        if old is None or old['size'] != size or old['mtime'] != mtime:
+            to_check.append(filepath)
+
+    # Forget files under data_dir that no longer exist
+    removed = [p for p in entries if p.startswith(prefix) and p not in seen]
+    for filepath in removed:
+        del entries[filepath]
+
+    if to_check:
+        print(f"Checking {len(to_check)} new or changed images ({len(seen) - len(to_check)} unchanged)...")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context()) as pool:
+            for filepath, entry in pool.map(check_file, to_check, chunksize=32):
+                entries[filepath] = entry
+    if to_check or removed:
+        save_manifest(entries, manifest_path)
+
+    return {p: e for p, e in entries.items() if p.startswith(prefix)}
+
+def corrupted_in(entries, directory):
+    """(path, error) for corrupted entries under directory."""
+    prefix = os.path.join(os.path.normpath(directory), '')
+    return [(p, e.get('error')) for p, e in sorted(entries.items())
+            if e['status'] != 'ok' and p.startswith(prefix)]
+
+def find_corrupted_images(data_dir, manifest_path=DEFAULT_MANIFEST, workers=None):
+    """Find all corrupted images in the dataset."""
+    corrupted = corrupted_in(scan(data_dir, manifest_path, workers), data_dir)
+    for filepath, error in corrupted:
+        print(f"Corrupted: {filepath} - {error}")
     return corrupted
 
 if __name__ == "__main__":
-    data_dir = "Stone_Data"
+    parser = argparse.ArgumentParser(description="Find corrupted images in the dataset.")
+    parser.add_argument('data_dir', nargs='?', default="Stone_Data")
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST,
+                        help=f"Manifest file (default: {DEFAULT_MANIFEST})")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir
     print(f"Scanning {data_dir} for corrupted images...")
-    corrupted = find_corrupted_images(data_dir)
-    
+    corrupted = find_corrupted_images(data_dir, args.manifest, args.workers)
+
     print(f"\nFound {len(corrupted)} corrupted images")
-    
+
     if corrupted:
         print("\nCorrupted files:")
         for filepath, error in corrupted:
             print(f"  {filepath}")
-        
+
         print("\nTo remove them, run:")
         for filepath, _ in corrupted:
             print(f"  rm '{filepath}'")
-
@@ -0,0 +1,218 @@
+"""
+Optional timing histograms and counters for the inference hot path.
+Disabled by default: metrics.timer() then returns a shared no-op context manager
+and metrics.inc() returns immediately, so instrumented code pays one attribute
+check per call.
+
+Enable with STONE_METRICS=1, or STONE_METRICS_FILE=<path> to also write the
+metrics when the process exits (Prometheus text format, or JSON if the path
+ends in .json). serve.py exposes the same data at GET /metrics.
+
+Stages timed: model_load, image_decode, preprocessing, backbone, main_predict,
+subtype_predict, postprocess, retrieval.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Seconds; covers a 1 ms head call up to a cold model load
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Predictions below this confidence are counted as low confidence (as in print_results)
+LOW_CONFIDENCE = 0.7
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations in seconds."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (None if empty)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """Per-stage duration histograms and named counters, safe to update from threads."""
+
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS, prefix='stone_'):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def timer(self, stage):
+        """Context manager that records its duration under stage."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def inc(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_prediction(self, confidence):
+        """Count one prediction, and whether it was low confidence."""
+        if not self.enabled:
+            return
+        self.inc('predictions_total')
+        if confidence < LOW_CONFIDENCE:
+            self.inc('low_confidence_predictions_total')
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def snapshot(self):
+        """Histogram counts and counters as plain data, e.g. to send from a worker process."""
+        with self._lock:
+            return {
+                'histograms': {stage: {'counts': list(h.counts), 'sum': h.sum, 'count': h.count}
+                               for stage, h in self.histograms.items()},
+                'counters': dict(self.counters),
+            }
+
+    def merge(self, snapshot):
+        """Add a snapshot (from another process with the same buckets) to these metrics."""
+        with self._lock:
+            for stage, data in snapshot['histograms'].items():
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    histogram = self.histograms[stage] = Histogram(self.buckets)
+                histogram.counts = [a + b for a, b in zip(histogram.counts, data['counts'])]
+                histogram.sum += data['sum']
+                histogram.count += data['count']
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_prometheus(self):
+        """All metrics in Prometheus text exposition format."""
+        name = f'{self.prefix}stage_duration_seconds'
+        lines = [f'# HELP {name} Time spent in each inference stage.',
+                 f'# TYPE {name} histogram']
+        with self._lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+            for counter, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {self.prefix}{counter} counter')
+                lines.append(f'{self.prefix}{counter} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Plain dict of counts, means and approximate percentiles (ms) per stage."""
+        with self._lock:
+            stages = {}
+            for stage, h in sorted(self.histograms.items()):
+                stages[stage] = {
+                    'count': h.count,
+                    'mean_ms': h.sum / h.count * 1000.0 if h.count else None,
+                    'p50_ms_le': _ms(h.quantile(0.5)),
+                    'p99_ms_le': _ms(h.quantile(0.99)),
+                }
+            return {'stages': stages, 'counters': dict(self.counters)}
+
+    def dump(self, path):
+        """Write the metrics to path (JSON if it ends in .json, else Prometheus text)."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.summary(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def print_summary(self):
+        summary = self.summary()
+        print("\nTimings (ms, percentiles are bucket upper bounds):")
+        for stage, s in summary['stages'].items():
+            print(f"  {stage:16s} n={s['count']:<7d} mean {s['mean_ms']:9.2f}  "
+                  f"p50<={s['p50_ms_le']:.1f}  p99<={s['p99_ms_le']:.1f}")
+        for counter, value in sorted(summary['counters'].items()):
+            print(f"  {counter}: {value}")
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000.0
+
+
+metrics = Metrics(enabled=os.environ.get('STONE_METRICS', '') not in ('', '0')
+                  or bool(os.environ.get('STONE_METRICS_FILE')))
+
+
+def enable(dump_path=None):
+    """Turn metrics on; with dump_path, write them there when the process exits."""
+    metrics.enabled = True
+    if dump_path:
+        atexit.register(metrics.dump, dump_path)
+    return metrics
+
+
+if os.environ.get('STONE_METRICS_FILE'):
+    atexit.register(metrics.dump, os.environ['STONE_METRICS_FILE'])
@@ -0,0 +1,150 @@
+"""
+Lazy registry for subtype models.
+A subtype model is loaded the first time its stone type is predicted. Loaded
+models are kept in an LRU bounded by count and by weight memory, and reloaded
+when the model or indices file changes on disk.
+With backend='tflite' the exported _head.tflite (or whole-model .tflite) files
+are loaded instead of the .h5 models.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from feature_cache import split_model, backbone_matches
+from tflite_backend import TFLiteModel, full_model_path, head_model_path
+from preprocessing import model_version
+from instrumentation import metrics
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _weights_nbytes(model):
+    return sum(w.nbytes for w in model.get_weights())
+
+
+class SubtypeEntry:
+    """A loaded subtype model.
+
+    head is set when the model's backbone matches the shared one; in that case the
+    full model is dropped and only the head is kept resident.
+    """
+
+    def __init__(self, stone_type, model, head, indices, signature, nbytes):
+        self.stone_type = stone_type
+        self.model = model
+        self.head = head
+        self.indices = indices
+        self.idx_to_name = {v: k for k, v in indices.items()}
+        self.signature = signature
+        self.nbytes = nbytes
+
+
+class SubtypeModelRegistry:
+    """LRU cache of subtype models keyed by stone type."""
+
+    def __init__(self, model_dir='.', backbone=None, max_models=8, max_bytes=None,
+                 backend='keras', num_threads=None, preprocessing_version=None):
+        self.model_dir = model_dir
+        self.backbone = backbone
+        self.backend = backend
+        self.num_threads = num_threads
+        # Version the shared backbone's input is prepared with, if any
+        self.preprocessing_version = preprocessing_version
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def paths(self, stone_type):
+        """(model_file, indices_file) for a stone type."""
+        model_file = os.path.join(self.model_dir, f'{stone_type}_subtype_model.h5')
+        if self.backend == 'tflite':
+            # Prefer the head-only export; it exists when the backbone is shared
+            head_file = head_model_path(model_file)
+            model_file = head_file if os.path.exists(head_file) else full_model_path(model_file)
+        return (model_file,
+                os.path.join(self.model_dir, f'{stone_type}_subtype_indices.json'))
+
+    def available(self, stone_type):
+        """True if a trained subtype model exists on disk."""
+        return all(os.path.exists(p) for p in self.paths(stone_type))
+
+    def loaded(self):
+        """Stone types currently resident, least recently used first."""
+        with self._lock:
+            return list(self._entries)
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(e.nbytes for e in self._entries.values())
+
+    def get(self, stone_type):
+        """Return the SubtypeEntry for stone_type, loading it if needed, or None."""
+        model_file, indices_file = self.paths(stone_type)
+        try:
+            signature = (_file_signature(model_file), _file_signature(indices_file))
+        except FileNotFoundError:
+            with self._lock:
+                self._entries.pop(stone_type, None)
+            return None
+
+        with self._lock:
+            entry = self._entries.get(stone_type)
+            if entry is not None and entry.signature == signature:
+                self._entries.move_to_end(stone_type)
+                return entry
+
+            if entry is not None:
+                print(f"Reloading {stone_type} subtype model (file changed)")
+                del self._entries[stone_type]
+            with metrics.timer('model_load'):
+                entry = self._load(stone_type, model_file, indices_file, signature)
+            self._entries[stone_type] = entry
+            self._evict()
+            return entry
+
+    def _load(self, stone_type, model_file, indices_file, signature):
+        with open(indices_file, 'r') as f:
+            indices = json.load(f)
+
+        h5_file = os.path.join(self.model_dir, f'{stone_type}_subtype_model.h5')
+        version = model_version(h5_file)
+        if self.preprocessing_version is not None and version != self.preprocessing_version:
+            print(f"WARNING: {stone_type} subtype model expects preprocessing version {version}, "
+                  f"main model uses {self.preprocessing_version}. Retrain it for best accuracy.")
+
+        if self.backend == 'tflite':
+            model = TFLiteModel(model_file, self.num_threads)
+            nbytes = os.path.getsize(model_file)
+            print(f"Loaded {stone_type} subtype model ({os.path.basename(model_file)})")
+            if model_file.endswith('_head.tflite'):
+                return SubtypeEntry(stone_type, None, model, indices, signature, nbytes)
+            return SubtypeEntry(stone_type, model, None, indices, signature, nbytes)
+
+        from tensorflow import keras
+
+        model = keras.models.load_model(model_file)
+        head = None
+        if self.backbone is not None and backbone_matches(self.backbone, model):
+            head = split_model(model)[1]
+            nbytes = _weights_nbytes(head)
+            model = None
+        else:
+            nbytes = _weights_nbytes(model)
+        print(f"Loaded {stone_type} subtype model")
+        return SubtypeEntry(stone_type, model, head, indices, signature, nbytes)
+
+    def _evict(self):
+        # The most recently used entry always stays, even if it alone exceeds max_bytes
+        while len(self._entries) > 1:
+            total = sum(e.nbytes for e in self._entries.values())
+            over_count = len(self._entries) > self.max_models
+            over_bytes = self.max_bytes is not None and total > self.max_bytes
+            if not (over_count or over_bytes):
+                break
+            stone_type, _ = self._entries.popitem(last=False)
+            print(f"Evicted {stone_type} subtype model")
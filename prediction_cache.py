@@ -0,0 +1,240 @@
+"""
+Content-addressed prediction cache.
+Results are keyed by the image's SHA-256 plus a model version derived from the
+hashes of the model files. An in-memory LRU sits in front of an optional SQLite
+file with size-based eviction. When any model file changes, its hash changes and
+every older entry is dropped.
+
+The model files are checked at most every version_check_interval seconds (or
+on refresh_version()), and SQLite writes (new rows and last_access updates) are
+buffered and committed together, so a cache hit costs no disk I/O. A failed
+SQLite write (e.g. another process holding the lock past the timeout) only
+prints a warning: the result is still returned and kept in memory.
+"""
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from feature_cache import file_hash
+
+
+def content_hash(data):
+    """SHA-256 of an image's bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ModelVersion:
+    """Hash of a set of model files, recomputed only when a file's size or mtime changes."""
+
+    def __init__(self, model_files):
+        self.model_files = model_files
+        self._signature = None
+        self._version = None
+
+    def _current_files(self):
+        files = self.model_files() if callable(self.model_files) else self.model_files
+        return sorted(f for f in files if os.path.exists(f))
+
+    def get(self):
+        files = self._current_files()
+        signature = tuple((f, os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files)
+        if signature != self._signature:
+            h = hashlib.sha256()
+            for f in files:
+                h.update(f.encode())
+                h.update(file_hash(f).encode())
+            self._signature = signature
+            self._version = h.hexdigest()[:16]
+        return self._version
+
+
+class PredictionCache:
+    """Two-tier (memory LRU + optional SQLite) cache of prediction results."""
+
+    def __init__(self, model_files, max_entries=1024, db_path=None, max_db_bytes=256 * 1024 * 1024,
+                 version_check_interval=5.0, flush_every=64, flush_interval=1.0):
+        self.model_version = ModelVersion(model_files)
+        self.max_entries = max_entries
+        self.max_db_bytes = max_db_bytes
+        self.version_check_interval = version_check_interval
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._memory = OrderedDict()
+        self._version = None
+        self._version_checked = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # Buffered SQLite writes: key -> row for new results, key -> time for hits
+        self._pending = {}
+        self._touched = {}
+        self._last_flush = time.monotonic()
+
+        self._db = None
+        if db_path:
+            # Several processes may share the file (evaluate_new_images.py --processes):
+            # WAL lets readers run during a write, and writers wait for the lock
+            self._db = sqlite3.connect(db_path, timeout=30.0, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS predictions ('
+                'key TEXT PRIMARY KEY, version TEXT, value TEXT, size INTEGER, last_access REAL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS predictions_access ON predictions(last_access)')
+            self._db.commit()
+            self._db_bytes = self._stored_bytes()
+            atexit.register(self.flush)
+
+    def refresh_version(self):
+        """Re-check the model files now, e.g. after reloading a model."""
+        with self._lock:
+            self._version_checked = 0.0
+            self._check_version()
+
+    def _check_version(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._version_checked < self.version_check_interval:
+            return self._version
+        self._version_checked = now
+        version = self.model_version.get()
+        if version != self._version:
+            # Model changed: everything cached under the old version is stale
+            self._memory.clear()
+            self._pending.clear()
+            self._touched.clear()
+            if self._db is not None:
+                try:
+                    self._db.execute('DELETE FROM predictions WHERE version != ?', (version,))
+                    self._db.commit()
+                    self._db_bytes = self._stored_bytes()
+                except sqlite3.Error as e:
+                    # Old rows are never returned (lookups match the version) and age out by eviction
+                    self._db.rollback()
+                    print(f"WARNING: could not purge stale prediction cache rows ({e})")
+            self._version = version
+        return version
+
+    def get(self, image_hash):
+        """Cached result for an image hash, or None."""
+        with self._lock:
+            version = self._check_version()
+            result = self._memory.get(image_hash)
+            if result is not None:
+                self._memory.move_to_end(image_hash)
+                self.hits += 1
+                return result
+            if image_hash in self._pending:
+                result = json.loads(self._pending[image_hash][2])
+                self._remember(image_hash, result)
+                self.hits += 1
+                return result
+            if self._db is not None:
+                try:
+                    row = self._db.execute(
+                        'SELECT value FROM predictions WHERE key = ? AND version = ?',
+                        (image_hash, version)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    print(f"WARNING: prediction cache read failed ({e})")
+                    row = None
+                if row is not None:
+                    result = json.loads(row[0])
+                    self._remember(image_hash, result)
+                    self._touch(image_hash)
+                    self.hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    def put(self, image_hash, result):
+        """Store a JSON-serializable result."""
+        with self._lock:
+            version = self._check_version()
+            self._remember(image_hash, result)
+            if self._db is not None:
+                value = json.dumps(result)
+                self._pending[image_hash] = (image_hash, version, value, len(value), time.time())
+                self._touched.pop(image_hash, None)
+                self._maybe_flush()
+
+    def flush(self):
+        """Write buffered rows and access times to SQLite in one transaction."""
+        with self._lock:
+            self._flush()
+
+    def _touch(self, image_hash):
+        if self._db is not None:
+            self._touched[image_hash] = time.time()
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        if (len(self._pending) + len(self._touched) >= self.flush_every
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if self._db is None or not (self._pending or self._touched):
+            return
+        rows = list(self._pending.values())
+        touched = [(t, key) for key, t in self._touched.items()]
+        # Dropped even if the write fails: it's a cache, and the results stay in memory
+        self._pending.clear()
+        self._touched.clear()
+        try:
+            added = 0
+            if rows:
+                # Sizes of rows being replaced, so the running total stays right
+                replaced = 0
+                keys = [row[0] for row in rows]
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start + 500]
+                    replaced += self._db.execute(
+                        f'SELECT COALESCE(SUM(size), 0) FROM predictions '
+                        f'WHERE key IN ({",".join("?" * len(chunk))})', chunk
+                    ).fetchone()[0]
+                self._db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)', rows)
+                added = sum(row[3] for row in rows) - replaced
+            if touched:
+                self._db.executemany('UPDATE predictions SET last_access = ? WHERE key = ?', touched)
+            self._db.commit()
+            self._db_bytes += added
+            self._evict_db()
+            self._db.commit()
+        except sqlite3.Error as e:
+            self._db.rollback()
+            print(f"WARNING: prediction cache write failed ({e}); {len(rows)} results kept in memory only")
+
+    def _remember(self, image_hash, result):
+        self._memory[image_hash] = result
+        self._memory.move_to_end(image_hash)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _stored_bytes(self):
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+
+    def _evict_db(self):
+        if self._db_bytes <= self.max_db_bytes:
+            return
+        # Drop least recently used rows until we're 10% under the cap; the row
+        # count comes from the average row size, so this is a single DELETE
+        total, count = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM predictions').fetchone()
+        target = total - int(self.max_db_bytes * 0.9)
+        if target <= 0 or count == 0:
+            self._db_bytes = total
+            return
+        limit = min(count, -(-target * count // total))
+        self._db.execute(
+            'DELETE FROM predictions WHERE key IN '
+            '(SELECT key FROM predictions ORDER BY last_access LIMIT ?)', (limit,)
+        )
+        self._db_bytes = self._stored_bytes()
@@ -0,0 +1,128 @@
+"""
+Shared image preprocessing.
+For current preprocessing versions, JPEGs are decoded with PIL's draft mode,
+which lets libjpeg scale the image by 1/2, 1/4 or 1/8 while decoding (DCT
+scaling). A 48 MP photo is decoded at about
+1000 px instead of full size before the final resize to 224x224. Pixels are
+written as float32 straight into a caller-supplied buffer, so batches are built
+without per-image temporaries.
+
+Preprocessing is versioned. Training records the version it used next to the
+model (<model>_metadata.json) and inference reads it back, so a model is always
+served with the pipeline it was trained on.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from instrumentation import metrics
+
+IMG_SIZE = 224
+
+# Resize filter per preprocessing version. Scaling is always x / 255 in float32.
+#   1: nearest neighbour on the full-size decode, what flow_from_directory used;
+#      models without metadata
+#   2: bilinear (antialiased when shrinking) on the full-size decode
+#   3: bilinear, JPEGs decoded in draft mode (reduced size) first
+PREPROCESSING_VERSIONS = {1: 'nearest', 2: 'bilinear', 3: 'bilinear'}
+# Versions whose JPEGs are decoded at reduced size (draft); others decode in full
+DRAFT_VERSIONS = {3}
+CURRENT_VERSION = 3
+LEGACY_VERSION = 1
+
+_PIL_FILTERS = {'nearest': Image.NEAREST, 'bilinear': Image.BILINEAR}
+
+
+def resize_method(version):
+    """Resize method name ('nearest' or 'bilinear') for a preprocessing version."""
+    if version not in PREPROCESSING_VERSIONS:
+        raise ValueError(f"Unknown preprocessing version {version}")
+    return PREPROCESSING_VERSIONS[version]
+
+
+def open_resized(source, img_size=IMG_SIZE, version=CURRENT_VERSION):
+    """Open an image (path or file object) and return it as an RGB PIL image of img_size."""
+    resample = _PIL_FILTERS[resize_method(version)]
+    img = Image.open(source)
+    if version in DRAFT_VERSIONS:
+        # Only JPEGs support draft; it picks the largest scale that keeps both sides >= img_size
+        img.draft('RGB', (img_size, img_size))
+    img = img.convert('RGB')
+    if img.size != (img_size, img_size):
+        img = img.resize((img_size, img_size), resample)
+    return img
+
+
+def load_uint8(source, img_size=IMG_SIZE, version=CURRENT_VERSION):
+    """Decode and resize to a (img_size, img_size, 3) uint8 array."""
+    return np.asarray(open_resized(source, img_size, version), dtype=np.uint8)
+
+
+def load_into(source, out, version=CURRENT_VERSION):
+    """Decode, resize and scale to [0, 1] into out, a float32 (H, W, 3) view."""
+    with metrics.timer('image_decode'):
+        pixels = np.asarray(open_resized(source, out.shape[0], version), dtype=np.uint8)
+    with metrics.timer('preprocessing'):
+        np.multiply(pixels, np.float32(1.0 / 255.0), out=out)
+    return out
+
+
+def load_image(source, img_size=IMG_SIZE, version=CURRENT_VERSION):
+    """Decode a single image to a new float32 array scaled to [0, 1]."""
+    out = np.empty((img_size, img_size, 3), dtype=np.float32)
+    return load_into(source, out, version)
+
+
+def load_batch(sources, out=None, img_size=IMG_SIZE, version=CURRENT_VERSION, workers=None):
+    """
+    Decode several images into one float32 batch.
+    out can be a preallocated (N, H, W, 3) buffer reused across calls; it must have
+    at least len(sources) rows. Returns the filled rows. Raises on the first
+    image that fails to decode.
+    """
+    sources = list(sources)
+    if out is None:
+        out = np.empty((len(sources), img_size, img_size, 3), dtype=np.float32)
+    batch = out[:len(sources)]
+    if workers and len(sources) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda i: load_into(sources[i], batch[i], version), range(len(sources))))
+    else:
+        for i, source in enumerate(sources):
+            load_into(source, batch[i], version)
+    return batch
+
+
+def metadata_path(model_path):
+    """Sidecar metadata file for a saved model."""
+    return os.path.splitext(model_path)[0] + '_metadata.json'
+
+
+def save_metadata(model_path, class_indices, version=CURRENT_VERSION, img_size=IMG_SIZE, **extra):
+    """Record how a model's inputs must be prepared (plus any extra keys, e.g. fine_tuned_blocks)."""
+    metadata = {
+        'preprocessing_version': version,
+        'img_size': img_size,
+        'class_indices': class_indices,
+    }
+    metadata.update(extra)
+    with open(metadata_path(model_path), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def load_metadata(model_path):
+    """Metadata for a saved model. Models saved before metadata existed get LEGACY_VERSION."""
+    path = metadata_path(model_path)
+    if not os.path.exists(path):
+        return {'preprocessing_version': LEGACY_VERSION, 'img_size': IMG_SIZE}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def model_version(model_path):
+    """Preprocessing version a saved model expects."""
+    return load_metadata(model_path)['preprocessing_version']
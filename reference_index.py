@@ -0,0 +1,183 @@
+"""
+Read-only index of training-image embeddings for similar-stone retrieval.
+Built from the embedding index (embedding_index.py build), it stores the train
+split's normalized embeddings in one memory-mapped matrix sorted by stone type,
+subtype and IVF list, so every stone type / subtype is a contiguous partition
+and every IVF list inside a partition is a contiguous slice.
+
+A query only reads its own partition: small partitions are scanned in full,
+large ones only in the nprobe IVF lists nearest the query.
+
+Usage: python reference_index.py [--index-dir embedding_index] [--output reference_index]
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from embedding_index import DEFAULT_INDEX_DIR, DEFAULT_NPROBE, EmbeddingIndex, normalize
+from feature_cache import PREPROCESSING, settings_id
+
+DEFAULT_REFERENCE_DIR = 'reference_index'
+# Partitions up to this many rows are scanned exactly (~20 MB of float32)
+EXACT_ROWS = 4096
+
+
+def _split_label(label):
+    """'marble/calacatta' -> ('marble', 'calacatta'); 'marble' -> ('marble', None)."""
+    stone_type, _, subtype = label.partition('/')
+    return stone_type, subtype or None
+
+
+def build_reference_index(index, output=DEFAULT_REFERENCE_DIR, split='train'):
+    """Write the split's rows of an EmbeddingIndex as a partitioned reference index. Returns the row count."""
+    if index.settings_id != settings_id(PREPROCESSING):
+        raise ValueError(f"{index.index_dir} was built with other preprocessing settings; rebuild it first")
+    if index.centroids is None:
+        index.train_ivf()
+
+    rows = np.flatnonzero(index.column('split') == split) if len(index) else np.zeros(0, dtype=np.int64)
+    labels = [index.rows[r]['label'] for r in rows]
+    assignments = index.assignments[rows] if len(rows) else np.zeros(0, dtype=np.int32)
+    nlist = len(index.centroids) if index.centroids is not None else 1
+
+    names = sorted(set(labels))
+    name_ids = {name: i for i, name in enumerate(names)}
+    label_ids = np.array([name_ids[label] for label in labels], dtype=np.int64)
+    order = np.lexsort((assignments, label_ids))
+
+    os.makedirs(output, exist_ok=True)
+    vectors = np.lib.format.open_memmap(
+        os.path.join(output, 'vectors.npy'), mode='w+', dtype=np.float32,
+        shape=(len(rows), index.vectors.shape[1])
+    )
+    for start in range(0, len(order), 65536):
+        chunk = order[start:start + 65536]
+        vectors[start:start + len(chunk)] = index.vectors[rows[chunk]]
+    vectors.flush()
+    del vectors
+
+    sorted_labels = label_ids[order]
+    sorted_lists = assignments[order]
+    partitions, list_offsets = [], []
+    for i, name in enumerate(names):
+        start, end = np.searchsorted(sorted_labels, [i, i + 1])
+        stone_type, subtype = _split_label(name)
+        partitions.append({'label': name, 'stone_type': stone_type, 'subtype': subtype,
+                           'start': int(start), 'end': int(end)})
+        list_offsets.append(start + np.searchsorted(sorted_lists[start:end], np.arange(nlist + 1)))
+
+    np.savez(os.path.join(output, 'ivf.npz'),
+             centroids=index.centroids if index.centroids is not None else np.zeros((1, index.vectors.shape[1])),
+             list_offsets=np.array(list_offsets, dtype=np.int64).reshape(len(names), nlist + 1))
+    with open(os.path.join(output, 'meta.json'), 'w') as f:
+        json.dump({
+            'settings': PREPROCESSING,
+            'split': split,
+            'paths': [index.rows[r]['path'] for r in rows[order]],
+            'partitions': partitions,
+        }, f)
+    return len(rows)
+
+
+class ReferenceIndex:
+    """Top-k most similar training images, filtered by stone type and optionally subtype."""
+
+    def __init__(self, index_dir=DEFAULT_REFERENCE_DIR, nprobe=DEFAULT_NPROBE, exact_rows=EXACT_ROWS):
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.settings = meta['settings']
+        self.preprocessing_version = self.settings['version']
+        self.paths = meta['paths']
+        self.partitions = meta['partitions']
+        self.vectors = np.load(os.path.join(index_dir, 'vectors.npy'), mmap_mode='r')
+        ivf = np.load(os.path.join(index_dir, 'ivf.npz'))
+        self.centroids = ivf['centroids'].astype(np.float32)
+        self.list_offsets = ivf['list_offsets']
+        self.nprobe = nprobe
+        self.exact_rows = exact_rows
+
+        self._ends = np.array([p['end'] for p in self.partitions], dtype=np.int64)
+        self._by_label = {p['label']: i for i, p in enumerate(self.partitions)}
+        self._by_type = {}
+        for i, p in enumerate(self.partitions):
+            self._by_type.setdefault(p['stone_type'], []).append(i)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def partitions_for(self, stone_type=None, subtype=None):
+        """Partition ids matching the filter; an unknown subtype falls back to the whole stone type."""
+        if stone_type is None:
+            return list(range(len(self.partitions)))
+        if subtype is not None:
+            i = self._by_label.get(f'{stone_type}/{subtype}')
+            if i is not None:
+                return [i]
+        return self._by_type.get(stone_type, [])
+
+    def _candidates(self, query, partition_ids, k, exact):
+        """Row ranges (start, end) to score for one query."""
+        full = [(self.partitions[i]['start'], self.partitions[i]['end']) for i in partition_ids]
+        if exact or sum(e - s for s, e in full) <= self.exact_rows:
+            return full
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        ranges = []
+        for i in partition_ids:
+            offsets = self.list_offsets[i]
+            ranges.extend((int(offsets[l]), int(offsets[l + 1])) for l in probes if offsets[l + 1] > offsets[l])
+        # The probed lists can miss a partition almost entirely
+        return ranges if sum(e - s for s, e in ranges) >= k else full
+
+    def search(self, queries, k=5, stone_types=None, subtypes=None, exact=False):
+        """
+        For each query embedding, the k most similar references as
+        [{'image', 'stone_type', 'subtype', 'similarity'}, ...], best first.
+        stone_types / subtypes: optional per-query filters (None entries mean no filter).
+        """
+        queries = normalize(queries)
+        stone_types = stone_types or [None] * len(queries)
+        subtypes = subtypes or [None] * len(queries)
+        out = []
+        for query, stone_type, subtype in zip(queries, stone_types, subtypes):
+            ranges = self._candidates(query, self.partitions_for(stone_type, subtype), k, exact)
+            if not ranges:
+                out.append([])
+                continue
+            rows = np.concatenate([np.arange(s, e) for s, e in ranges])
+            block = np.concatenate([self.vectors[s:e] for s, e in ranges])
+            scores = block @ query
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            out.append([self._describe(int(rows[j]), float(scores[j])) for j in top])
+        return out
+
+    def _describe(self, row, similarity):
+        # Partitions are contiguous and sorted by start
+        partition = self.partitions[int(np.searchsorted(self._ends, row, side='right'))]
+        return {'image': self.paths[row], 'stone_type': partition['stone_type'],
+                'subtype': partition['subtype'], 'similarity': similarity}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the similar-stone reference index from the embedding index.")
+    parser.add_argument('--index-dir', default=DEFAULT_INDEX_DIR,
+                        help=f"Embedding index to read (default: {DEFAULT_INDEX_DIR})")
+    parser.add_argument('--output', default=DEFAULT_REFERENCE_DIR,
+                        help=f"Where to write the reference index (default: {DEFAULT_REFERENCE_DIR})")
+    parser.add_argument('--split', default='train', help="Which split to use as references (default: train)")
+    args = parser.parse_args()
+
+    index = EmbeddingIndex(args.index_dir)
+    if len(index) == 0:
+        parser.error(f"{args.index_dir} is empty, run 'python embedding_index.py build' first")
+    count = build_reference_index(index, args.output, args.split)
+    reference = ReferenceIndex(args.output)
+    print(f"Wrote {count} references in {len(reference.partitions)} partitions to {args.output}")
+    for p in reference.partitions:
+        print(f"  {p['label']:32s} {p['end'] - p['start']}")
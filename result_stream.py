@@ -0,0 +1,152 @@
+"""
+Incremental result files and bounded top-k tracking.
+Results are appended to a JSONL or CSV file as they are produced, so a long
+run keeps everything finished so far even if it is killed, and summaries keep
+only running counts and small heaps instead of every result.
+
+The results file doubles as the checkpoint journal: a resumed run reads it back
+(read_results) to learn which images are done, after repair_tail has dropped a
+row that was cut off mid-write.
+"""
+import csv
+import heapq
+import json
+import os
+
+CSV_FIELDS = ['image', 'predicted_class', 'confidence', 'top3', 'margin', 'entropy', 'is_correct', 'error']
+
+
+class TopK:
+    """The k items with the largest keys, in bounded memory. Keys must be unique."""
+
+    def __init__(self, k):
+        self.k = k
+        self._heap = []
+
+    def push(self, key, item):
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, (key, item))
+        elif key > self._heap[0][0]:
+            heapq.heapreplace(self._heap, (key, item))
+
+    def __len__(self):
+        return len(self._heap)
+
+    def items(self):
+        """Items, largest key first."""
+        return [item for _, item in sorted(self._heap, key=lambda e: e[0], reverse=True)]
+
+
+class ResultWriter:
+    """
+    Appends result dicts to a .jsonl or .csv file, flushing every flush_every rows.
+    fields are the CSV columns (other keys are dropped from CSV rows).
+    """
+
+    def __init__(self, path, append=False, flush_every=64, fields=CSV_FIELDS):
+        self.path = path
+        self.format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+        self.flush_every = flush_every
+        self._pending = 0
+        self.file = open(path, 'a' if append else 'w', newline='' if self.format == 'csv' else None)
+        self._csv = None
+        if self.format == 'csv':
+            if self.file.tell() > 0:
+                # Appending: keep the columns the file was started with
+                with open(path, 'r', newline='') as f:
+                    fields = next(csv.reader(f), None) or fields
+            self._csv = csv.DictWriter(self.file, fieldnames=fields, extrasaction='ignore')
+            if self.file.tell() == 0:
+                self._csv.writeheader()
+
+    def write(self, result):
+        if self._csv is not None:
+            row = dict(result)
+            if row.get('top3') is not None:
+                row['top3'] = ';'.join(f"{name}:{prob:.4f}" for name, prob in row['top3'])
+            self._csv.writerow(row)
+        else:
+            self.file.write(json.dumps(result) + '\n')
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        # Survive losing the node, not just the process
+        os.fsync(self.file.fileno())
+        self._pending = 0
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def read_jsonl(path):
+    """Yield one dict per line. A truncated last line (from a killed run) is skipped."""
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def repair_tail(path):
+    """Truncate path after its last complete line. Returns the bytes dropped."""
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            step = min(65536, end)
+            f.seek(end - step)
+            block = f.read(step)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                end = end - step + newline + 1
+                break
+            end -= step
+        if end != size:
+            f.truncate(end)
+        return size - end
+
+
+def _csv_float(value):
+    """Float from a CSV cell; None for empty cells and columns older files lack."""
+    return float(value) if value not in (None, '') else None
+
+
+def _from_csv_row(row):
+    result = {'image': row['image']}
+    if row.get('error'):
+        result['error'] = row['error']
+        return result
+    top3 = []
+    for entry in filter(None, row['top3'].split(';')):
+        name, prob = entry.rsplit(':', 1)
+        top3.append((name, float(prob)))
+    result.update({
+        'predicted_class': row['predicted_class'],
+        'confidence': float(row['confidence']),
+        'top3': top3,
+        'margin': _csv_float(row.get('margin')),
+        'entropy': _csv_float(row.get('entropy')),
+        'is_correct': {'True': True, 'False': False}.get(row['is_correct']),
+    })
+    return result
+
+
+def read_results(path):
+    """Yield the result dicts in a .jsonl or .csv results file."""
+    if path.lower().endswith('.csv'):
+        with open(path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                yield _from_csv_row(row)
+    else:
+        yield from read_jsonl(path)
@@ -0,0 +1,236 @@
+"""
+HTTP inference service for the two-stage stone classifier.
+Models are loaded once at startup. Concurrent requests are merged into
+micro-batches so the backbone runs on several images per call.
+
+Usage: python serve.py [--port 8000] [--max-batch-size 32] [--max-latency-ms 10] [--max-queue 256]
+
+Endpoints:
+  POST /predict        one image file (form field "file")
+  POST /predict/batch  several image files (form field "files")
+  POST /similar        prediction plus the k closest training images (?k=5&by_subtype=true)
+  GET  /health
+  GET  /metrics        stage timings and counters in Prometheus format
+                       (enable with STONE_METRICS=1 or --metrics)
+"""
+import argparse
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import PlainTextResponse
+
+import instrumentation
+from instrumentation import metrics
+from prediction_cache import content_hash
+
+
+class QueueFullError(Exception):
+    """Raised when the request queue is at capacity."""
+
+
+class MicroBatcher:
+    """
+    Collects single-image requests into batches.
+    A batch is sent to the model when it reaches max_batch_size or when the oldest
+    request has waited max_latency seconds, whichever comes first.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_latency=0.01, max_queue=256):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        # One model thread: batches are serialized, the event loop stays free
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, img_array):
+        """Queue one preprocessed image and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((img_array, future))
+        except asyncio.QueueFull:
+            raise QueueFullError()
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            batch = [(arr, fut) for arr, fut in batch if not fut.cancelled()]
+            if not batch:
+                continue
+            try:
+                img_batch = np.stack([arr for arr, _ in batch])
+                results = await loop.run_in_executor(self.executor, self.predict_fn, img_batch)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut), result in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(result)
+
+
+def create_app(max_batch_size=32, max_latency_ms=10, max_queue=256, decode_workers=4):
+    """Build the FastAPI app. Models load when the app starts."""
+    state = {}
+
+    @asynccontextmanager
+    async def lifespan(app):
+        import testScript as predictor
+
+        # Load the models now rather than on the first request
+        predictor.load_models()
+        state['predictor'] = predictor
+        state['decode_pool'] = ThreadPoolExecutor(max_workers=decode_workers)
+        state['batcher'] = MicroBatcher(
+            predictor.predict_batch,
+            max_batch_size=max_batch_size,
+            max_latency=max_latency_ms / 1000.0,
+            max_queue=max_queue
+        )
+        state['batcher'].start()
+        yield
+        await state['batcher'].stop()
+        predictor.prediction_cache.flush()
+        state['decode_pool'].shutdown(wait=False)
+
+    app = FastAPI(title="Stone Classifier", lifespan=lifespan)
+
+    async def classify(upload):
+        data = await upload.read()
+        cache = state['predictor'].prediction_cache
+        loop = asyncio.get_running_loop()
+        # Hashing and the SQLite tier block, so they run off the event loop
+        image_hash = await loop.run_in_executor(state['decode_pool'], content_hash, data)
+        cached = await loop.run_in_executor(state['decode_pool'], cache.get, image_hash)
+        if cached is not None:
+            return dict(cached, image=upload.filename)
+
+        try:
+            img_array = await loop.run_in_executor(
+                state['decode_pool'], state['predictor'].load_image, io.BytesIO(data)
+            )
+        except Exception as e:
+            metrics.inc('errors_total')
+            raise HTTPException(status_code=400, detail=f"Could not read image {upload.filename}: {e}")
+        try:
+            result = await state['batcher'].submit(img_array)
+        except QueueFullError:
+            metrics.inc('rejected_total')
+            raise HTTPException(status_code=503, detail="Server busy, retry later",
+                                headers={'Retry-After': '1'})
+        await loop.run_in_executor(state['decode_pool'], cache.put, image_hash, result)
+        return dict(result, image=upload.filename)
+
+    @app.get('/health')
+    async def health():
+        predictor = state['predictor']
+        return {
+            'status': 'ok',
+            'stone_types': predictor.class_names,
+            'subtype_models_loaded': predictor.subtype_registry.loaded(),
+            'queue_depth': state['batcher'].queue.qsize(),
+            'cache_hits': predictor.prediction_cache.hits,
+            'cache_misses': predictor.prediction_cache.misses,
+        }
+
+    @app.get('/metrics', response_class=PlainTextResponse)
+    async def prometheus_metrics():
+        if not metrics.enabled:
+            raise HTTPException(status_code=404, detail="Metrics are disabled (set STONE_METRICS=1)")
+        return metrics.to_prometheus()
+
+    @app.post('/predict')
+    async def predict(file: UploadFile = File(...)):
+        return await classify(file)
+
+    @app.post('/predict/batch')
+    async def predict_batch(files: list[UploadFile] = File(...)):
+        return await asyncio.gather(*(classify(f) for f in files))
+
+    @app.post('/similar')
+    async def similar(file: UploadFile = File(...), k: int = 5, by_subtype: bool = True):
+        predictor = state['predictor']
+        if not os.path.exists(os.path.join(predictor.REFERENCE_INDEX_DIR, 'meta.json')):
+            raise HTTPException(status_code=404, detail="No reference index (run reference_index.py)")
+        data = await file.read()
+        loop = asyncio.get_running_loop()
+        try:
+            # On the model thread, so it never runs alongside a micro-batch
+            result = await loop.run_in_executor(
+                state['batcher'].executor, predictor.find_similar, [data], max(1, min(k, 100)), by_subtype
+            )
+        except Exception as e:
+            metrics.inc('errors_total')
+            raise HTTPException(status_code=400, detail=f"Could not read image {file.filename}: {e}")
+        return dict(result[0], image=file.filename)
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve stone classifier predictions over HTTP.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32,
+                        help="Largest micro-batch sent to the model (default: 32)")
+    parser.add_argument('--max-latency-ms', type=float, default=10,
+                        help="How long a request may wait for a batch to fill (default: 10)")
+    parser.add_argument('--max-queue', type=int, default=256,
+                        help="Queued requests before returning 503 (default: 256)")
+    parser.add_argument('--decode-workers', type=int, default=4,
+                        help="Image decode threads (default: 4)")
+    parser.add_argument('--backend', choices=['keras', 'tflite'], default=None,
+                        help="Model backend (default: $STONE_BACKEND or keras)")
+    parser.add_argument('--tflite-threads', type=int, default=None,
+                        help="TFLite interpreter threads")
+    parser.add_argument('--metrics', action='store_true',
+                        help="Record stage timings and expose them at /metrics")
+    args = parser.parse_args()
+
+    if args.metrics:
+        instrumentation.enable()
+
+    # testScript reads these when the app starts
+    if args.backend:
+        os.environ['STONE_BACKEND'] = args.backend
+    if args.tflite_threads:
+        os.environ['TFLITE_THREADS'] = str(args.tflite_threads)
+
+    app = create_app(args.max_batch_size, args.max_latency_ms, args.max_queue, args.decode_workers)
+    uvicorn.run(app, host=args.host, port=args.port)
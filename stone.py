@@ -0,0 +1,59 @@
+"""
+Single entry point for the project's scripts.
+Only the chosen command's module is imported, so `python stone.py --help`,
+`python stone.py <command> --help` and commands that never touch a model
+(scan, shards, cached predictions) start without importing TensorFlow.
+
+Usage: python stone.py <command> [args...]
+Example:
+  python stone.py scan Stone_Data
+  python stone.py evaluate --no-plot
+  python stone.py evaluate-new ./new_marble_images marble
+"""
+import runpy
+import sys
+
+# command -> (module, description)
+COMMANDS = {
+    'predict': ('testScript', "Two-stage prediction on the images in test/"),
+    'evaluate': ('evaluate_model', "Validation accuracy, confusion matrix and report"),
+    'evaluate-new': ('evaluate_new_images', "Score new images before adding them to the dataset"),
+    'scan': ('find_corrupted_images', "Find corrupted images (incremental manifest)"),
+    'shards': ('dataset_shards', "Pre-decode the dataset into training shards"),
+    'features': ('feature_cache', "Populate the backbone embedding cache"),
+    'index': ('embedding_index', "Near-duplicate and train/val leakage checks"),
+    'references': ('reference_index', "Build the similar-stone reference index"),
+    'train': ('train_model', "Train the stone type classifier"),
+    'train-weighted': ('train_model_weighted', "Train the stone type classifier with class weights"),
+    'train-subtype': ('train_subtype_model', "Train subtype classifiers"),
+    'export-tflite': ('export_tflite', "Export quantized TFLite models"),
+    'serve': ('serve', "Run the HTTP inference service"),
+    'benchmark': ('benchmark', "Measure inference and training throughput"),
+}
+
+
+def usage():
+    lines = ["Usage: python stone.py <command> [args...]", "", "Commands:"]
+    lines += [f"  {name:16s}{description}" for name, (_, description) in COMMANDS.items()]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0
+    command, rest = argv[0], argv[1:]
+    if command not in COMMANDS:
+        print(f"Unknown command '{command}'\n\n{usage()}", file=sys.stderr)
+        return 2
+
+    module = COMMANDS[command][0]
+    # The scripts parse sys.argv themselves
+    sys.argv = [f'{module}.py'] + rest
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Streaming classification metrics.
+Batches are folded into a confusion matrix and top-k counters as they arrive,
+so evaluation memory doesn't grow with the size of the validation set.
+"""
+import json
+
+import numpy as np
+
+
+class StreamingEvaluator:
+    """Accumulates confusion matrix, per-class counts and top-k accuracy batch by batch."""
+
+    def __init__(self, class_names, top_k=3, spill_path=None, spill_rows=None):
+        self.class_names = list(class_names)
+        self.num_classes = len(self.class_names)
+        self.top_k = max(1, min(top_k, self.num_classes))
+        self.confusion = np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+        self.topk_correct = np.zeros(self.top_k, dtype=np.int64)
+        self.count = 0
+
+        # Optional on-disk copy of every probability row, e.g. for calibration plots
+        # spill_rows is an upper bound: images that fail to decode are skipped, so
+        # only the first `count` rows (see <spill>_meta.json) are filled and the
+        # labels of the rest stay -1
+        self.spill = None
+        if spill_path is not None:
+            if spill_rows is None:
+                raise ValueError("spill_rows is required when spill_path is set")
+            base = spill_path.replace('.npy', '')
+            self.spill_meta_path = base + '_meta.json'
+            self.spill = np.lib.format.open_memmap(
+                spill_path, mode='w+', dtype=np.float32, shape=(spill_rows, self.num_classes)
+            )
+            self.spill_labels = np.lib.format.open_memmap(
+                base + '_labels.npy', mode='w+', dtype=np.int32, shape=(spill_rows,)
+            )
+            self.spill_labels[:] = -1
+
+    def update(self, y_true, y_proba):
+        """Add a batch. y_true are integer labels, y_proba is (batch, num_classes)."""
+        y_true = np.asarray(y_true, dtype=np.int64)
+        y_proba = np.asarray(y_proba)
+        y_pred = np.argmax(y_proba, axis=1)
+        np.add.at(self.confusion, (y_true, y_pred), 1)
+
+        # Rank of the true class: how many classes scored strictly higher
+        true_scores = y_proba[np.arange(len(y_true)), y_true]
+        rank = np.sum(y_proba > true_scores[:, None], axis=1)
+        for k in range(self.top_k):
+            self.topk_correct[k] += np.sum(rank <= k)
+
+        if self.spill is not None:
+            end = min(self.count + len(y_true), self.spill.shape[0])
+            self.spill[self.count:end] = y_proba[:end - self.count]
+            self.spill_labels[self.count:end] = y_true[:end - self.count]
+        self.count += len(y_true)
+
+    def accuracy(self):
+        return np.trace(self.confusion) / self.count if self.count else 0.0
+
+    def topk_accuracy(self, k):
+        return self.topk_correct[k - 1] / self.count if self.count else 0.0
+
+    def support(self):
+        return self.confusion.sum(axis=1)
+
+    def per_class_accuracy(self):
+        """Recall per class; NaN for classes with no samples."""
+        support = self.support()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.diag(self.confusion) / support
+
+    def progress_line(self):
+        """One-line summary of the metrics so far."""
+        parts = [f"{self.count} images", f"acc {self.accuracy():.4f}"]
+        if self.top_k > 1:
+            parts.append(f"top-{self.top_k} {self.topk_accuracy(self.top_k):.4f}")
+        return ", ".join(parts)
+
+    def classification_report(self):
+        """Precision/recall/F1 table in the same layout as sklearn's report."""
+        tp = np.diag(self.confusion).astype(np.float64)
+        predicted = self.confusion.sum(axis=0)
+        support = self.support()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            precision = np.nan_to_num(tp / predicted)
+            recall = np.nan_to_num(tp / support)
+            f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+
+        width = max(len(n) for n in self.class_names + ['weighted avg'])
+        lines = [f"{'':>{width}} {'precision':>9} {'recall':>9} {'f1-score':>9} {'support':>9}", ""]
+        for i, name in enumerate(self.class_names):
+            lines.append(f"{name:>{width}} {precision[i]:>9.2f} {recall[i]:>9.2f} {f1[i]:>9.2f} {support[i]:>9d}")
+        lines.append("")
+        total = support.sum()
+        lines.append(f"{'accuracy':>{width}} {'':>9} {'':>9} {self.accuracy():>9.2f} {total:>9d}")
+        lines.append(f"{'macro avg':>{width}} {precision.mean():>9.2f} {recall.mean():>9.2f} "
+                     f"{f1.mean():>9.2f} {total:>9d}")
+        weights = support / total if total else np.zeros_like(precision)
+        lines.append(f"{'weighted avg':>{width}} {np.dot(precision, weights):>9.2f} "
+                     f"{np.dot(recall, weights):>9.2f} {np.dot(f1, weights):>9.2f} {total:>9d}")
+        return "\n".join(lines)
+
+    def misclassifications(self, limit=10):
+        """[((true_class, predicted_class), count)] sorted by count."""
+        off_diagonal = self.confusion.copy()
+        np.fill_diagonal(off_diagonal, 0)
+        pairs = [((self.class_names[t], self.class_names[p]), int(off_diagonal[t, p]))
+                 for t, p in zip(*np.nonzero(off_diagonal))]
+        return sorted(pairs, key=lambda x: x[1], reverse=True)[:limit]
+
+    def flush(self):
+        """Write the spill arrays and record how many of their rows are filled."""
+        if self.spill is not None:
+            self.spill.flush()
+            self.spill_labels.flush()
+            with open(self.spill_meta_path, 'w') as f:
+                json.dump({'count': min(self.count, self.spill.shape[0]), 'rows': self.spill.shape[0],
+                           'class_names': self.class_names}, f, indent=2)
@@ -1,12 +1,30 @@
-import tensorflow as tf
-from tensorflow import keras
 import numpy as np
-from PIL import Image
 import os
+import io
 import json
 
-# Load main stone type model
-main_model = keras.models.load_model('stone_classifier_model_weighted.h5')
+import preprocessing
+from batch_inference import iter_batches, DEFAULT_BATCH_SIZE, DEFAULT_WORKERS
+from feature_cache import split_model, file_hash
+from model_registry import SubtypeModelRegistry
+from tflite_backend import TFLiteModel, BACKBONE_FILE, head_model_path
+from prediction_cache import PredictionCache
+from instrumentation import metrics
+
+MAIN_MODEL_FILE = 'stone_classifier_model_weighted.h5'
+
+# Images are prepared exactly as the main model's training data was
+PREPROCESSING_VERSION = preprocessing.model_version(MAIN_MODEL_FILE)
+
+# STONE_BACKEND=tflite runs the artifacts written by export_tflite.py
+BACKEND = os.environ.get('STONE_BACKEND', 'keras')
+TFLITE_THREADS = int(os.environ['TFLITE_THREADS']) if os.environ.get('TFLITE_THREADS') else None
+
+# The backbone runs once per image; the main and subtype heads share its output.
+# Both are loaded by load_models() on the first prediction, so cached results
+# are answered without importing TensorFlow.
+backbone = None
+main_head = None
 
 # Load main class indices
 with open('class_indices.json', 'r') as f:
@@ -16,19 +34,58 @@ with open('class_indices.json', 'r') as f:
 idx_to_class = {v: k for k, v in class_indices.items()}
 class_names = [idx_to_class[i] for i in range(len(class_indices))]
 
-# Load subtype models if they exist
-subtype_models = {}
-subtype_indices = {}
+# Subtype models load on first use and are kept in a bounded LRU
+SUBTYPE_CACHE_SIZE = int(os.environ.get('SUBTYPE_CACHE_SIZE', 8))
+SUBTYPE_CACHE_MB = os.environ.get('SUBTYPE_CACHE_MB')
+subtype_registry = SubtypeModelRegistry(
+    max_models=SUBTYPE_CACHE_SIZE,
+    max_bytes=int(SUBTYPE_CACHE_MB) * 1024 * 1024 if SUBTYPE_CACHE_MB else None,
+    backend=BACKEND,
+    num_threads=TFLITE_THREADS,
+    preprocessing_version=PREPROCESSING_VERSION
+)
 
-for stone_type in class_names:
-    model_file = f'{stone_type}_subtype_model.h5'
-    indices_file = f'{stone_type}_subtype_indices.json'
-    
-    if os.path.exists(model_file) and os.path.exists(indices_file):
-        subtype_models[stone_type] = keras.models.load_model(model_file)
-        with open(indices_file, 'r') as f:
-            subtype_indices[stone_type] = json.load(f)
-        print(f"Loaded {stone_type} subtype model")
+def model_files():
+    """Every file a prediction depends on; changing any of them invalidates cached results."""
+    if BACKEND == 'tflite':
+        files = [BACKBONE_FILE, head_model_path(MAIN_MODEL_FILE)]
+    else:
+        files = [MAIN_MODEL_FILE]
+    files.append('class_indices.json')
+    for stone_type in class_names:
+        files.extend(subtype_registry.paths(stone_type))
+    return files
+
+# Repeated images are answered from cache; PREDICTION_CACHE=<file.sqlite> adds a disk tier
+prediction_cache = PredictionCache(
+    model_files,
+    max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 1024)),
+    db_path=os.environ.get('PREDICTION_CACHE')
+)
+
+# Similar-stone retrieval (find_similar); build with embedding_index.py and reference_index.py
+REFERENCE_INDEX_DIR = os.environ.get('REFERENCE_INDEX', 'reference_index')
+reference_index = None
+# A fine-tuned main backbone no longer produces the stock embeddings the index holds
+FINE_TUNED = bool(preprocessing.load_metadata(MAIN_MODEL_FILE).get('fine_tuned_blocks'))
+reference_backbone = None
+
+def load_models():
+    """Load the backbone and main head (only the first call does any work)."""
+    global backbone, main_head
+    if backbone is None:
+        with metrics.timer('model_load'):
+            if BACKEND == 'tflite':
+                backbone = TFLiteModel(BACKBONE_FILE, TFLITE_THREADS)
+                main_head = TFLiteModel(head_model_path(MAIN_MODEL_FILE), TFLITE_THREADS)
+            else:
+                from tensorflow import keras
+
+                # Load main stone type model
+                main_model = keras.models.load_model(MAIN_MODEL_FILE)
+                backbone, main_head = split_model(main_model)
+        subtype_registry.backbone = backbone
+    return backbone, main_head
 
 def get_subtypes(stone_type):
     """Get available subtypes for a stone type."""
@@ -39,43 +96,130 @@ def get_subtypes(stone_type):
         return subtypes
     return []
 
-def predict_stone(image_path):
-    # Load and preprocess
-    img = Image.open(image_path).convert('RGB')
-    img = img.resize((224, 224))
-    img_array = np.array(img) / 255.0
-    img_array = np.expand_dims(img_array, axis=0)
-    
-    # Stage 1: Predict stone type
-    predictions = main_model.predict(img_array, verbose=0)
-    predicted_class = np.argmax(predictions[0])
-    confidence = predictions[0][predicted_class]
-    predicted_stone = class_names[predicted_class]
+def load_image(source):
+    """Load and preprocess an image (path or file object) for the classifiers."""
+    return preprocessing.load_image(source, version=PREPROCESSING_VERSION)
+
+def extract_features(img_batch):
+    """Backbone embeddings for a batch of preprocessed images."""
+    load_models()
+    with metrics.timer('backbone'):
+        return np.asarray(backbone.predict_on_batch(img_batch))
+
+def predict_batch(img_batch):
+    """
+    Two-stage prediction for a batch of preprocessed images.
+    The backbone runs once; its features feed the stone type head and then, grouped
+    by predicted stone type, the matching subtype head.
+    """
+    return classify_features(extract_features(img_batch), img_batch)
+
+def classify_features(features, img_batch):
+    """Stone type and subtype predictions from backbone features (img_batch feeds full subtype models)."""
+    with metrics.timer('main_predict'):
+        predictions = np.asarray(main_head.predict_on_batch(features))
+
+    with metrics.timer('postprocess'):
+        predicted = np.argmax(predictions, axis=1)
+        results = []
+        for i, probs in enumerate(predictions):
+            results.append({
+                'stone_type': class_names[predicted[i]],
+                'stone_type_index': int(predicted[i]),
+                'confidence': float(probs[predicted[i]]),
+                'probabilities': {class_names[j]: float(p) for j, p in enumerate(probs)},
+                'subtype': None,
+                'subtype_confidence': None,
+                'top3_subtypes': [],
+            })
+
+    # Stage 2: one call per stone type present in the batch
+    for stone_type in set(r['stone_type'] for r in results):
+        entry = subtype_registry.get(stone_type)
+        if entry is None:
+            continue
+        rows = [i for i, r in enumerate(results) if r['stone_type'] == stone_type]
+        with metrics.timer('subtype_predict'):
+            if entry.head is not None:
+                subtype_preds = entry.head.predict_on_batch(features[rows])
+            else:
+                subtype_preds = entry.model.predict_on_batch(img_batch[rows])
+            subtype_preds = np.asarray(subtype_preds)
+
+        with metrics.timer('postprocess'):
+            subtype_idx_to_name = entry.idx_to_name
+            for row, probs in zip(rows, subtype_preds):
+                subtype_idx = int(np.argmax(probs))
+                top3_indices = np.argsort(probs)[-3:][::-1]
+                results[row]['subtype'] = subtype_idx_to_name[subtype_idx]
+                results[row]['subtype_confidence'] = float(probs[subtype_idx])
+                results[row]['top3_subtypes'] = [(subtype_idx_to_name[j], float(probs[j])) for j in top3_indices]
+
+    for result in results:
+        metrics.record_prediction(result['confidence'])
+    return results
+
+def predict_stones(image_paths, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS):
+    """
+    Two-stage prediction for several image files. Images not in the prediction
+    cache are decoded and predicted batch_size at a time. An image that can't be
+    read gets {'image': path, 'error': message} instead of a prediction.
+    """
+    results = [None] * len(image_paths)
+    misses = []
+    for i, image_path in enumerate(image_paths):
+        try:
+            # Same SHA-256 as content_hash, without holding the file in memory
+            image_hash = file_hash(image_path)
+        except OSError as e:
+            metrics.inc('errors_total')
+            results[i] = {'error': str(e)}
+            continue
+        cached = prediction_cache.get(image_hash)
+        if cached is not None:
+            results[i] = dict(cached)
+        else:
+            misses.append((i, image_hash))
+
+    # Only images not seen before go through the models, one bounded batch at a time
+    done = 0
+    for chunk, img_batch, errors in iter_batches([image_paths[i] for i, _ in misses], batch_size,
+                                                 workers, version=PREPROCESSING_VERSION):
+        chunk_misses = misses[done:done + len(chunk)]
+        done += len(chunk)
+        predictions = iter(predict_batch(img_batch) if len(img_batch) else [])
+        for (i, image_hash), error in zip(chunk_misses, errors):
+            if error is not None:
+                metrics.inc('errors_total')
+                results[i] = {'error': error}
+                continue
+            result = next(predictions)
+            prediction_cache.put(image_hash, result)
+            results[i] = dict(result)
+
+    for image_path, result in zip(image_paths, results):
+        result['image'] = image_path
+    return results
+
+def print_prediction(result):
+    """Print a two-stage prediction result."""
+    if 'error' in result:
+        print(f"Image: {os.path.basename(result['image'])}")
+        print(f"Error: could not read image: {result['error']}")
+        return
+    predicted_stone = result['stone_type']
     
-    print(f"Image: {os.path.basename(image_path)}")
+    print(f"Image: {os.path.basename(result['image'])}")
     print(f"Predicted Stone Type: {predicted_stone}")
-    print(f"Stone Type Confidence: {confidence:.2%}")
+    print(f"Stone Type Confidence: {result['confidence']:.2%}")
     
-    # Stage 2: Predict subtype if model exists
-    if predicted_stone in subtype_models:
-        subtype_model = subtype_models[predicted_stone]
-        subtype_preds = subtype_model.predict(img_array, verbose=0)
-        subtype_idx = np.argmax(subtype_preds[0])
-        subtype_confidence = subtype_preds[0][subtype_idx]
-        
-        # Get subtype name
-        subtype_idx_to_name = {v: k for k, v in subtype_indices[predicted_stone].items()}
-        predicted_subtype = subtype_idx_to_name[subtype_idx]
-        
-        print(f"Predicted {predicted_stone} Subtype: {predicted_subtype}")
-        print(f"Subtype Confidence: {subtype_confidence:.2%}")
+    if result['subtype'] is not None:
+        print(f"Predicted {predicted_stone} Subtype: {result['subtype']}")
+        print(f"Subtype Confidence: {result['subtype_confidence']:.2%}")
         
         # Show top 3 subtypes
-        top3_indices = np.argsort(subtype_preds[0])[-3:][::-1]
         print(f"\nTop 3 {predicted_stone} subtypes:")
-        for idx in top3_indices:
-            subtype_name = subtype_idx_to_name[idx]
-            prob = subtype_preds[0][idx]
+        for subtype_name, prob in result['top3_subtypes']:
             print(f"  {subtype_name}: {prob:.2%}")
     else:
         # Show available subtypes if no model yet
@@ -86,29 +230,104 @@ def predict_stone(image_path):
                 print(f"  - {subtype}")
     
     print(f"\nAll stone type probabilities:")
-    for i, prob in enumerate(predictions[0]):
-        print(f"  {class_names[i]}: {prob:.2%}")
+    for class_name, prob in result['probabilities'].items():
+        print(f"  {class_name}: {prob:.2%}")
     print()
-    
-    return predicted_class, confidence
-
-# Test single image from test folder
-test_image = 'test/IMG_6893.jpeg'
-if os.path.exists(test_image):
-    print("Testing image from test folder:")
-    predict_stone(test_image)
-else:
-    print(f"Image not found: {test_image}")
-    print("\nAvailable images in test folder:")
-    for f in os.listdir('test/'):
-        if f.lower().endswith(('.jpg', '.jpeg', '.png')):
-            print(f"  - {f}")
-
-# OR test multiple images from test folder
-print("\n" + "="*50)
-print("Testing all images in test folder:")
-print("="*50)
-test_folder = 'test/'
-for img_file in os.listdir(test_folder):
-    if img_file.lower().endswith(('.jpg', '.jpeg', '.png')):
-        predict_stone(os.path.join(test_folder, img_file))
+
+def predict_stone(image_path):
+    result = predict_stones([image_path])[0]
+    print_prediction(result)
+    if 'error' in result:
+        return None, None
+    return result['stone_type_index'], result['confidence']
+
+def load_reference_index():
+    """The similar-stone reference index (built by reference_index.py), opened on first use."""
+    global reference_index
+    if reference_index is None:
+        from reference_index import ReferenceIndex
+        reference_index = ReferenceIndex(REFERENCE_INDEX_DIR)
+    return reference_index
+
+def reference_features(datas, version):
+    """Query embeddings in the reference index's feature space (stock backbone, its preprocessing)."""
+    global reference_backbone
+    img_batch = preprocessing.load_batch([io.BytesIO(d) for d in datas], version=version)
+    if not FINE_TUNED:
+        return extract_features(img_batch)
+    if reference_backbone is None:
+        from feature_cache import build_backbone
+        reference_backbone = build_backbone()
+    with metrics.timer('backbone'):
+        return np.asarray(reference_backbone.predict_on_batch(img_batch))
+
+def find_similar(images, k=5, by_subtype=True):
+    """
+    Two-stage prediction plus the k most similar training images for each image
+    (paths or bytes). Neighbours are restricted to the predicted stone type, and
+    to the predicted subtype when by_subtype is set and that subtype has references.
+    """
+    references = load_reference_index()
+    datas = []
+    for image in images:
+        if isinstance(image, bytes):
+            datas.append(image)
+        else:
+            with open(image, 'rb') as f:
+                datas.append(f.read())
+
+    img_batch = preprocessing.load_batch([io.BytesIO(d) for d in datas], version=PREPROCESSING_VERSION)
+    features = extract_features(img_batch)
+    results = classify_features(features, img_batch)
+    if FINE_TUNED or references.preprocessing_version != PREPROCESSING_VERSION:
+        features = reference_features(datas, references.preprocessing_version)
+
+    with metrics.timer('retrieval'):
+        neighbours = references.search(
+            features, k,
+            stone_types=[r['stone_type'] for r in results],
+            subtypes=[r['subtype'] if by_subtype else None for r in results]
+        )
+    for image, result, similar in zip(images, results, neighbours):
+        if not isinstance(image, bytes):
+            result['image'] = image
+        result['similar'] = similar
+    return results
+
+def print_similar(result):
+    print("Most similar reference images:")
+    for match in result['similar']:
+        label = match['stone_type'] + (f"/{match['subtype']}" if match['subtype'] else '')
+        print(f"  {match['similarity']:.3f}  [{label}] {match['image']}")
+    print()
+
+def similar_stones(image_path, k=5):
+    """Print the prediction and the k closest training images for one file."""
+    result = find_similar([image_path], k)[0]
+    print_prediction(result)
+    print_similar(result)
+    return result['similar']
+
+if __name__ == "__main__":
+    # Test single image from test folder
+    test_image = 'test/IMG_6893.jpeg'
+    if os.path.exists(test_image):
+        print("Testing image from test folder:")
+        predict_stone(test_image)
+    else:
+        print(f"Image not found: {test_image}")
+        print("\nAvailable images in test folder:")
+        for f in os.listdir('test/'):
+            if f.lower().endswith(('.jpg', '.jpeg', '.png')):
+                print(f"  - {f}")
+
+    # OR test multiple images from test folder
+    print("\n" + "="*50)
+    print("Testing all images in test folder:")
+    print("="*50)
+    test_folder = 'test/'
+    test_images = [os.path.join(test_folder, f) for f in os.listdir(test_folder)
+                   if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    if test_images:
+        for result in predict_stones(test_images):
+            print_prediction(result)
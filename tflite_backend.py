@@ -0,0 +1,58 @@
+"""
+TFLite inference backend.
+TFLiteModel wraps a .tflite artifact written by export_tflite.py behind the same
+predict_on_batch interface the Keras models expose, so the inference scripts
+can switch backends without other changes.
+"""
+import os
+
+import numpy as np
+
+BACKENDS = ('keras', 'tflite')
+BACKBONE_FILE = 'mobilenet_backbone.tflite'
+
+
+def full_model_path(h5_path):
+    """TFLite artifact for a whole classifier (image in, probabilities out)."""
+    return os.path.splitext(h5_path)[0] + '.tflite'
+
+
+def head_model_path(h5_path):
+    """TFLite artifact for a classifier's head (backbone features in)."""
+    return os.path.splitext(h5_path)[0] + '_head.tflite'
+
+
+class TFLiteModel:
+    """A TFLite interpreter with a Keras-like predict_on_batch."""
+
+    def __init__(self, model_path, num_threads=None):
+        import tensorflow as tf
+
+        self.model_path = model_path
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        # Resizing reallocates tensors, so only do it when the batch size changes
+        if batch.shape[0] != self._batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self._batch_size = batch.shape[0]
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+    def predict(self, batch, verbose=0):
+        return self.predict_on_batch(batch)
+
+
+def load_classifier(h5_path, backend='keras', num_threads=None):
+    """Load a whole classifier with the chosen backend."""
+    if backend == 'tflite':
+        return TFLiteModel(full_model_path(h5_path), num_threads)
+    from tensorflow import keras
+    return keras.models.load_model(h5_path)
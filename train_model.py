@@ -1,85 +1,46 @@
-import tensorflow as tf
-from tensorflow import keras
-from tensorflow.keras import layers
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-import json 
+"""
+Train the stone type classifier (frozen MobileNetV2 backbone + dense head).
+Usage: python train_model.py [--batch-size 256] [--intra-op-threads 32] [--config train.json]
+       python train_model.py --cached-features   (head only, on cached backbone features)
+See training.py for the shared settings.
+"""
+import argparse
+import json
 import os
 
-img_size= 224
-batch_size = 32
-epochs = 15
-data_dir = "Stone_Data"
+import training
 
+parser = training.add_arguments(argparse.ArgumentParser(description="Train the stone type classifier."))
+args = parser.parse_args()
+config = training.load_config(args)
+training.configure(config)
+
+data_dir = config['data_dir']
 train_dir = os.path.join(data_dir, 'train')
 val_dir = os.path.join(data_dir, 'val')
 
-train_datagen = ImageDataGenerator(
-    rescale = 1./255,
-    shear_range = 0.2,
-    zoom_range = 0.2,
-    rotation_range = 20,
-    width_shift_range = 0.2,
-    height_shift_range = 0.2,
-    brightness_range = [0.8,1.2],
-    horizontal_flip = True,
-    fill_mode = "nearest"
-)
-
-val_datagen = ImageDataGenerator(rescale = 1./255)
-
-train_generator = train_datagen.flow_from_directory(
-    train_dir,
-    target_size = (224,224),
-    batch_size = 32,
-    class_mode = "categorical"
-)
-
-val_generator = val_datagen.flow_from_directory(
-    val_dir,
-    target_size = (224,224),
-    batch_size = 32,
-    class_mode = "categorical"
-)
-
-num_classes = len(train_generator.class_indices)
-
-base_model = keras.applications.MobileNetV2(
-input_shape = (224,224,3),
-include_top = False,
-weights = 'imagenet'
-)
-
-base_model.trainable = False
-
-model = keras.Sequential([
-    base_model,
-    layers.GlobalAveragePooling2D(),
-    layers.Dropout(0.3),
-    layers.Dense(256, activation = 'relu'),
-    layers.Dropout(.3),
-    layers.Dense(128, activation = 'relu'),
-    layers.Dropout(.2),
-    layers.Dense(num_classes, activation = 'softmax')
-])
+if config['cached_features']:
+    model, class_indices = training.fit_cached_head(train_dir, val_dir, config)
+    run_dir, fine_tuned_blocks = None, 0
+else:
+    train_ds, val_ds, class_indices, train_samples = training.load_datasets(
+        train_dir, val_dir, config, augment=True
+    )
 
-model.compile(
-    optimizer = keras.optimizers.Adam(learning_rate=0.001),
-    loss = 'categorical_crossentropy',
-    metrics = ['accuracy']
-)
+    model = training.build_classifier(len(class_indices))
+    training.compile_model(model, config)
 
-history = model.fit(
-    train_generator,
-    epochs = epochs,
-    validation_data = val_generator,
-    verbose = 1
-)
+    run_dir, fine_tuned_blocks = training.fit(model, train_ds, val_ds, config, 'stone_classifier_model',
+                                              train_samples, train_dir=train_dir)
 
-model.save('stone_classifier_model.h5')
+num_classes = len(class_indices)
+training.save_classifier(model, 'stone_classifier_model.h5', class_indices, num_classes,
+                         fine_tuned_blocks=fine_tuned_blocks)
+training.clear_checkpoints(run_dir)
 
 with open('class_indices.json', 'w') as f:
-    json.dump(train_generator.class_indices, f)
+    json.dump(class_indices, f)
 
 print("Model training completed and saved")
 print(f"Classes: {num_classes}")
-print(f"Class indices: {train_generator.class_indices}")
+print(f"Class indices: {class_indices}")
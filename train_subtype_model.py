@@ -2,23 +2,128 @@
 Train subtype classifier for a specific stone type.
 Usage: python train_subtype_model.py <stone_type>
 Example: python train_subtype_model.py marble
+         python train_subtype_model.py marble --cached-features   (head only, on cached features)
+
+Train every stone type that has subtype folders in one run:
+       python train_subtype_model.py --all [--augmented-copies N]
+The backbone runs once per image (embeddings are kept in the feature cache) and
+each subtype head is trained on those features.
+
+See training.py for the shared settings (batch size, threads, precision, XLA).
 """
-import tensorflow as tf
-from tensorflow import keras
-from tensorflow.keras import layers
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
+import argparse
 import json
 import os
 import sys
+
 import numpy as np
 
-if len(sys.argv) < 2:
-    print("Usage: python train_subtype_model.py <stone_type>")
+import training
+
+def augmented_features(backbone, directory, copies, batch_size=32):
+    """Backbone features for `copies` randomly augmented passes over directory."""
+    from data_pipeline import build_dataset, DEFAULT_AUGMENTATION
+
+    features, labels = [], []
+    for _ in range(copies):
+        ds, _, _ = build_dataset(directory, batch_size=batch_size,
+                                 augmentation=DEFAULT_AUGMENTATION, shuffle=False)
+        for images, one_hot in ds:
+            features.append(np.asarray(backbone.predict_on_batch(images)))
+            labels.append(np.argmax(one_hot, axis=1))
+    return np.concatenate(features), np.concatenate(labels).astype(np.int32)
+
+def train_all_subtypes(config, augmented_copies=0):
+    """Train a head for every stone type with subtype folders, sharing one backbone."""
+    from dataset_shards import subtype_dirs
+    from feature_cache import FeatureCache, build_backbone, load_labeled_features, train_head, attach_head
+
+    data_dir = config['data_dir']
+    train_root = os.path.join(data_dir, 'train')
+    stone_types = [os.path.basename(d) for d in subtype_dirs(train_root)]
+    if not stone_types:
+        print(f"No stone types with subtype folders found in {train_root}")
+        return
+    print(f"Training subtype heads for: {', '.join(stone_types)}")
+
+    cache = FeatureCache()
+    backbone = build_backbone()
+    learning_rate = training.scaled_learning_rate(config)
+
+    for stone_type in stone_types:
+        train_dir = os.path.join(data_dir, 'train', stone_type)
+        val_dir = os.path.join(data_dir, 'val', stone_type)
+        print(f"\n{'='*60}\n{stone_type}\n{'='*60}")
+
+        x_train, y_train, class_indices = load_labeled_features(cache, backbone, train_dir)
+        if augmented_copies:
+            x_aug, y_aug = augmented_features(backbone, train_dir, augmented_copies, config['batch_size'])
+            x_train = np.concatenate([x_train, x_aug])
+            y_train = np.concatenate([y_train, y_aug])
+        validation_data = None
+        if os.path.isdir(val_dir):
+            x_val, y_val, val_indices = load_labeled_features(cache, backbone, val_dir)
+            if val_indices == class_indices and len(y_val):
+                validation_data = (x_val, y_val)
+            else:
+                print(f"Skipping validation for {stone_type}: val subtypes don't match train")
+
+        num_classes = len(class_indices)
+        if num_classes < 2 or len(y_train) == 0:
+            print(f"Skipping {stone_type}: need at least two subtypes with images")
+            continue
+
+        # Inverse frequency class weights, as in single-stone mode
+        counts = np.bincount(y_train, minlength=num_classes)
+        class_weights = {i: len(y_train) / (num_classes * c) for i, c in enumerate(counts) if c > 0}
+        for subtype, idx in class_indices.items():
+            print(f"  {subtype}: {counts[idx]} training samples")
+
+        head = train_head(x_train, y_train, num_classes, class_weights, epochs=config['epochs'],
+                          batch_size=config['batch_size'], validation_data=validation_data,
+                          learning_rate=learning_rate, jit_compile=bool(config['xla']),
+                          callbacks=training.head_callbacks(config, len(y_train), validation_data is not None))
+
+        # Saved with the backbone attached, same layout as single-stone training
+        model = attach_head(backbone, head)
+        model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+        model_filename = f'{stone_type}_subtype_model.h5'
+        training.save_classifier(model, model_filename, class_indices, num_classes,
+                                 version=cache.settings['version'])
+        indices_filename = f'{stone_type}_subtype_indices.json'
+        with open(indices_filename, 'w') as f:
+            json.dump(class_indices, f, indent=2)
+        print(f"Model saved as: {model_filename}")
+        print(f"Class indices saved as: {indices_filename}")
+
+parser = argparse.ArgumentParser(
+    description="Train subtype classifiers.",
+    epilog="Example: python train_subtype_model.py marble",
+)
+parser.add_argument('stone_type', nargs='?', default=None, help="Stone type to train subtypes for")
+parser.add_argument('--all', action='store_true',
+                    help="Train a head for every stone type with subtype folders (cached features)")
+parser.add_argument('--augmented-copies', type=int, default=0,
+                    help="With --all, extra augmented passes over the training images (default: 0)")
+training.add_arguments(parser)
+args = parser.parse_args()
+config = training.load_config(args)
+
+if args.all:
+    config['cached_features'] = True
+    if config['fine_tune_blocks']:
+        print("Ignoring --fine-tune-blocks with --all: heads are trained on cached backbone features")
+    training.configure(config)
+    train_all_subtypes(config, augmented_copies=args.augmented_copies)
+    sys.exit(0)
+
+if args.stone_type is None:
+    parser.print_usage()
     print("Example: python train_subtype_model.py marble")
     sys.exit(1)
 
-stone_type = sys.argv[1].lower()
-data_dir = "Stone_Data"
+stone_type = args.stone_type.lower()
+data_dir = config['data_dir']
 train_dir = os.path.join(data_dir, 'train', stone_type)
 val_dir = os.path.join(data_dir, 'val', stone_type)
 
@@ -34,143 +139,51 @@ print(f"Training {stone_type} subtype classifier...")
 print(f"Train directory: {train_dir}")
 print(f"Val directory: {val_dir}")
 
-img_size = 224
-batch_size = 32
-epochs = 15
-
-train_datagen = ImageDataGenerator(
-    rescale=1./255,
-    shear_range=0.2,
-    zoom_range=0.2,
-    rotation_range=20,
-    width_shift_range=0.2,
-    height_shift_range=0.2,
-    brightness_range=[0.8, 1.2],
-    horizontal_flip=True,
-    fill_mode="nearest"
-)
+# Clean corrupted images
+training.report_corrupted(data_dir, train_dir, val_dir)
 
-val_datagen = ImageDataGenerator(rescale=1./255)
+training.configure(config)
 
-# Clean corrupted images
-print("\nChecking for corrupted images...")
-from PIL import Image
-import glob
-
-def check_corrupted_images(directory):
-    """Check for corrupted image files without deleting."""
-    corrupted = []
-    image_extensions = ['*.jpg', '*.jpeg', '*.png', '*.JPG', '*.JPEG', '*.PNG']
-    
-    for ext in image_extensions:
-        for img_path in glob.glob(os.path.join(directory, '**', ext), recursive=True):
-            try:
-                img = Image.open(img_path)
-                img.load()
-                img.close()
-            except Exception as e:
-                if "UnidentifiedImageError" in str(type(e).__name__) or "cannot identify" in str(e).lower():
-                    corrupted.append(img_path)
-    
-    return corrupted
-
-corrupted_train = check_corrupted_images(train_dir)
-corrupted_val = check_corrupted_images(val_dir)
-
-if corrupted_train or corrupted_val:
-    print(f"WARNING: Found {len(corrupted_train)} corrupted images in train, {len(corrupted_val)} in val")
-    print("These will be skipped during training.")
-
-train_generator = train_datagen.flow_from_directory(
-    train_dir,
-    target_size=(img_size, img_size),
-    batch_size=batch_size,
-    class_mode='categorical'
-)
+if config['cached_features']:
+    model, class_indices = training.fit_cached_head(train_dir, val_dir, config, weighted=True)
+    run_dir, fine_tuned_blocks = None, 0
+    num_classes = len(class_indices)
+else:
+    # Pre-decoded shards are used when dataset_shards.py --subtypes has been run
+    train_ds, val_ds, class_indices, train_samples = training.load_datasets(train_dir, val_dir, config)
 
-val_generator = val_datagen.flow_from_directory(
-    val_dir,
-    target_size=(img_size, img_size),
-    batch_size=batch_size,
-    class_mode='categorical'
-)
+    num_classes = len(class_indices)
+    print(f"\nFound {num_classes} {stone_type} subtypes:")
+    for subtype, idx in class_indices.items():
+        print(f"  {idx}: {subtype}")
 
-num_classes = len(train_generator.class_indices)
-print(f"\nFound {num_classes} {stone_type} subtypes:")
-for subtype, idx in train_generator.class_indices.items():
-    print(f"  {idx}: {subtype}")
-
-# Calculate class weights
-print("\nCalculating class weights...")
-class_counts = {}
-for subtype, subtype_idx in train_generator.class_indices.items():
-    subtype_dir = os.path.join(train_dir, subtype)
-    if os.path.exists(subtype_dir):
-        count = 0
-        for root, dirs, files in os.walk(subtype_dir):
-            for file in files:
-                if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    count += 1
-        class_counts[subtype] = count
-        print(f"  {subtype}: {count} images")
-
-total_samples = sum(class_counts.values())
-class_weights = {}
-for subtype, subtype_idx in train_generator.class_indices.items():
-    if subtype in class_counts and class_counts[subtype] > 0:
-        weight = total_samples / (num_classes * class_counts[subtype])
-        class_weights[subtype_idx] = weight
-        print(f"  {subtype} (idx {subtype_idx}): weight = {weight:.3f}")
-
-print("\nClass weights:", class_weights)
-
-# Build model
-base_model = keras.applications.MobileNetV2(
-    input_shape=(img_size, img_size, 3),
-    include_top=False,
-    weights='imagenet'
-)
+    # Calculate class weights
+    print("\nCalculating class weights...")
+    class_weights, _ = training.class_weights_for(train_dir, class_indices)
 
-base_model.trainable = False
-
-model = keras.Sequential([
-    base_model,
-    layers.GlobalAveragePooling2D(),
-    layers.Dropout(0.3),
-    layers.Dense(256, activation='relu'),
-    layers.Dropout(0.3),
-    layers.Dense(128, activation='relu'),
-    layers.Dropout(0.2),
-    layers.Dense(num_classes, activation='softmax')
-])
-
-model.compile(
-    optimizer=keras.optimizers.Adam(learning_rate=0.001),
-    loss='categorical_crossentropy',
-    metrics=['accuracy']
-)
+    print("\nClass weights:", class_weights)
 
-print(f"\nStarting training for {stone_type} subtypes...")
-history = model.fit(
-    train_generator,
-    epochs=epochs,
-    validation_data=val_generator,
-    class_weight=class_weights,
-    verbose=1
-)
+    # Build model
+    model = training.build_classifier(num_classes)
+    training.compile_model(model, config)
+
+    print(f"\nStarting training for {stone_type} subtypes...")
+    run_dir, fine_tuned_blocks = training.fit(model, train_ds, val_ds, config, f'{stone_type}_subtype_model',
+                                              train_samples, class_weight=class_weights, train_dir=train_dir)
 
 # Save model
 model_filename = f'{stone_type}_subtype_model.h5'
-model.save(model_filename)
+training.save_classifier(model, model_filename, class_indices, num_classes,
+                         fine_tuned_blocks=fine_tuned_blocks)
+training.clear_checkpoints(run_dir)
 
 # Save class indices
 indices_filename = f'{stone_type}_subtype_indices.json'
 with open(indices_filename, 'w') as f:
-    json.dump(train_generator.class_indices, f, indent=2)
+    json.dump(class_indices, f, indent=2)
 
 print(f"\nModel training completed!")
 print(f"Model saved as: {model_filename}")
 print(f"Class indices saved as: {indices_filename}")
 print(f"Classes: {num_classes}")
-print(f"Class indices: {train_generator.class_indices}")
-
+print(f"Class indices: {class_indices}")
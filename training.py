@@ -0,0 +1,587 @@
+"""
+Shared setup for the train_*.py scripts.
+Settings come from DEFAULTS, then an optional JSON config file (--config), then
+command-line flags, so a node can keep its thread counts in a file while a run
+overrides the batch size.
+
+configure() must run before any model is built: it sets TensorFlow's thread
+pools and, on CPUs with native bfloat16 (AVX512_BF16 or AMX), the
+mixed_bfloat16 policy. Models are always saved in float32, so serving and the
+TFLite export are unaffected by how they were trained.
+
+Larger batches keep a big CPU node busy; the learning rate is scaled from
+base_batch_size (sqrt scaling by default, which suits Adam better than linear).
+
+fit() checkpoints weights and optimizer state to checkpoint_dir/<model name>
+every epoch (or every checkpoint_every batches), so rerunning a crashed or
+preempted command continues where it stopped (checkpoints from a run with other
+images, classes or settings are discarded instead). It stops early once the monitored
+validation metric hasn't improved for `patience` epochs, keeps the best weights,
+and with fine_tune_blocks > 0 adds a second phase that unfreezes the top
+MobileNetV2 blocks at a lower learning rate.
+
+With cached_features, only the head is trained, on backbone embeddings from
+feature_cache.py. There is no augmentation or fine-tuning (both change what the
+backbone sees), but the backbone runs once per image across all runs and
+heads, so retraining the head takes seconds.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from preprocessing import IMG_SIZE, CURRENT_VERSION, save_metadata
+
+DEFAULTS = {
+    'data_dir': 'Stone_Data',
+    'epochs': 15,
+    'batch_size': 32,
+    # learning_rate is tuned for base_batch_size; other batch sizes are scaled from it
+    'learning_rate': 0.001,
+    'base_batch_size': 32,
+    'lr_scaling': 'sqrt',
+    # 0 keeps TensorFlow's default (one thread per core for intra-op)
+    'intra_op_threads': 0,
+    'inter_op_threads': 0,
+    # 'auto' uses bfloat16 only where the CPU supports it natively
+    'mixed_precision': 'auto',
+    'xla': False,
+    # Optional decoded-image cache: 'memory' or a file path
+    'data_cache': os.environ.get('DATA_CACHE'),
+    'checkpoint_dir': 'checkpoints',
+    # 0 checkpoints at the end of every epoch; N every N batches (for preemptible nodes)
+    'checkpoint_every': 0,
+    'resume': True,
+    'monitor': 'val_loss',
+    # Epochs without improvement before stopping; 0 always runs every epoch
+    'patience': 3,
+    'min_delta': 0.001,
+    # MobileNetV2 blocks (counted from the top, 1..16) unfrozen after the head is trained
+    'fine_tune_blocks': 0,
+    'fine_tune_epochs': 10,
+    'fine_tune_learning_rate': 0.00001,
+    # Train the head alone on cached backbone features (no augmentation or fine-tuning)
+    'cached_features': False,
+}
+
+# MobileNetV2's inverted residual blocks are named block_1_* .. block_16_*
+MOBILENET_BLOCKS = 16
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def add_arguments(parser):
+    """Add the shared training flags. Unset flags fall back to --config, then DEFAULTS."""
+    group = parser.add_argument_group('training')
+    group.add_argument('--config', metavar='JSON_FILE', default=None,
+                       help="JSON file with any of: " + ', '.join(sorted(DEFAULTS)))
+    group.add_argument('--data-dir', default=None, help=f"Dataset root (default: {DEFAULTS['data_dir']})")
+    group.add_argument('--epochs', type=int, default=None, help=f"(default: {DEFAULTS['epochs']})")
+    group.add_argument('--batch-size', type=int, default=None, help=f"(default: {DEFAULTS['batch_size']})")
+    group.add_argument('--learning-rate', type=float, default=None,
+                       help=f"Learning rate at --base-batch-size (default: {DEFAULTS['learning_rate']})")
+    group.add_argument('--base-batch-size', type=int, default=None,
+                       help=f"Batch size the learning rate is tuned for (default: {DEFAULTS['base_batch_size']})")
+    group.add_argument('--lr-scaling', choices=['sqrt', 'linear', 'none'], default=None,
+                       help=f"How the learning rate follows the batch size (default: {DEFAULTS['lr_scaling']})")
+    group.add_argument('--intra-op-threads', type=int, default=None,
+                       help="Threads per TensorFlow op (default: TensorFlow's choice)")
+    group.add_argument('--inter-op-threads', type=int, default=None,
+                       help="TensorFlow ops run concurrently (default: TensorFlow's choice)")
+    group.add_argument('--mixed-precision', choices=['auto', 'bf16', 'off'], default=None,
+                       help="bfloat16 compute: auto (if the CPU supports it), bf16 (always) or off")
+    group.add_argument('--xla', action=argparse.BooleanOptionalAction, default=None,
+                       help="Compile the training step with XLA")
+    group.add_argument('--checkpoint-dir', default=None,
+                       help=f"Where run checkpoints are kept (default: {DEFAULTS['checkpoint_dir']})")
+    group.add_argument('--checkpoint-every', type=int, default=None, metavar='BATCHES',
+                       help="Also checkpoint every BATCHES batches, not just every epoch")
+    group.add_argument('--resume', action=argparse.BooleanOptionalAction, default=None,
+                       help="Continue from the last checkpoint of this model, if any (default: yes)")
+    group.add_argument('--monitor', default=None,
+                       help=f"Validation metric for early stopping and best weights (default: {DEFAULTS['monitor']})")
+    group.add_argument('--patience', type=int, default=None,
+                       help=f"Epochs without improvement before stopping, 0 to disable (default: {DEFAULTS['patience']})")
+    group.add_argument('--fine-tune-blocks', type=int, default=None,
+                       help="Unfreeze this many top MobileNetV2 blocks in a second phase (default: 0, off)")
+    group.add_argument('--fine-tune-epochs', type=int, default=None,
+                       help=f"Epochs in the fine-tuning phase (default: {DEFAULTS['fine_tune_epochs']})")
+    group.add_argument('--fine-tune-learning-rate', type=float, default=None,
+                       help=f"Fine-tuning learning rate at --base-batch-size "
+                            f"(default: {DEFAULTS['fine_tune_learning_rate']})")
+    group.add_argument('--cached-features', action=argparse.BooleanOptionalAction, default=None,
+                       help="Train only the head on cached backbone features (feature_cache.py); "
+                            "no augmentation or fine-tuning")
+    return parser
+
+
+def load_config(args):
+    """Settings dict from DEFAULTS, args.config and the flags that were given."""
+    config = dict(DEFAULTS)
+    if args.config:
+        with open(args.config, 'r') as f:
+            overrides = json.load(f)
+        unknown = set(overrides) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown settings in {args.config}: {', '.join(sorted(unknown))}")
+        config.update(overrides)
+    for key in DEFAULTS:
+        value = getattr(args, key, None)
+        if value is not None:
+            config[key] = value
+    return config
+
+
+def cpu_supports_bf16():
+    """True if the CPU has native bfloat16 instructions (Linux only; False elsewhere)."""
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    flags = set(line.split(':', 1)[1].split())
+                    return bool(flags & {'avx512_bf16', 'amx_bf16'})
+    except OSError:
+        pass
+    return False
+
+
+def configure(config):
+    """Apply thread and precision settings. Returns the precision policy name."""
+    import tensorflow as tf
+    from tensorflow import keras
+
+    if config['intra_op_threads']:
+        tf.config.threading.set_intra_op_parallelism_threads(config['intra_op_threads'])
+    if config['inter_op_threads']:
+        tf.config.threading.set_inter_op_parallelism_threads(config['inter_op_threads'])
+
+    mode = config['mixed_precision']
+    if config['cached_features'] and mode != 'off':
+        # Cached features are float32; bfloat16 ones would be stored under the same key
+        mode = 'off'
+    policy = 'float32'
+    if mode == 'bf16' or (mode == 'auto' and cpu_supports_bf16()):
+        policy = 'mixed_bfloat16'
+    keras.mixed_precision.set_global_policy(policy)
+
+    print(f"Threads: intra-op {config['intra_op_threads'] or 'default'}, "
+          f"inter-op {config['inter_op_threads'] or 'default'}; precision: {policy}; "
+          f"XLA: {'on' if config['xla'] else 'off'}")
+    return policy
+
+
+def scaled_learning_rate(config, key='learning_rate'):
+    """config[key] adjusted for config['batch_size']."""
+    ratio = config['batch_size'] / config['base_batch_size']
+    if config['lr_scaling'] == 'linear':
+        return config[key] * ratio
+    if config['lr_scaling'] == 'sqrt':
+        return config[key] * ratio ** 0.5
+    return config[key]
+
+
+def build_classifier(num_classes, img_size=IMG_SIZE, weights='imagenet'):
+    """Frozen MobileNetV2 + GAP + the standard head, the layout every saved classifier uses."""
+    from feature_cache import build_backbone, build_head, attach_head
+
+    return attach_head(build_backbone(img_size, weights), build_head(num_classes))
+
+
+def compile_model(model, config, loss='categorical_crossentropy', learning_rate_key='learning_rate'):
+    from tensorflow import keras
+
+    learning_rate = scaled_learning_rate(config, learning_rate_key)
+    print(f"Batch size {config['batch_size']}, learning rate {learning_rate:g}")
+    model.compile(
+        optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
+        loss=loss,
+        metrics=['accuracy'],
+        jit_compile=bool(config['xla'])
+    )
+    return model
+
+
+def throughput_callback(samples):
+    """Keras callback printing images/sec after each epoch (also added to the epoch logs)."""
+    from tensorflow import keras
+
+    class Throughput(keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.perf_counter()
+            self.train_end = None
+
+        def on_test_begin(self, logs=None):
+            # Validation runs at the end of the epoch; it isn't training throughput
+            if self.train_end is None:
+                self.train_end = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            now = time.perf_counter()
+            elapsed = (self.train_end or now) - self.start
+            rate = samples / elapsed if elapsed > 0 else 0.0
+            if logs is not None:
+                logs['images_per_sec'] = rate
+            print(f"Epoch {epoch + 1}: {rate:.1f} images/sec ({elapsed:.1f}s training, "
+                  f"{now - self.start:.1f}s with validation)")
+
+    return Throughput()
+
+
+def load_datasets(train_dir, val_dir, config, augment=True):
+    """
+    Training and validation datasets. With augment, training batches get the same
+    augmentation the ImageDataGenerator pipeline used.
+    Returns (train_ds, val_ds, class_indices, train_samples).
+    """
+    from data_pipeline import build_dataset, DEFAULT_AUGMENTATION
+
+    # Pre-decoded shards are used when dataset_shards.py has been run
+    train_ds, class_indices, train_samples = build_dataset(
+        train_dir,
+        batch_size=config['batch_size'],
+        augmentation=DEFAULT_AUGMENTATION if augment else None,
+        cache=config['data_cache']
+    )
+    val_ds, _, _ = build_dataset(
+        val_dir,
+        batch_size=config['batch_size'],
+        shuffle=False,
+        cache=config['data_cache'] and 'memory'
+    )
+    return train_ds, val_ds, class_indices, train_samples
+
+
+def report_corrupted(data_dir, *directories):
+    """Warn about corrupted images under directories (incremental manifest scan). Returns the count."""
+    from find_corrupted_images import scan, corrupted_in
+
+    print("\nChecking for corrupted images...")
+    # Only new or changed files are checked; results are kept in image_manifest.json
+    manifest = scan(data_dir)
+    found = [corrupted_in(manifest, d) for d in directories]
+    for corrupted in found:
+        for img_path, error in corrupted:
+            print(f"Found corrupted image: {img_path}")
+    total = sum(len(c) for c in found)
+    if total:
+        print(f"\nWARNING: Found {total} corrupted images. They will be skipped during training.")
+        print("To see the list, run: python3 find_corrupted_images.py")
+    else:
+        print("No corrupted images found.")
+    return total
+
+
+def count_images(directory):
+    """Image files under directory, recursively."""
+    count = 0
+    for root, dirs, files in os.walk(directory):
+        count += sum(1 for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    return count
+
+
+def class_weights_for(train_dir, class_indices):
+    """Inverse frequency class weights from the image count in each class folder."""
+    counts = {}
+    for class_name in class_indices:
+        class_dir = os.path.join(train_dir, class_name)
+        if os.path.exists(class_dir):
+            counts[class_name] = count_images(class_dir)
+            print(f"  {class_name}: {counts[class_name]} images")
+        else:
+            print(f"  Warning: {class_dir} not found")
+
+    total = sum(counts.values())
+    num_classes = len(class_indices)
+    weights = {}
+    for class_name, class_idx in class_indices.items():
+        if counts.get(class_name):
+            weights[class_idx] = total / (num_classes * counts[class_name])
+            print(f"  {class_name} (idx {class_idx}): weight = {weights[class_idx]:.3f}")
+        else:
+            print(f"  Warning: No images found for {class_name}, using default weight")
+            weights[class_idx] = 1.0
+    return weights, total
+
+
+def save_classifier(model, path, class_indices, num_classes, version=CURRENT_VERSION,
+                    fine_tuned_blocks=0):
+    """
+    Save model (and its preprocessing metadata) in float32. A model trained
+    under mixed_bfloat16 is rebuilt in float32 and its weights copied over.
+    fine_tuned_blocks is recorded so users of the backbone know it is no
+    longer the stock ImageNet one.
+    """
+    from tensorflow import keras
+
+    if keras.mixed_precision.global_policy().name != 'float32':
+        keras.mixed_precision.set_global_policy('float32')
+        float32_model = build_classifier(num_classes, weights=None)
+        float32_model.build(model.input_shape)
+        float32_model.set_weights(model.get_weights())
+        float32_model.compile(optimizer='adam', loss=model.loss, metrics=['accuracy'])
+        model = float32_model
+    model.save(path)
+    # Records the preprocessing version the model must be served with
+    save_metadata(path, class_indices, version, fine_tuned_blocks=fine_tuned_blocks)
+    return model
+
+
+def head_callbacks(config, samples, validation=True):
+    """Callbacks for head-only training on cached features: throughput and early stopping."""
+    from tensorflow import keras
+
+    callbacks = [throughput_callback(samples)]
+    if validation and config['patience']:
+        callbacks.append(keras.callbacks.EarlyStopping(
+            monitor=config['monitor'], patience=config['patience'], min_delta=config['min_delta'],
+            restore_best_weights=True, verbose=1))
+    return callbacks
+
+
+def fit_cached_head(train_dir, val_dir, config, weighted=False):
+    """
+    Train a head on cached backbone features (config['cached_features']) and
+    attach it to the backbone, giving the same layout as build_classifier.
+    Retraining takes seconds instead of hours because the backbone only runs on
+    images not yet in the cache, but there is no augmentation or fine-tuning.
+    weighted uses inverse frequency class weights. Returns (model, class_indices).
+    """
+    from feature_cache import FeatureCache, build_backbone, load_labeled_features, train_head, attach_head
+
+    if config['fine_tune_blocks']:
+        print("Ignoring fine_tune_blocks: with cached features only the head is trained")
+    cache = FeatureCache()
+    backbone = build_backbone()
+    print(f"\nLoading cached features for {train_dir} (new images go through the backbone once)")
+    x_train, y_train, class_indices = load_labeled_features(cache, backbone, train_dir)
+    num_classes = len(class_indices)
+    print(f"Found {len(y_train)} images belonging to {num_classes} classes.")
+
+    validation_data = None
+    if os.path.isdir(val_dir):
+        x_val, y_val, val_indices = load_labeled_features(cache, backbone, val_dir)
+        if val_indices == class_indices and len(y_val):
+            validation_data = (x_val, y_val)
+        else:
+            print(f"Skipping validation: classes in {val_dir} don't match {train_dir}")
+
+    class_weight = None
+    if weighted:
+        counts = np.bincount(y_train, minlength=num_classes)
+        class_weight = {i: len(y_train) / (num_classes * c) for i, c in enumerate(counts) if c > 0}
+        print("\nClass weights:", class_weight)
+
+    learning_rate = scaled_learning_rate(config)
+    print(f"Batch size {config['batch_size']}, learning rate {learning_rate:g}")
+    head = train_head(x_train, y_train, num_classes, class_weight, epochs=config['epochs'],
+                      batch_size=config['batch_size'], validation_data=validation_data,
+                      learning_rate=learning_rate, jit_compile=bool(config['xla']),
+                      callbacks=head_callbacks(config, len(y_train), validation_data is not None))
+
+    model = attach_head(backbone, head)
+    model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+    return model, class_indices
+
+
+def unfreeze_top_blocks(model, blocks):
+    """
+    Make the top `blocks` MobileNetV2 blocks (and the final 1x1 conv) trainable.
+    BatchNorm layers stay frozen, so they keep running in inference mode.
+    """
+    from tensorflow import keras
+
+    base = model.layers[0]
+    first = MOBILENET_BLOCKS + 1 - blocks
+    base.trainable = True
+    for layer in base.layers:
+        if layer.name.startswith('block_'):
+            top = int(layer.name.split('_')[1]) >= first
+        else:
+            top = layer.name.startswith(('Conv_1', 'out_relu'))
+        layer.trainable = top and not isinstance(layer, keras.layers.BatchNormalization)
+    trainable = sum(int(np.prod(w.shape)) for w in base.trainable_weights)
+    print(f"Fine-tuning the top {blocks} MobileNetV2 blocks ({trainable:,} backbone parameters)")
+
+
+class RunState:
+    """
+    Progress of a training run that survives restarts: finished phases and the
+    best epoch so far (its value and the phase that produced it).
+    """
+
+    def __init__(self, run_dir):
+        self.path = os.path.join(run_dir, 'state.json')
+        self.best_path = os.path.join(run_dir, 'best_weights.npz')
+        self.data = {'completed': [], 'phase': None, 'best': None, 'best_phase': None, 'wait': 0}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.data = json.load(f)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+    def save_best(self, model):
+        tmp_path = self.best_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, *model.get_weights())
+        os.replace(tmp_path, self.best_path)
+
+    def restore_best(self, model):
+        """Load the best weights into model. Returns False if none were saved."""
+        if not os.path.exists(self.best_path):
+            return False
+        with np.load(self.best_path) as saved:
+            model.set_weights([saved[f'arr_{i}'] for i in range(len(saved.files))])
+        return True
+
+
+def best_weights_callback(state, monitor, patience, min_delta):
+    """
+    Saves the weights whenever `monitor` improves and stops training after
+    `patience` epochs without improvement. Its state lives in a RunState, so
+    a resumed run keeps both the best value and the patience count.
+    """
+    from tensorflow import keras
+
+    lower_is_better = 'loss' in monitor
+
+    class BestWeights(keras.callbacks.Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            value = (logs or {}).get(monitor)
+            if value is None:
+                print(f"WARNING: '{monitor}' is not in the epoch logs; not tracking best weights")
+                return
+            value = float(value)
+            best = state['best']
+            if best is None or (value < best - min_delta if lower_is_better else value > best + min_delta):
+                state['best'] = value
+                state['best_phase'] = state['phase']
+                state['wait'] = 0
+                state.save_best(self.model)
+                print(f"New best {monitor}: {value:.4f}")
+            else:
+                state['wait'] += 1
+                if patience and state['wait'] >= patience:
+                    print(f"No {monitor} improvement for {patience} epochs, stopping this phase")
+                    self.model.stop_training = True
+            state.save()
+
+    return BestWeights()
+
+
+# Settings a checkpoint is only valid for; epochs and checkpoint_every may change between runs
+RUN_SETTINGS = ('data_dir', 'batch_size', 'base_batch_size', 'learning_rate', 'lr_scaling',
+                'monitor', 'min_delta', 'fine_tune_blocks', 'fine_tune_learning_rate')
+
+
+def run_fingerprint(config, train_dir, samples, class_weight):
+    """What a run's checkpoints depend on: the training images, classes and settings."""
+    from tensorflow import keras
+    from dataset_shards import list_labeled_images, source_fingerprint
+
+    fingerprint = {
+        'settings': {key: config[key] for key in RUN_SETTINGS},
+        'precision': keras.mixed_precision.global_policy().name,
+        'samples': samples,
+        'class_weight': {str(k): float(v) for k, v in (class_weight or {}).items()},
+    }
+    if train_dir is not None:
+        paths, labels, class_indices = list_labeled_images(train_dir)
+        fingerprint['class_indices'] = class_indices
+        fingerprint['images'] = source_fingerprint(train_dir, paths, labels)
+    return fingerprint
+
+
+def fit(model, train_ds, val_ds, config, run_name, samples, class_weight=None, train_dir=None):
+    """
+    Train model in up to two phases (head, then fine-tuning if fine_tune_blocks),
+    checkpointing to checkpoint_dir/run_name so a rerun resumes, and leave the
+    best weights seen in model. Checkpoints from a run with other training
+    images (train_dir), classes or settings are discarded rather than resumed.
+    Returns (run directory, fine-tuned blocks of the weights left in model): pass
+    the first to clear_checkpoints once the model is saved, the second to
+    save_classifier (0 when the best weights came from the head phase).
+    """
+    from tensorflow import keras
+
+    run_dir = os.path.join(config['checkpoint_dir'], run_name)
+    fingerprint = run_fingerprint(config, train_dir, samples, class_weight)
+    if os.path.exists(run_dir):
+        if not config['resume']:
+            shutil.rmtree(run_dir)
+        elif RunState(run_dir).data.get('fingerprint') != fingerprint:
+            print(f"WARNING: checkpoints in {run_dir} are from a run with different data, classes "
+                  f"or settings; starting {run_name} from scratch")
+            shutil.rmtree(run_dir)
+    os.makedirs(run_dir, exist_ok=True)
+    state = RunState(run_dir)
+    if state.data.get('fingerprint') is None:
+        state['fingerprint'] = fingerprint
+        state.save()
+    if state['completed'] or state['phase']:
+        print(f"Resuming {run_name} from {run_dir} (finished phases: {', '.join(state['completed']) or 'none'})")
+
+    phases = [('head', config['epochs'], 0)]
+    if config['fine_tune_blocks']:
+        phases.append(('fine_tune', config['fine_tune_epochs'], min(config['fine_tune_blocks'], MOBILENET_BLOCKS)))
+
+    for name, epochs, blocks in phases:
+        if name in state['completed']:
+            continue
+        if state['completed']:
+            # Continue from the best weights of the previous phase
+            state.restore_best(model)
+        if blocks:
+            unfreeze_top_blocks(model, blocks)
+            compile_model(model, config, model.loss, 'fine_tune_learning_rate')
+        if state['phase'] != name:
+            state['phase'] = name
+            state['wait'] = 0
+            state.save()
+
+        print(f"\nPhase '{name}': up to {epochs} epochs")
+        callbacks = [
+            # Weights, optimizer state and the epoch/batch reached; deleted when the phase ends
+            keras.callbacks.BackupAndRestore(os.path.join(run_dir, name),
+                                             save_freq=config['checkpoint_every'] or 'epoch'),
+            best_weights_callback(state, config['monitor'], config['patience'], config['min_delta']),
+            throughput_callback(samples),
+        ]
+        model.fit(
+            train_ds,
+            epochs=epochs,
+            validation_data=val_ds,
+            class_weight=class_weight,
+            callbacks=callbacks,
+            verbose=1
+        )
+        state['completed'].append(name)
+        state.save()
+
+    blocks_by_phase = {name: blocks for name, _, blocks in phases}
+    if state.restore_best(model):
+        best_phase = state.data.get('best_phase') or 'head'
+        print(f"Restored the best weights ({config['monitor']} = {state['best']:.4f}, phase '{best_phase}')")
+        fine_tuned_blocks = blocks_by_phase.get(best_phase, 0)
+    else:
+        # Nothing tracked: the model keeps the last phase's weights
+        fine_tuned_blocks = phases[-1][2]
+    return run_dir, fine_tuned_blocks
+
+
+def clear_checkpoints(run_dir):
+    """Remove a finished run's checkpoints, so the next run of the same command starts fresh."""
+    if run_dir:
+        shutil.rmtree(run_dir, ignore_errors=True)